@@ -19,78 +19,459 @@
 # TODO: Find a good os.nice value so we don't slow things down on a busy
 # system
 
-from ConfigParser import SafeConfigParser
+# Importing config does no work: s3backup.conf is read, the key file
+# opened and the encryption key derived the first time a setting that
+# needs them is used, so that --version, -h and short commands start
+# quickly. Each setting is worked out once and then kept; assigning one
+# (as s3bench does) overrides it, and the settings derived from it that
+# haven't been read yet follow.
+
 import os
+import sys
+import threading
+import types
+
+_lock = threading.RLock()
+
+
+class _setting(object):
+    '''A setting worked out by func the first time it is read, and then
+    kept in the config object.'''
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with _lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.func(instance)
+            return instance.__dict__[self.name]
+
+
+def _option(getter, section, option, default):
+    '''Returns the value of the option, or default if it isn't set. Newer
+    settings are optional so that older config files keep working. getter
+    is a method of scp.'''
+    if getter.__self__.has_option(section, option):
+        return getter(section, option)
+    return default
+
+
+class _Config(types.ModuleType):
+    '''The config module; see the comment at the top.'''
+
+    # Suite version
+    version = '0.9'
+
+    @_setting
+    def scp(self):
+        from ConfigParser import SafeConfigParser
+
+        scp = SafeConfigParser()
+        scp.read('s3backup.conf')
+        return scp
+
+    # === Company Settings === #
+
+    # Company / software name. Used as prefix for logging, eg:
+    # name.s3Backup ....
+    @_setting
+    def company(self):
+        return self.scp.get('Company', 'company')
+
+    # === AWS Settings === #
+
+    # Read the keys from a file; The first is the access key, the second is
+    # the secret key
+    @_setting
+    def keypath(self):
+        return self.scp.get('AWS', 'keypath')
+
+    @_setting
+    def _keys(self):
+        with open(self.keypath, 'r') as inf:
+            return inf.readline().strip(), inf.readline().strip()
+
+    @_setting
+    def aws_access_key_id(self):
+        return self._keys[0]
 
-scp = SafeConfigParser()
-scp.read('s3backup.conf')
+    @_setting
+    def aws_secret_access_key(self):
+        return self._keys[1]
 
-# Suite version
-version = '0.9'
+    @_setting
+    def bucket(self):
+        return self.scp.get('AWS', 'bucket_name')
 
-# === Company Settings === #
+    @_setting
+    def machine_name(self):
+        return self.scp.get('AWS', 'machine_name')
 
-# Company / software name. Used as prefix for logging, eg:
-# name.s3Backup ....
-company = scp.get('Company', 'company')
+    # Connect to another S3-compatible endpoint rather than Amazon (eg, a
+    # local stand-in for testing). Leave s3_host empty to use Amazon.
+    @_setting
+    def s3_host(self):
+        return _option(self.scp.get, 'AWS', 's3_host', '')
 
-# === AWS Settings === #
+    @_setting
+    def s3_port(self):
+        return _option(self.scp.getint, 'AWS', 's3_port', None)
 
-# Read the keys from a file; The first is the access key, the second is
-# the secret key
-keypath = scp.get('AWS', 'keypath')
-with open(keypath, 'r') as inf:
-    aws_access_key_id = inf.readline().strip()
-    aws_secret_access_key = inf.readline().strip()
+    @_setting
+    def s3_is_secure(self):
+        return _option(self.scp.getboolean, 'AWS', 's3_is_secure', True)
 
-bucket = scp.get('AWS', 'bucket_name')
-machine_name = scp.get('AWS', 'machine_name')
+    # === Directory / Filesystem settings === #
 
-# === Directory / Filesystem settings === #
+    @_setting
+    def base_dir(self):
+        return self.scp.get('Directory', 'base_directory')
 
-base_dir = scp.get('Directory', 'base_directory')
-daily_backup_list = os.path.join(base_dir, scp.get('Directory',
+    @_setting
+    def daily_backup_list(self):
+        return os.path.join(self.base_dir, self.scp.get('Directory',
                 'daily_list'))
-weekly_backup_list = os.path.join(base_dir, scp.get('Directory',
+
+    @_setting
+    def weekly_backup_list(self):
+        return os.path.join(self.base_dir, self.scp.get('Directory',
                 'weekly_list'))
-monthly_backup_list = os.path.join(base_dir, scp.get('Directory',
-                'monthly_list')) 
-
-dest_location = scp.get('Directory', 'destination')
-log_file = scp.get('Directory', 'log_path')
-hash_file_path = scp.get('Directory', 'hash_file_path')
-
-
-# === Backup settings === #
-
-log_raise_errs = scp.get('Backup', 'raise_log_errors')
-
-# Note: this deletes the entire dest_location folder
-delete_archive_when_finished = scp.get('Backup', 'delete_archive')
-
-pass_hash = scp.get('Backup', 'passwd_hash_type')
-
-# Import the proper module and initialize pass_hash
-if pass_hash == 'SHA512':
-    from Crypto.Hash import SHA512
-    pass_hash = SHA512.new()
-elif pass_hash == 'MD5':
-    from Crypto.Hash import MD5
-    pass_hash = MD5.new()
-elif pass_hash == 'SHA256':
-    from Crypto.Hash import SHA256
-    pass_hash = SHA256.new()
-else:
-    from Crypto.Hash import SHA
-    pass_hash = SHA.new()
-    
-# We hash a memorable password for the encryption key
-enc_backup = scp.get('Backup', 'use_encryption')
-enc_password = scp.get('Backup', 'encryption_password')
-pass_hash.update(enc_password)
-
-enc_key = pass_hash.digest()[0:32] # Use the first 32 bits
-enc_piece_size = 1024*64
-
-# Supported compression methods are none, gz, bz2, and zip
-compression_method = scp.get('Backup', 'compression')
+
+    @_setting
+    def monthly_backup_list(self):
+        return os.path.join(self.base_dir, self.scp.get('Directory',
+                'monthly_list'))
+
+    @_setting
+    def dest_location(self):
+        return self.scp.get('Directory', 'destination')
+
+    @_setting
+    def log_file(self):
+        return self.scp.get('Directory', 'log_path')
+
+    @_setting
+    def hash_file_path(self):
+        return self.scp.get('Directory', 'hash_file_path')
+
+    # === Logging settings === #
+
+    # The lowest level (DEBUG, INFO, WARNING, ERROR or CRITICAL) written to
+    # the log file and to the console.
+    @_setting
+    def log_file_level(self):
+        return _option(self.scp.get, 'Logging', 'file_level', 'DEBUG').upper()
+
+    @_setting
+    def log_console_level(self):
+        return _option(self.scp.get, 'Logging', 'console_level',
+                'DEBUG').upper()
+
+    # Write the log from a background thread, so the programs don't wait
+    # for the file or the console. Messages may then show up after a
+    # prompt.
+    @_setting
+    def log_queue(self):
+        return _option(self.scp.getboolean, 'Logging', 'queue', False)
+
+    # The debug messages about single files: all, none, or one in
+    # file_log_sample (sample); at most file_log_rate a second (0 for no
+    # limit). Loops over files also log how far they have got every
+    # progress_interval seconds (0 for never).
+    @_setting
+    def file_log(self):
+        file_log = _option(self.scp.get, 'Logging', 'file_log', 'all')
+        if file_log not in ('all', 'sample', 'none'):
+            file_log = 'all'
+        return file_log
+
+    @_setting
+    def file_log_sample(self):
+        return _option(self.scp.getint, 'Logging', 'file_log_sample', 100)
+
+    @_setting
+    def file_log_rate(self):
+        return _option(self.scp.getint, 'Logging', 'file_log_rate', 0)
+
+    @_setting
+    def progress_interval(self):
+        return _option(self.scp.getint, 'Logging', 'progress_interval', 0)
+
+    # === Backup settings === #
+
+    # raise_log_errors, delete_archive and use_encryption are booleans
+    # (True/False, yes/no, on/off or 1/0). Older releases read them as
+    # strings and compared to True, so they never took effect:
+    # archives stayed in plaintext (while tagged enc='True'), the
+    # destination directory was kept and logging errors were always
+    # raised.
+    # Turning them on in an old config file now does what it says;
+    # archives uploaded before then are still restored as plaintext (see
+    # utils.aws).
+    @_setting
+    def log_raise_errs(self):
+        return self.scp.getboolean('Backup', 'raise_log_errors')
+
+    # Note: this deletes the entire dest_location folder
+    @_setting
+    def delete_archive_when_finished(self):
+        return self.scp.getboolean('Backup', 'delete_archive')
+
+    # Import the proper module and initialize pass_hash with the password
+    @_setting
+    def pass_hash(self):
+        hash_type = self.scp.get('Backup', 'passwd_hash_type')
+        if hash_type == 'SHA512':
+            from Crypto.Hash import SHA512
+            pass_hash = SHA512.new()
+        elif hash_type == 'MD5':
+            from Crypto.Hash import MD5
+            pass_hash = MD5.new()
+        elif hash_type == 'SHA256':
+            from Crypto.Hash import SHA256
+            pass_hash = SHA256.new()
+        else:
+            from Crypto.Hash import SHA
+            pass_hash = SHA.new()
+        pass_hash.update(self.enc_password)
+        return pass_hash
+
+    # We hash a memorable password for the encryption key
+    @_setting
+    def enc_backup(self):
+        return self.scp.getboolean('Backup', 'use_encryption')
+
+    @_setting
+    def enc_password(self):
+        return self.scp.get('Backup', 'encryption_password')
+
+    @_setting
+    def enc_key(self):
+        return self.pass_hash.digest()[0:32] # Use the first 32 bits
+
+    enc_piece_size = 1024*64
+
+    # Encryption format 2 (AES-CTR with an HMAC per segment of
+    # encryption_segment_size KB, done on several processors) or 1
+    # (AES-CBC, for restoring with older versions). Both can be restored.
+    @_setting
+    def encryption_version(self):
+        return _option(self.scp.getint, 'Backup', 'encryption_version', 2)
+
+    @_setting
+    def encryption_segment_size(self):
+        return _option(self.scp.getint, 'Backup', 'encryption_segment_size',
+                1024) * 1024
+
+    # Supported compression methods are none, gz, bz2, and zip, and pgz,
+    # pbz2, zstd and lz4, which compress tar archives using several
+    # processes
+    @_setting
+    def compression_method(self):
+        return self.scp.get('Backup', 'compression')
+
+    # tar, or s3b: blocks of the tar archive are compressed (with the
+    # compression method's codec) and encrypted independently and in
+    # parallel, so they can be read in any order. Zip archives are always
+    # zip.
+    @_setting
+    def archive_format(self):
+        if self.compression_method == 'zip':
+            return 'zip'
+        return _option(self.scp.get, 'Backup', 'archive_format', 'tar')
+
+    # Stream the archive straight to S3 instead of writing it (and an
+    # encrypted copy) to dest_location first. Only tar archives can be
+    # streamed.
+    @_setting
+    def stream_backup(self):
+        return _option(self.scp.getboolean, 'Backup', 'stream_backup', False)
+
+    # Archives larger than upload_part_size MB are sent in pieces of that
+    # size by upload_workers threads at once. As the size of streamed
+    # uploads isn't known, their pieces double in size every 1000 pieces,
+    # to stay under S3's limit of 10000. S3 requires at least 5 MB.
+    @_setting
+    def upload_part_size(self):
+        return _option(self.scp.getint, 'Backup', 'upload_part_size',
+                16) * 1024 * 1024
+
+    # No piece is larger than upload_max_part_size MB; uploads hold up to
+    # 2 * upload_workers + 2 pieces in memory.
+    @_setting
+    def upload_max_part_size(self):
+        return _option(self.scp.getint, 'Backup', 'upload_max_part_size',
+                128) * 1024 * 1024
+
+    @_setting
+    def upload_workers(self):
+        return _option(self.scp.getint, 'Backup', 'upload_workers', 4)
+
+    # s3restore fetches archives in download_range_size MB pieces,
+    # download_workers at a time.
+    @_setting
+    def download_range_size(self):
+        return _option(self.scp.getint, 'Backup', 'download_range_size',
+                16) * 1024 * 1024
+
+    @_setting
+    def download_workers(self):
+        return _option(self.scp.getint, 'Backup', 'download_workers', 4)
+
+    # Deduplicated backups (s3backup --dedup) store file chunks under
+    # chunk_prefix, shared by every machine using the bucket. Machines
+    # sharing chunks must use the same password and encryption setting.
+    # chunk_index is a local cache of the chunks already uploaded. Chunk
+    # sizes are in KB; chunk_avg_size must be a power of two.
+    @_setting
+    def chunk_prefix(self):
+        return _option(self.scp.get, 'Backup', 'chunk_prefix', 'chunks')
+
+    @_setting
+    def chunk_index(self):
+        return _option(self.scp.get, 'Backup', 'chunk_index',
+                os.path.join(self.hash_file_path, 'chunks.db'))
+
+    @_setting
+    def chunk_min_size(self):
+        return _option(self.scp.getint, 'Backup', 'chunk_min_size',
+                256) * 1024
+
+    @_setting
+    def chunk_avg_size(self):
+        return _option(self.scp.getint, 'Backup', 'chunk_avg_size',
+                1024) * 1024
+
+    @_setting
+    def chunk_max_size(self):
+        return _option(self.scp.getint, 'Backup', 'chunk_max_size',
+                4096) * 1024
+
+    # Files up to this size in MB are read into memory when adding them to
+    # a zip archive, so they are only read once.
+    @_setting
+    def zip_memory_limit(self):
+        return _option(self.scp.getint, 'Backup', 'zip_memory_limit',
+                64) * 1024 * 1024
+
+    # File hashes are cached in hash_cache (an SQLite database) and reused
+    # while a file's inode, size, mtime and ctime are unchanged. At most
+    # hash_cache_entries are kept. Leave hash_cache empty to disable it.
+    @_setting
+    def hash_cache(self):
+        return _option(self.scp.get, 'Directory', 'hash_cache',
+                os.path.join(self.hash_file_path, 'hashcache.db'))
+
+    @_setting
+    def hash_cache_entries(self):
+        return _option(self.scp.getint, 'Backup', 'hash_cache_entries',
+                1000000)
+
+    # s3restore keeps a catalog of the archives in the bucket (an SQLite
+    # database) so it doesn't have to list them all each time.
+    @_setting
+    def catalog(self):
+        return _option(self.scp.get, 'Directory', 'catalog',
+                os.path.join(self.hash_file_path, 'catalog.db'))
+
+    # Directory trees are listed by scan_workers threads at once, which
+    # helps most on network filesystems.
+    @_setting
+    def scan_workers(self):
+        return _option(self.scp.getint, 'Backup', 'scan_workers', 8)
+
+    # Multipart uploads of files are recorded in upload_checkpoints so a
+    # later run can resume them. Checkpoints, and unfinished uploads in S3,
+    # older than stale_upload_days are removed.
+    @_setting
+    def upload_checkpoints(self):
+        return _option(self.scp.get, 'Directory', 'upload_checkpoints',
+                os.path.join(self.hash_file_path, 'uploads'))
+
+    @_setting
+    def stale_upload_days(self):
+        return _option(self.scp.getint, 'Backup', 'stale_upload_days', 7)
+
+    # s3put uploads put_workers files at a time.
+    @_setting
+    def put_workers(self):
+        return _option(self.scp.getint, 'Backup', 'put_workers', 8)
+
+    # All transfers together are kept under bandwidth_limit KB/s (0 for no
+    # limit). With autotune_transfers the number of requests at once (up to
+    # the *_workers settings) and the part and range sizes (up to 8 times
+    # the configured ones) follow the measured throughput, and back off
+    # when requests fail.
+    @_setting
+    def bandwidth_limit(self):
+        return _option(self.scp.getint, 'Backup', 'bandwidth_limit',
+                0) * 1024
+
+    @_setting
+    def autotune_transfers(self):
+        return _option(self.scp.getboolean, 'Backup', 'autotune_transfers',
+                True)
+
+    # s3backup and s3restore write the bytes, items and times of each stage
+    # of a run to metrics_path, as NAME.json and as NAME.prom for the
+    # Prometheus node exporter's textfile collector. Leave it empty to
+    # write none.
+    @_setting
+    def metrics_path(self):
+        return _option(self.scp.get, 'Directory', 'metrics_path',
+                os.path.join(self.hash_file_path, 'metrics'))
+
+    # s3put --bundle packs files smaller than bundle_threshold KB into
+    # objects of about bundle_size MB.
+    @_setting
+    def bundle_threshold(self):
+        return _option(self.scp.getint, 'Backup', 'bundle_threshold',
+                256) * 1024
+
+    @_setting
+    def bundle_size(self):
+        return _option(self.scp.getint, 'Backup', 'bundle_size',
+                64) * 1024 * 1024
+
+    # Settings for the parallel compression methods (pgz, pbz2, zstd and
+    # lz4); the level's range depends on the codec. Blocks of
+    # compression_block_size MB are compressed by compression_workers
+    # processes; 0 uses one per CPU.
+    @_setting
+    def compression_level(self):
+        return _option(self.scp.getint, 'Backup', 'compression_level', 9)
+
+    @_setting
+    def compression_workers(self):
+        return _option(self.scp.getint, 'Backup', 'compression_workers', 0)
+
+    @_setting
+    def compression_block_size(self):
+        return _option(self.scp.getint, 'Backup', 'compression_block_size',
+                4) * 1024 * 1024
+
+    # With the parallel compression methods, files that are already
+    # compressed (by extension, or judged by compressing a sample) are
+    # stored instead.
+    @_setting
+    def skip_incompressible(self):
+        return _option(self.scp.getboolean, 'Backup', 'skip_incompressible',
+                True)
+
+    @_setting
+    def incompressible_extensions(self):
+        return _option(self.scp.get, 'Backup', 'incompressible_extensions',
+                '7z bz2 flac gif gz jpeg jpg lz4 mkv mov mp3 mp4 ogg png '
+                'rar tgz webm webp xz zip zst').split()
+
+
+# Replace this module with a _Config, keeping the module itself alive so
+# that Python 2 doesn't clear the globals the settings use.
+_config = _Config(__name__, __doc__)
+_config.__file__ = __file__
+_config._module = sys.modules[__name__]
+sys.modules[__name__] = _config
@@ -22,6 +22,7 @@ import sys
 import config
 import utils.log
 import utils.encrypt
+import utils.metrics
 
 log = utils.log.get_logger('s3backup')
 
@@ -37,18 +38,37 @@ def main():
     parser.add_argument('--follow-symlinks', action='store_true',
             help='''If given, follows symbolic links. Note that zip
             archives always follow links.''')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--incremental', action='store_const',
+            dest='backup_type', const='incremental', default='full',
+            help='''Only archive files that are new or changed since the
+            last backup of this schedule.''')
+    mode.add_argument('--differential', action='store_const',
+            dest='backup_type', const='differential', help='''Only archive
+            files that are new or changed since the last full backup of
+            this schedule.''')
+    mode.add_argument('--dedup', action='store_const', dest='backup_type',
+            const='dedup', help='''Store files as deduplicated chunks
+            shared between backups and machines; only chunks not already
+            in the bucket are uploaded.''')
+    parser.add_argument('--profile', choices=['cpu', 'memory'],
+            help='''Profile the run with cProfile (the main thread only) or
+            tracemalloc, writing the results next to the metrics.''')
     parser.add_argument('--version', action='version', version='s3backup '
             '%s; Suite version %s' % (version, config.version))
     args = parser.parse_args()
 
-    do_backup(args.schedule, args.follow_symlinks)
+    with utils.metrics.run('s3backup-' + args.schedule, {'schedule':
+            args.schedule, 'backup_type': args.backup_type}, args.profile):
+        do_backup(args.schedule, args.follow_symlinks, args.backup_type)
 
 
-def do_backup(schedule, follow_links):
-    '''Handles the backup.'''
+def do_backup(schedule, follow_links, backup_type='full'):
+    '''Handles the backup. backup_type is "full", "incremental",
+    "differential" or "dedup".'''
     
-    from shutil import rmtree
     import utils.filesystem
+    import utils.manifest
 
     if schedule == 'daily':
         backup_list = config.daily_backup_list
@@ -59,44 +79,251 @@ def do_backup(schedule, follow_links):
 
     try:
         files = utils.filesystem.read_file_list(backup_list)
-        archive_path, tar_type = create_archive(files, follow_links)
-        if config.enc_backup == True:
+        files = [f.strip() for f in files if f.strip()]
+        if backup_type == 'dedup':
+            dedup_backup(files, follow_links, schedule)
+            return
+
+        # Runs of the same schedule would compare against and record the
+        # same state
+        with utils.manifest.lock_state(schedule):
+            archive_backup(files, follow_links, schedule, backup_type)
+    except IOError:
+        raise
+        log.critical('Cannot open file: %s' % backup_list)
+        sys.exit(1) 
+
+
+def archive_backup(files, follow_links, schedule, backup_type):
+    """Archives and sends the files, or those that changed since the last
+    backup or the last full backup, and records the state of the tree."""
+    from shutil import rmtree
+    import utils.aws
+    import utils.manifest
+    import utils.upload
+    from utils.misc import add_deleted_files, get_hash_file_path
+
+    utils.upload.clean_uploads(utils.aws.get_bucket(),
+            config.machine_name + '/', config.stale_upload_days * 86400)
+    if resume_backups(schedule):
+        log.info('Today\'s backup was made by an earlier run; its '
+                'upload is now finished.')
+        return
+
+    # Every run records the state of the tree so later incremental and
+    # differential runs have something to compare against.
+    state_path = utils.manifest.get_state_path(schedule)
+    full_state_path = utils.manifest.get_state_path(schedule, True)
+    if backup_type == 'differential':
+        ref_path = full_state_path
+    else:
+        ref_path = state_path
+    if backup_type != 'full' and not os.path.exists(ref_path):
+        log.warn('No previous backup to compare against. Making a '
+                'full backup.')
+        backup_type = 'full'
+    # A full backup archives everything anyway, so the archiver hashes
+    # new and changed files as it reads them.
+    state, changed, deleted = utils.manifest.find_changes(files,
+            utils.manifest.read_manifest(ref_path), follow_links,
+            backup_type != 'full')
+
+    archive_name = get_archive_info(schedule, backup_type)[0]
+    # Left by an earlier run of the day that failed
+    if os.path.exists(get_hash_file_path(archive_name)):
+        os.remove(get_hash_file_path(archive_name))
+    if backup_type != 'full':
+        if not changed and not deleted:
+            log.info('Nothing has changed since the last backup.')
+            return
+        files = changed
+        add_deleted_files(archive_name, deleted)
+
+    if config.stream_backup and config.compression_method != 'zip':
+        stream_backup(files, follow_links, schedule, backup_type)
+        save_pending_state(state, archive_name, backup_type)
+    else:
+        if config.stream_backup:
+            log.warn('Zip archives cannot be streamed. Creating the '
+                    'archive locally.')
+        archive_path, tar_type = create_archive(files, follow_links,
+                schedule, backup_type)
+        # Kept with the archive in case the upload has to be resumed
+        save_pending_state(state, archive_name, backup_type)
+        # s3b archives encrypt their blocks as they are written
+        if config.enc_backup == True and config.archive_format != 's3b':
             # We don't add the enc extension to the key - the metadata
             # will tell us whether the archive is encrypted.
             enc_file = utils.encrypt.encrypt_file(config.enc_key,
-                    archive_path, config.enc_piece_size)
-            send_backup(enc_file, tar_type, schedule)
+                    archive_path, config.enc_piece_size,
+                    get_segment_size(), config.compression_workers)
+            send_backup(enc_file, tar_type, schedule, backup_type,
+                    enc_format=get_enc_format())
             # Delete the plaintext local version
             os.remove(archive_path)
-        else: # Not encrypting
-            send_backup(archive_path, tar_type, schedule)
+        else: # Not encrypting, or an s3b archive
+            send_backup(archive_path, tar_type, schedule, backup_type,
+                    enc_format=get_enc_format())
 
         if config.delete_archive_when_finished == True:
             log.debug('Deleting archive.')
             rmtree(config.dest_location)
-    except IOError:
-        raise
-        log.critical('Cannot open file: %s' % backup_list)
-        sys.exit(1) 
 
+    commit_state(archive_name, schedule, backup_type)
 
-def create_archive(files, follow_links):
-    """Creates an archive of the given files and stores them in
-    the location specified by config.destination. Returns the full path of
-    the archive."""
 
-    from time import strftime
+def get_pending_state_path(archive_name):
+    """Returns where the state of the tree is kept until the archive has
+    been sent."""
+    from utils.misc import get_hash_file_path
+
+    return get_hash_file_path(archive_name)[:-len('.hash')] + '.state'
+
+
+def save_pending_state(state, archive_name, backup_type):
+    """Saves the state of the tree after the backup, to be recorded by
+    commit_state once the archive has been sent."""
+    import utils.manifest
+    from utils.misc import get_hash_file_path
+
+    if backup_type == 'full':
+        utils.manifest.fill_hashes(state, get_hash_file_path(archive_name))
+    utils.manifest.write_manifest(get_pending_state_path(archive_name),
+            state)
+
+
+def commit_state(archive_name, schedule, backup_type):
+    """Records the pending state of a sent backup as the schedule's state
+    for later incremental and differential backups."""
+    from shutil import copyfile
+    import utils.manifest
+
+    pending = get_pending_state_path(archive_name)
+    if not os.path.exists(pending):
+        log.warn('The state of the tree for %s was not saved; the next '
+                'incremental backup will compare against an older one.' %
+                archive_name)
+        return
+    state_path = utils.manifest.get_state_path(schedule)
+    os.rename(pending, state_path)
+    if backup_type == 'full':
+        copyfile(state_path, utils.manifest.get_state_path(schedule, True))
+
+
+def resume_backups(schedule):
+    """Finishes sending the archives of this schedule whose upload an
+    earlier run started but didn't finish, and records their state.
+    Returns True if one of them is today's."""
+    import utils.aws
+    import utils.upload
+
+    today = False
+    prefix = '%s/%s/' % (config.machine_name, schedule)
+    for checkpoint in utils.upload.list_checkpoints(prefix):
+        path = checkpoint.path
+        archive_type = '.' + checkpoint.keyname[len(prefix):].split('.', 1)[1]
+        metadata = checkpoint.state['metadata']
+        backup_type = metadata.get('backup-type', 'full')
+        log.info('Resuming the upload of %s.' % path)
+        send_backup(path, archive_type, schedule, backup_type,
+                checkpoint.keyname, metadata.get('enc-format'))
+        archive_name = path
+        if path.endswith('.enc'):
+            archive_name = path[:-len('.enc')]
+            if os.path.exists(archive_name):
+                os.remove(archive_name)
+        commit_state(archive_name, schedule, backup_type)
+        if config.delete_archive_when_finished == True:
+            os.remove(path)
+        if checkpoint.keyname == utils.aws.create_archive_key(archive_type,
+                schedule):
+            today = True
+    return today
+
+
+def dedup_backup(files, follow_links, schedule):
+    """Stores the files in the chunk store and uploads the backup's
+    manifest."""
+    import utils.aws
+    import utils.chunkstore
+
+    utils.chunkstore.backup_files(utils.aws.get_bucket(), files,
+            follow_links, utils.aws.create_archive_key('.chunks', schedule))
+
+
+def stream_backup(files, follow_links, schedule, backup_type='full'):
+    """Archives, compresses, encrypts and uploads the files in a single
+    pass. Nothing but the hash file is written to disk."""
+    from os.path import basename
+    import utils.aws
+    import utils.pcompress
+    import utils.upload
+    from utils.misc import get_hash_file_path
+
+    archive_name, archive_type, mode = get_archive_info(schedule, backup_type)
+    # tarfile's stream modes use '|' instead of ':'
+    mode = mode.replace(':', '|')
+    if (config.compression_method in utils.pcompress.PARALLEL or
+            config.archive_format == 's3b' or (config.enc_backup == True and
+            get_segment_size() is not None)):
+        # Start the worker processes before the upload threads
+        utils.pcompress.get_pool(config.compression_workers)
+
+    bucket = utils.aws.get_bucket()
+    keyname = utils.aws.create_archive_key(archive_type, schedule)
+    metadata = utils.aws.encryption_metadata(get_enc_format())
+    metadata['backup-type'] = backup_type
+    uploader = utils.upload.MultipartUpload(bucket, keyname,
+            config.upload_part_size, config.upload_workers, metadata,
+            max_part_size=config.upload_max_part_size)
+    hasher = utils.encrypt.HashingWriter(uploader)
+    if config.enc_backup == True and config.archive_format != 's3b':
+        if get_segment_size() is not None:
+            sink = utils.encrypt.SegmentEncryptingWriter(config.enc_key,
+                    hasher, get_segment_size(), config.compression_workers)
+        else:
+            sink = utils.encrypt.EncryptingWriter(config.enc_key, hasher,
+                    config.enc_piece_size)
+    else:
+        sink = hasher
+    sink = open_compressor(sink)
 
     try:
-        if not os.path.exists(config.dest_location):
-            os.makedirs(config.dest_location)
-    except OSError:
-        # TODO: Fallback to a tmp directory before failing
-        log.critical('Cannot create directory %s' % config.dest_location)
-        sys.exit(1)
+        index = create_tar(archive_name, files, mode, follow_links, sink)
+        sink.close()
+    except:
+        uploader.abort()
+        raise
+    log.debug('Streamed %s; hash %s' % (keyname, hasher.hexdigest()))
+    save_index(index, archive_name, sink)
+
+    # The archive's hash isn't known until it has been sent, so it's
+    # stored with the hash file instead of the archive.
+    utils.upload.send_file(bucket, get_hash_file_path(basename(
+            archive_name)), utils.aws.create_archive_key('.hash', schedule),
+            metadata={'archive-hash': hasher.hexdigest()})
+    send_index(bucket, archive_name, schedule)
+
+
+def get_archive_info(schedule, backup_type):
+    """Returns the full path of the archive, its extension, and the mode to
+    pass to tarfile (None for zip archives). The name holds the schedule
+    and backup type, so that the local files of backups made on the same
+    day are kept apart."""
+    from time import strftime
+    from utils.pcompress import PARALLEL
 
+    mode = None
     if config.compression_method == 'zip':
         archive_type = '.zip'
+    elif config.archive_format == 's3b':
+        # tarfile writes plain tar; open_compressor packs it into blocks
+        archive_type = '.s3b'
+        mode = 'w:'
+    elif config.compression_method in PARALLEL:
+        # tarfile writes plain tar; open_compressor compresses it
+        archive_type = '.tar.' + PARALLEL[config.compression_method]
+        mode = 'w:'
     else:
         archive_type = '.tar'
         mode = 'w:'
@@ -104,61 +331,236 @@ def create_archive(files, follow_links):
             archive_type = archive_type + '.' + config.compression_method
             mode += config.compression_method
 
-    archive_name = ('bak' + strftime('%Y%m%d') + archive_type)
+    archive_name = ('bak%s-%s-%s%s' % (strftime('%Y%m%d'), schedule,
+            backup_type, archive_type))
     archive_name = os.path.join(config.dest_location, archive_name)
+
+    return archive_name, archive_type, mode
+
+
+def create_archive(files, follow_links, schedule, backup_type):
+    """Creates an archive of the given files and stores them in
+    the location specified by config.destination. Returns the full path of
+    the archive."""
+
+    try:
+        if not os.path.exists(config.dest_location):
+            os.makedirs(config.dest_location)
+    except OSError:
+        # TODO: Fallback to a tmp directory before failing
+        log.critical('Cannot create directory %s' % config.dest_location)
+        sys.exit(1)
+
+    import utils.pcompress
+
+    archive_name, archive_type, mode = get_archive_info(schedule, backup_type)
    
     if config.compression_method == 'zip':
         # zipfile always follows links
         create_zip(archive_name, files)
+    elif (config.compression_method in utils.pcompress.PARALLEL or
+            config.archive_format == 's3b'):
+        with open(archive_name, 'wb') as outf:
+            compressor = open_compressor(outf)
+            index = create_tar(archive_name, files, 'w|', follow_links,
+                    compressor)
+            compressor.close()
+        save_index(index, archive_name, compressor)
     else:
-        create_tar(archive_name, files, mode, follow_links)
+        index = create_tar(archive_name, files, mode, follow_links)
+        save_index(index, archive_name)
 
     return archive_name, archive_type
 
 
+def has_index():
+    """Returns whether archives get a member index: only uncompressed tar
+    archives and those made by the block compressor can be read from the
+    middle."""
+    from utils.pcompress import PARALLEL
+
+    return (config.compression_method == 'none' or
+            config.compression_method in PARALLEL or
+            config.archive_format == 's3b')
+
+
+def save_index(index, archive_name, compressor=None):
+    """Writes the member index of an archive, if it can have one.
+    compressor is the ParallelCompressor the archive was written through,
+    if any."""
+    from utils.misc import get_index_file_path
+
+    if not has_index():
+        return
+    path = get_index_file_path(archive_name)
+    if config.archive_format == 's3b':
+        index.save(path, compressor.codec, compressor.blocks, 's3b')
+    elif config.compression_method == 'none':
+        index.save(path)
+    else:
+        index.save(path, compressor.codec, compressor.blocks)
+
+
+def send_index(bucket, archive_name, schedule, keyname=None):
+    """Uploads the member index of an archive, if it has one, to keyname or
+    today's index key."""
+    import utils.aws
+    import utils.upload
+    from utils.chunkstore import pack_metadata
+    from utils.misc import get_index_file_path
+
+    if keyname is None:
+        keyname = utils.aws.create_archive_key('.index', schedule)
+    if not has_index():
+        # Don't leave the index of an earlier backup made today
+        bucket.delete_key(keyname)
+        return
+    utils.upload.send_file(bucket, get_index_file_path(archive_name),
+            keyname, metadata=pack_metadata())
+
+
+def get_segment_size():
+    """Returns the segment size to encrypt archives with, or None to use
+    encryption format 1."""
+    if config.encryption_version == 1:
+        return None
+    return config.encryption_segment_size
+
+
+def get_enc_format():
+    """Returns the encryption format archives are written in (see
+    utils.aws.encryption_metadata), or None if they aren't encrypted."""
+    if config.enc_backup != True:
+        return None
+    if config.archive_format == 's3b':
+        return 'blocks'
+    if get_segment_size() is None:
+        return '1'
+    return '2'
+
+
+def open_compressor(fileobj):
+    """Wraps fileobj in a BlockArchiveWriter for s3b archives, or in a
+    ParallelCompressor if the compression method is a parallel one;
+    otherwise returns fileobj."""
+    from utils.blockarchive import CODECS, BlockArchiveWriter
+    from utils.pcompress import PARALLEL, ParallelCompressor
+
+    if config.archive_format == 's3b':
+        if config.enc_backup == True:
+            key = config.enc_key
+        else:
+            key = None
+        return BlockArchiveWriter(fileobj,
+                CODECS[config.compression_method], config.compression_level,
+                config.compression_workers, config.compression_block_size,
+                key)
+    if config.compression_method not in PARALLEL:
+        return fileobj
+    return ParallelCompressor(fileobj, PARALLEL[config.compression_method],
+            config.compression_level, config.compression_workers,
+            config.compression_block_size)
+
+
 def create_zip(archive, files):
     '''Creates a zip file containing the files being backed up.'''
     import zipfile
-    from utils.misc import add_file_hash
+    from utils.manifest import ManifestWriter
+    from utils.misc import get_hash_file_path
+    from utils.scanner import scan
 
+    manifest = ManifestWriter(get_hash_file_path(archive))
+    progress = utils.log.FileProgress(log, 'Added')
     try:
         # zipfile always follows links
         with zipfile.ZipFile(archive, 'w') as zipf:
             zipf.comment = 'Created by s3-backup'
+            files = [f.strip() for f in files]
             for f in files:
-                f = f.strip()
-                if os.path.exists(f):
-                    zipf.write(f)
-                    add_file_hash(archive, f)
-                    log.debug('Added %s.' % f)
-                else:
+                if not os.path.exists(f):
                     log.error('%s does not exist.' % f)
-                
-                if zipf.testzip() != None:
-                    log.error('An error occured creating the zip archive.')
+            for path, st in scan(files, True, config.scan_workers):
+                add_to_zip(zipf, path, st, manifest)
+                progress.add(path, st.st_size)
+            progress.finish()
+
+            if zipf.testzip() != None:
+                log.error('An error occured creating the zip archive.')
     except zipfile.BadZipfile:
         # I assume this only happens on reads? Just in case...
         log.critical('The zip file is corrupt.')
     except zipfile.LargeZipFile:
         log.critical('The zip file is greater than 2 GB.'
                 ' Enable zip64 functionality.')
+    finally:
+        manifest.close()
 
 
-def create_tar(archive, files, mode, follow_links):
-    '''Creates a tar archive of the files being backed up.'''
+def add_to_zip(zipf, path, st, manifest):
+    '''Adds a file to the zip archive, given its stat, and its hash to the
+    manifest.'''
+    import stat
+    import zipfile
+    from time import localtime
+
+    if stat.S_ISDIR(st.st_mode):
+        zipf.write(path)
+        return
+
+    if st.st_size > config.zip_memory_limit:
+        # Too big to hold in memory; zipfile has to read it itself
+        zipf.write(path)
+        manifest.add(path, utils.encrypt.get_file_hash(path))
+        return
+
+    # Read the file once, hashing it as it goes into the archive
+    with utils.metrics.timed('read', st.st_size, 1, io=True):
+        with open(path, 'rb') as inf:
+            data = inf.read()
+    info = zipfile.ZipInfo(path.lstrip('/'), localtime(st.st_mtime)[:6])
+    info.external_attr = (st.st_mode & 0xFFFF) << 16
+    info.compress_type = zipf.compression
+    zipf.writestr(info, data)
+    hash = utils.encrypt.new_hash()
+    hash.update(data)
+    manifest.add(path, hash.hexdigest())
+
+
+def create_tar(archive, files, mode, follow_links, fileobj=None):
+    '''Creates a tar archive of the files being backed up. If fileobj is
+    given, the archive is written to it rather than to the archive path;
+    the path is still used to name the hash file. Returns the archive's
+    MemberIndex.'''
     import tarfile
-    from utils.misc import add_file_hash
+    from utils.archiveindex import MemberIndex
+    from utils.manifest import ManifestWriter
+    from utils.misc import get_hash_file_path
+    from utils.scanner import scan
 
+    if fileobj is not None:
+        name = None
+    else:
+        name = archive
+    # Only the block compressor can store some files uncompressed
+    if config.skip_incompressible and hasattr(fileobj, 'set_compress'):
+        compressor = fileobj
+    else:
+        compressor = None
+
+    manifest = ManifestWriter(get_hash_file_path(archive))
+    index = MemberIndex()
+    progress = utils.log.FileProgress(log, 'Added')
     try:
-        with tarfile.open(archive, mode, dereference=follow_links) as tar:
+        with tarfile.open(name, mode, fileobj,
+                dereference=follow_links) as tar:
+            files = [f.strip() for f in files]
             for f in files:
-                f = f.strip()
-                if os.path.exists(f):
-                    tar.add(f)
-                    add_file_hash(archive, f);
-                    log.debug('Added %s.' % f)
-                else:
+                if not os.path.exists(f):
                     log.error('%s does not exist.' % f)
+            for path, st in scan(files, follow_links, config.scan_workers):
+                add_to_tar(tar, path, st, manifest, index, progress,
+                        compressor)
+        progress.finish()
     except tarfile.CompressionError:
         log.critical('There was an error compressing the backup archive. '
                 'Please try again.')
@@ -167,25 +569,74 @@ def create_tar(archive, files, mode, follow_links):
         log.critical('There was an error creating the backup archive. '
                 'Please try again.')
         sys.exit(1)
+    finally:
+        manifest.close()
+    return index
+
+
+def add_to_tar(tar, path, st, manifest, index, progress, compressor=None):
+    '''Adds a file to the tar archive, given its stat. Regular files are
+    hashed as they are read into the archive and the hashes are added to
+    the manifest, their offsets to the index and their sizes to the
+    FileProgress. If compressor is given, files that look incompressible
+    are stored uncompressed.'''
+    from utils.filesystem import get_tarinfo
+    from utils.pcompress import should_compress
+
+    if tar.name is not None and os.path.abspath(path) == tar.name:
+        # Don't add the archive to itself
+        return
+
+    tarinfo = get_tarinfo(tar, path, st)
+    if tarinfo is None:
+        log.error('Cannot archive %s; unsupported file type.' % path)
+    elif tarinfo.isreg():
+        if compressor is not None:
+            compressor.set_compress(should_compress(path, tarinfo.size))
+        with open(path, 'rb') as inf:
+            reader = utils.encrypt.HashingReader(
+                    utils.metrics.MeteredFile(inf, 'read'))
+            tar.addfile(tarinfo, reader)
+        utils.metrics.add('read', items=1)
+        manifest.add(path, reader.hexdigest())
+        index.add(tar, tarinfo)
+        progress.add(path, tarinfo.size)
+    else:
+        tar.addfile(tarinfo)
 
 
-def send_backup(path, tar_type, backup_schedule):
-    """Uses s3put.py to send a file to Amazon S3"""
+def send_backup(path, tar_type, backup_schedule, backup_type='full',
+        keyname=None, enc_format=None):
+    """Sends an archive to Amazon S3, as keyname or today's archive key.
+    enc_format is the format the archive is encrypted in, if it is (see
+    get_enc_format). Large archives are sent as resumable multipart
+    uploads."""
     # First we have to create a connection to S3
     from os.path import basename
     import utils.aws
+    import utils.upload
     from utils.misc import get_hash_file_path
 
     key = utils.aws.s3connect()
-    key.key = utils.aws.create_archive_key(tar_type, backup_schedule)
-    key.set_metadata('hash', utils.encrypt.get_file_hash(path))
-    key.set_metadata('enc', str(config.enc_backup))
+    if keyname is None:
+        keyname = utils.aws.create_archive_key(tar_type, backup_schedule)
+    key.key = keyname
+    # The archive's .hash and .index keys share its date
+    stem = keyname[:-len(tar_type)]
+    key.set_metadata('hash', utils.encrypt.get_file_hash(path,
+            use_cache=False))
+    key.update_metadata(utils.aws.encryption_metadata(enc_format))
+    key.set_metadata('backup-type', backup_type)
     log.debug('key: %s' % key)
     log.debug('meta:enc: %s' % key.get_metadata('enc'))
-    key.set_contents_from_filename(path)
+    utils.upload.send_file(key.bucket, path, key.key,
+            metadata=key.metadata)
     # Use the same name for the hash file, but a '.hash' extension
-    key.key = utils.aws.create_archive_key(".hash", backup_schedule)
-    key.set_contents_from_filename(get_hash_file_path(basename(path)))
+    if path.endswith('.enc'):
+        path = path[:-len('.enc')]
+    utils.upload.send_file(key.bucket, get_hash_file_path(basename(path)),
+            stem + '.hash', metadata=key.metadata)
+    send_index(key.bucket, basename(path), backup_schedule, stem + '.index')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,489 @@
+# s3bench.py - Measures the throughput of the backup and restore stages
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Builds a synthetic tree (many small files, a few huge ones, incompressible
+# data and sparse files), the same for the same seed and scale, and runs
+# each stage of a backup and a restore on it against a FakeS3 in this
+# process, with the settings in s3backup.conf. Everything written locally
+# goes under the work directory. The report is JSON:
+#
+#   {"tree": {"files": ..., "bytes": ..., "scale": ..., "seed": ...},
+#    "settings": {...}, "host": {...},
+#    "stages": [{"name": ..., "seconds": ..., "bytes": ..., "files": ...,
+#                "mb_per_s": ..., "files_per_s": ..., "cpu_seconds": ...,
+#                "peak_rss": ...}, ...]}
+#
+# cpu_seconds includes the compression processes, and the fake S3's
+# threads. peak_rss is the most memory this process (not the compression
+# processes) had resident during the stage.
+
+import os
+import sys
+import threading
+import time
+
+import config
+import utils.log
+
+
+log = utils.log.get_logger('s3bench')
+
+version = '0.1'
+
+STAGES = ['archive', 'hash', 'encrypt', 'upload', 'backup', 'restore']
+
+# The files of the tree at scale 1
+SMALL_FILES = 2000
+SMALL_MAX = 16 * 1024
+HUGE_FILES = 2
+HUGE_SIZE = 64 * 1024 * 1024
+RANDOM_FILES = 4
+RANDOM_SIZE = 8 * 1024 * 1024
+SPARSE_FILES = 1
+SPARSE_SIZE = 64 * 1024 * 1024
+# Sparse files have this much data every SPARSE_STRIDE bytes
+SPARSE_EXTENT = 1024 * 1024
+SPARSE_STRIDE = 16 * 1024 * 1024
+
+# Every file gets this mtime, so that trees are alike down to the archive
+TREE_MTIME = 1300000000
+
+PIECE_SIZE = 1024 * 1024
+
+
+def main():
+    import argparse
+    import json
+    import shutil
+    import tempfile
+
+    parser = argparse.ArgumentParser(description='''Measures the
+            throughput of each stage of a backup and a restore of a
+            synthetic tree, against a local S3 stand-in, and reports it as
+            JSON.''')
+    parser.add_argument('--workdir', help='''Where to build the tree and
+            the archives. By default a temporary directory, removed
+            afterwards.''')
+    parser.add_argument('--scale', type=float, default=1.0, help='''Scales
+            the number of small files and the size of the others. At 1 the
+            tree is about 230 MB.''')
+    parser.add_argument('--seed', type=int, default=0, help='''Seeds the
+            tree's contents.''')
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+            default=STAGES, help='''The stages to run, in order. restore
+            needs backup.''')
+    parser.add_argument('-o', '--output', help='''Write the report to this
+            file rather than to standard output.''')
+    parser.add_argument('--version', action='version', version='s3bench '
+            '%s; Suite version %s' % (version, config.version))
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='s3bench-')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    # Logging is set up by the first message, so this comes before any
+    use_log_files(workdir)
+    try:
+        if 'restore' in args.stages and 'backup' not in args.stages:
+            log.error('The restore stage needs the backup stage.')
+            sys.exit(1)
+        report = run_bench(workdir, args.scale, args.seed, args.stages)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, True)
+
+    if args.output:
+        with open(args.output, 'w') as outf:
+            json.dump(report, outf, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+def run_bench(workdir, scale, seed, stages):
+    '''Builds the tree under workdir, runs the stages and returns the
+    report.'''
+    import multiprocessing
+    import platform
+    import utils.fakes3
+    from utils.pcompress import get_pool
+
+    tree = os.path.join(workdir, 'tree')
+    log.info('Building the tree in %s.' % tree)
+    files, size = make_tree(tree, scale, seed)
+    use_workdir(workdir, tree)
+
+    # The pool is forked before the server's threads start
+    get_pool(config.compression_workers)
+    server = utils.fakes3.start(os.path.join(workdir, 's3'))
+    config.s3_host = server.host
+    config.s3_port = server.port
+    config.s3_is_secure = False
+    try:
+        results = []
+        context = {'tree': tree, 'files': files, 'bytes': size}
+        for name in stages:
+            log.info('Running the %s stage.' % name)
+            result = STAGE_FUNCTIONS[name](context)
+            if result is not None:
+                results.append(result)
+    finally:
+        server.stop()
+
+    return {'version': version,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'tree': {'files': files, 'bytes': size, 'scale': scale,
+                    'seed': seed},
+            'settings': dict((name, getattr(config, name)) for name in (
+                    'compression_method', 'compression_level',
+                    'compression_workers', 'compression_block_size',
+                    'archive_format', 'enc_backup', 'encryption_version',
+                    'encryption_segment_size', 'stream_backup',
+                    'upload_part_size', 'upload_max_part_size',
+                    'upload_workers', 'download_range_size',
+                    'download_workers',
+                    'bandwidth_limit', 'autotune_transfers')),
+            'host': {'platform': platform.platform(),
+                    'python': platform.python_version(),
+                    'cpus': multiprocessing.cpu_count()},
+            'stages': results}
+
+
+def use_log_files(workdir):
+    '''Points the log file and the metrics of the runs measured into
+    workdir, rather than at the configured ones.'''
+    config.log_file = os.path.join(workdir, 's3bench.log')
+    config.metrics_path = os.path.join(workdir, 'metrics')
+
+
+def use_workdir(workdir, tree):
+    '''Points the settings that write locally, and the bucket, into
+    workdir, and the daily backup list at the tree.'''
+    config.dest_location = os.path.join(workdir, 'dest')
+    config.hash_file_path = os.path.join(workdir, 'hash')
+    config.hash_cache = os.path.join(config.hash_file_path, 'hashcache.db')
+    config.catalog = os.path.join(config.hash_file_path, 'catalog.db')
+    config.chunk_index = os.path.join(config.hash_file_path, 'chunks.db')
+    config.upload_checkpoints = os.path.join(config.hash_file_path,
+            'uploads')
+    config.daily_backup_list = os.path.join(workdir, 'daily.s3')
+    config.bucket = 's3bench'
+    for path in (config.dest_location, config.hash_file_path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    with open(config.daily_backup_list, 'w') as outf:
+        outf.write(tree + '\n')
+
+
+# Tree
+
+
+def make_tree(root, scale, seed):
+    '''Builds the synthetic tree under root, unless it is there already.
+    Returns the number of files and their total size.'''
+    import random
+
+    rng = random.Random(seed)
+    text = make_text(rng)
+    plan = []
+    for i in range(max(int(SMALL_FILES * scale), 1)):
+        plan.append(('small/%02d/%05d.txt' % (i % 50, i), 'text',
+                rng.randint(1, SMALL_MAX)))
+    for i in range(max(int(HUGE_FILES * scale), 1)):
+        plan.append(('huge/%d.log' % i, 'text', int(HUGE_SIZE * scale)))
+    for i in range(RANDOM_FILES):
+        plan.append(('random/%d.bin' % i, 'random', int(RANDOM_SIZE * scale)))
+    for i in range(SPARSE_FILES):
+        plan.append(('sparse/%d.img' % i, 'sparse', int(SPARSE_SIZE * scale)))
+
+    total = 0
+    for number, (name, kind, size) in enumerate(plan):
+        path = os.path.join(root, name)
+        total += size
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            continue
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as outf:
+            if kind == 'text':
+                # A generator of its own, so that files left from an
+                # earlier run don't change the others
+                write_text(outf, text, random.Random('%d-%d' % (seed,
+                        number)), size)
+            elif kind == 'random':
+                write_random(outf, '%d-%d' % (seed, number), size)
+            else:
+                write_sparse(outf, '%d-%d' % (seed, number), size)
+        os.utime(path, (TREE_MTIME, TREE_MTIME))
+    return len(plan), total
+
+
+def make_text(rng):
+    '''Returns a megabyte of text made of a made-up vocabulary, which
+    compresses about as well as logs and source code do.'''
+    import string
+
+    words = [''.join(rng.choice(string.ascii_lowercase) for i in
+            range(rng.randint(2, 10))) for j in range(5000)]
+    lines = []
+    size = 0
+    while size < PIECE_SIZE:
+        line = ' '.join(rng.choice(words) for i in range(rng.randint(4,
+                16))) + '\n'
+        lines.append(line)
+        size += len(line)
+    return ''.join(lines)[:PIECE_SIZE]
+
+
+def write_text(outf, text, rng, size):
+    '''Writes size bytes of slices of text.'''
+    while size > 0:
+        start = rng.randint(0, len(text) - 1)
+        piece = text[start:start + size]
+        outf.write(piece)
+        size -= len(piece)
+
+
+def keystream(name):
+    '''Returns an AES-CTR cipher whose output, for encrypting zeroes, is
+    random-looking bytes that are the same for the same name.'''
+    import hashlib
+    from Crypto.Cipher import AES
+    from Crypto.Util import Counter
+
+    return AES.new(hashlib.sha256(name).digest(), AES.MODE_CTR,
+            counter=Counter.new(128))
+
+
+def write_random(outf, name, size):
+    '''Writes size incompressible bytes.'''
+    cipher = keystream(name)
+    while size > 0:
+        piece = min(size, PIECE_SIZE)
+        outf.write(cipher.encrypt(b'\0' * piece))
+        size -= piece
+
+
+def write_sparse(outf, name, size):
+    '''Writes a file of size bytes that is mostly holes, with
+    SPARSE_EXTENT random bytes every SPARSE_STRIDE bytes.'''
+    cipher = keystream(name)
+    for offset in range(0, size, SPARSE_STRIDE):
+        outf.seek(offset)
+        outf.write(cipher.encrypt(b'\0' * min(SPARSE_EXTENT, size - offset)))
+    outf.truncate(size)
+
+
+# Measurement
+
+
+class Stage(object):
+    '''Measures the wall and CPU time of the block it is used for, and
+    samples the resident memory of this process while it runs.'''
+
+    interval = 0.05
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.peak_rss = resident_memory()
+        self.running = True
+        self.sampler = threading.Thread(target=self._sample)
+        self.sampler.daemon = True
+        self.sampler.start()
+        self.cpu = cpu_time()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.time() - self.start
+        self.cpu = cpu_time() - self.cpu
+        self.running = False
+        self.sampler.join()
+        self.peak_rss = max(self.peak_rss, resident_memory())
+
+    def _sample(self):
+        while self.running:
+            self.peak_rss = max(self.peak_rss, resident_memory())
+            time.sleep(self.interval)
+
+    def result(self, size, files=0):
+        '''Returns the stage's entry in the report, for size bytes and
+        files files handled.'''
+        seconds = max(self.seconds, 1e-6)
+        result = {'name': self.name, 'seconds': round(self.seconds, 3),
+                'bytes': size, 'files': files,
+                'mb_per_s': round(size / 1048576.0 / seconds, 2),
+                'files_per_s': round(files / seconds, 1),
+                'cpu_seconds': round(self.cpu, 3),
+                'peak_rss': self.peak_rss}
+        log.info('%s: %.2f MB/s, %.1f files/s, %.2f s (%.2f s CPU).' % (
+                self.name, result['mb_per_s'], result['files_per_s'],
+                self.seconds, self.cpu))
+        return result
+
+
+def cpu_time():
+    '''Returns the CPU time used by this process, its finished children
+    and the compression pool's processes so far.'''
+    import resource
+    from utils import pcompress
+
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    if pcompress._pool is not None:
+        for process in pcompress._pool._pool:
+            total += process_cpu_time(process.pid)
+    return total
+
+
+def process_cpu_time(pid):
+    '''Returns the CPU time of another running process, from /proc; 0 where
+    there is no /proc.'''
+    try:
+        with open('/proc/%d/stat' % pid) as inf:
+            # The fields after the command, which may hold spaces
+            fields = inf.read().rsplit(')', 1)[1].split()
+    except IOError:
+        return 0.0
+    return (int(fields[11]) + int(fields[12])) / float(
+            os.sysconf('SC_CLK_TCK'))
+
+
+def resident_memory():
+    '''Returns the resident memory of this process in bytes, or its peak
+    so far where there is no /proc.'''
+    try:
+        with open('/proc/self/statm') as inf:
+            pages = int(inf.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        # KB on Linux, bytes on OS X
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return maxrss
+        return maxrss * 1024
+
+
+# Stages. Each takes the context shared between stages and returns its
+# result, or None if it doesn't apply to these settings.
+
+
+def bench_archive(context):
+    '''Creates the archive of the tree as s3backup would.'''
+    import s3backup
+
+    with Stage('archive') as stage:
+        path, extension = s3backup.create_archive([context['tree']], False,
+                'bench', 'full')
+    context['archive'] = path
+    context['extension'] = extension
+    return stage.result(context['bytes'], context['files'])
+
+
+def bench_hash(context):
+    '''Hashes the archive.'''
+    from utils.encrypt import get_file_hash
+
+    path = need_archive(context)
+    with Stage('hash') as stage:
+        get_file_hash(path, use_cache=False)
+    return stage.result(os.path.getsize(path))
+
+
+def bench_encrypt(context):
+    '''Encrypts the archive, if archives are encrypted as a whole.'''
+    import s3backup
+    from utils.encrypt import encrypt_file
+
+    if config.enc_backup != True or config.archive_format == 's3b':
+        log.info('Archives are not encrypted as a whole; skipping the '
+                'encrypt stage.')
+        return None
+    path = need_archive(context)
+    with Stage('encrypt') as stage:
+        context['upload'] = encrypt_file(config.enc_key, path,
+                config.enc_piece_size, s3backup.get_segment_size(),
+                config.compression_workers)
+    return stage.result(os.path.getsize(path))
+
+
+def bench_upload(context):
+    '''Sends the archive, encrypted if it was, as s3backup would, under a
+    schedule of its own.'''
+    import s3backup
+
+    path = context.get('upload') or need_archive(context)
+    with Stage('upload') as stage:
+        s3backup.send_backup(path, context['extension'], 'bench')
+    return stage.result(os.path.getsize(path))
+
+
+def bench_backup(context):
+    '''Runs a whole daily backup of the tree.'''
+    import shutil
+    import s3backup
+
+    # Leave nothing from the earlier stages for the backup to reuse
+    shutil.rmtree(config.dest_location, True)
+    os.makedirs(config.dest_location)
+    with Stage('backup') as stage:
+        s3backup.do_backup('daily', False, 'full')
+    return stage.result(context['bytes'], context['files'])
+
+
+def bench_restore(context):
+    '''Downloads, decrypts and extracts the daily backup, as s3restore
+    full-restore would.'''
+    import s3restore
+    from utils.pcompress import open_tar
+
+    root = os.path.join(os.path.dirname(context['tree']), 'restore')
+    if not os.path.isdir(config.dest_location):
+        os.makedirs(config.dest_location)
+    with Stage('restore') as stage:
+        archive = s3restore.handle_download(s3restore.s3connect(), 'daily',
+                'last', config.dest_location)
+        if config.compression_method == 'zip':
+            import zipfile
+            arc = zipfile.ZipFile(archive, 'r')
+        else:
+            arc = open_tar(archive)
+        arc.extractall(root)
+        arc.close()
+    return stage.result(context['bytes'], context['files'])
+
+
+def need_archive(context):
+    '''Returns the archive made by the archive stage, making it first if
+    that stage wasn't run.'''
+    if 'archive' not in context:
+        log.info('Creating the archive for the later stages.')
+        bench_archive(context)
+    return context['archive']
+
+
+STAGE_FUNCTIONS = {'archive': bench_archive, 'hash': bench_hash,
+        'encrypt': bench_encrypt, 'upload': bench_upload,
+        'backup': bench_backup, 'restore': bench_restore}
+
+
+if __name__ == "__main__":
+    main()
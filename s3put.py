@@ -19,7 +19,6 @@ import os.path
 
 import utils.log
 import config
-from utils.encrypt import getFileHash
 
 
 log = utils.log.get_logger('s3put')
@@ -28,8 +27,7 @@ version = '0.7'
 
 def main():
     import argparse
-    import utils.aws
-    import utils.filesystem 
+    from sys import exit
 
     parser = argparse.ArgumentParser(description='''Transfers the given
             file to Amazon S3.''')
@@ -37,48 +35,155 @@ def main():
             file is a list of files, send each item in the list. The
             directory tree is preserved so that the files can be restored
             to their original locations.''')
+    parser.add_argument('--sync', action='store_true', help='''Only
+            upload files that differ from S3. Files already uploaded today
+            are skipped, and files unchanged since the most recent earlier
+            upload are copied from it within S3, so each day still holds
+            every file.''')
+    parser.add_argument('--bundle', action='store_true', help='''With
+            --list, pack files smaller than bundle_threshold into larger
+            objects rather than uploading each one. Restore them with
+            s3restore get-files.''')
+    parser.add_argument('-w', '--workers', type=int, help='''The number of
+            files to upload at once; put_workers by default.''')
     parser.add_argument('file_path')
     args = parser.parse_args()
-    
-    key = utils.aws.s3connect()
-    key.key = utils.aws.create_file_key(os.path.basename(args.file_path))
-    if args.list:
-        # key.key is now a folder. We'll modify the key with each upload to
-        # place the files within it
-        base = os.path.dirname(key.key)
 
+    import utils.aws
+    import utils.filesystem 
+    import utils.upload
+
+    if args.workers is None:
+        args.workers = config.put_workers
+    bucket = utils.aws.get_bucket()
+    utils.upload.clean_uploads(bucket, config.machine_name + '/',
+            config.stale_upload_days * 86400)
+    keyname = utils.aws.create_file_key(os.path.basename(args.file_path))
+    if args.list:
+        # The files are placed within keyname's folder
+        base = os.path.dirname(keyname)
         files = utils.filesystem.read_file_list(args.file_path)
-        for f in files:
-            f = f.strip()
-            key.key = '/' + base + f
-
-            if os.path.isdir(f):
-                upload_dir_tree(f, key)
-            else:
-                key.set_metadata('hash', getFileHash(f))
-                key.set_contents_from_filename(f)
-
-
-def upload_dir_tree(dir_tree, key):
-    '''Uploads a directory tree rather than a single file.'''
-
-    def visit(_, dir_tree, files):
-        log.debug('dirtree\t%s' % dir_tree)
-        k = thekey      # Reset key each entry
-        for f in files:
-            log.debug('f: %s' % f)
-            fp = os.path.join(dir_tree, f)
-            if os.path.isfile(fp):
-                log.debug('reg f:  %s' % fp)
-                # For each file, update the key with the path
-                key.key = k + os.path.basename(fp)
-                key.set_metadata('hash', getFileHash(fp))
-                key.set_contents_from_filename(fp)
-
-    # Execute visit in each directory
-    thekey = key.key
+        uploads = list_uploads([f.strip() for f in files if f.strip()], base)
+        prefix = base + '/'
+    else:
+        uploads = [(args.file_path, keyname)]
+        prefix = keyname
+
+    should_send = None
+    find_copy = None
+    if args.sync:
+        if args.bundle:
+            log.error('--sync and --bundle cannot be combined.')
+            exit(1)
+        should_send = RemoteFiles(bucket, prefix).differs
+        earlier = earlier_upload(bucket, prefix)
+        if earlier is not None:
+            def find_copy(path, keyname):
+                return earlier.find(path, earlier.prefix +
+                        keyname[len(prefix):])
+    if args.bundle and args.list:
+        from utils.bundle import Bundler
+        uploads = Bundler(bucket, base, config.bundle_threshold,
+                config.bundle_size).filter(uploads)
+
+    report = utils.upload.upload_files(bucket, uploads, max(args.workers, 1),
+            should_send=should_send, find_copy=find_copy)
+    log.info('Uploaded %d files (%d bytes); %d copied unchanged from an '
+            'earlier upload; %d already uploaded today; %d failed.' %
+            (report.sent, report.bytes, report.copied, report.skipped,
+            len(report.failed)))
+    if report.failed:
+        for path, error in report.failed:
+            log.error('Not uploaded: %s (%s)' % (path, error))
+        exit(1)
+
+
+class RemoteFiles(object):
+    '''The keys under a prefix, with their size and ETag, from a single
+    (paged) LIST, for comparing local files against without a request per
+    file.'''
+
+    def __init__(self, bucket, prefix):
+        self.prefix = prefix
+        self.keys = {}
+        for key in bucket.list(prefix):
+            self.keys[key.name] = key
+        log.debug('Listed %d keys under %s.' % (len(self.keys), prefix))
+
+    def differs(self, path, keyname):
+        '''Returns whether the file at path is missing from keyname or
+        differs from it.'''
+        return self.find(path, keyname) is None
+
+    def find(self, path, keyname):
+        '''Returns the key at keyname if it holds the same data as the file
+        at path, or None. Sizes are compared first; hashes come from the
+        hash cache.'''
+        from utils.encrypt import get_file_hash, get_multipart_etag
+        from utils.throttle import part_sizes
+
+        key = self.keys.get(keyname)
+        if key is None:
+            return None
+        size, etag = key.size, key.etag.strip('"')
+        if os.path.getsize(path) != size:
+            return None
+        if '-' in etag:
+            # A multipart upload's ETag, which we can only reproduce if we
+            # know the part size; try those the uploader may have chosen
+            parts = int(etag.split('-')[1])
+            for part_size in part_sizes(config.upload_part_size, size):
+                if (-(-size // part_size) == parts and
+                        get_multipart_etag(path, part_size) == etag):
+                    return key
+            return None
+        if get_file_hash(path) != etag:
+            return None
+        return key
+
+
+def earlier_upload(bucket, prefix):
+    '''Returns the RemoteFiles of prefix (machine_name/YYYYMMDD/...) on
+    the most recent earlier date anything was uploaded with s3put, or
+    None if there is none.'''
+    base = config.machine_name + '/'
+    date, sep, rest = prefix[len(base):].partition('/')
+    dates = [item.name[len(base):].rstrip('/') for item in bucket.list(base,
+            '/')]
+    # The schedules of s3backup are listed as well
+    dates = [other for other in dates if len(other) == 8 and
+            other.isdigit() and other < date]
+    if not dates:
+        return None
+    return RemoteFiles(bucket, base + max(dates) + sep + rest)
+
+
+def list_uploads(paths, base):
+    '''Yields (path, keyname) for each file to upload from paths and the
+    directory trees among them. The keys are the paths under base.'''
+    for f in paths:
+        keyname = '%s/%s' % (base, f.lstrip('/'))
+        if os.path.isdir(f):
+            for item in dir_tree_uploads(f, keyname):
+                yield item
+        else:
+            yield f, keyname
+
+
+def dir_tree_uploads(dir_tree, keyname):
+    '''Yields (path, keyname) for each file in a directory tree. Each
+    file's key is keyname followed by its path within dir_tree.'''
+    import stat
+    from utils.scanner import scan
+
+    keyname = keyname.rstrip('/')
     log.debug('uploading tree %s', dir_tree)
-    os.path.walk(dir_tree, visit, None)
+    for fp, st in scan([dir_tree], False, config.scan_workers):
+        # Links to files are uploaded as the files
+        if stat.S_ISREG(st.st_mode) or (stat.S_ISLNK(st.st_mode) and
+                os.path.isfile(fp)):
+            yield fp, '%s/%s' % (keyname,
+                    os.path.relpath(fp, dir_tree).replace(os.sep, '/'))
 
 
 if __name__ == '__main__':
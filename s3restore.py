@@ -19,6 +19,7 @@ from sys import exit
 
 import config
 import utils.log
+import utils.metrics
 
 version = '1.1'
 
@@ -29,25 +30,31 @@ log = utils.log.get_logger('s3restore')
 def main():
     parser = get_args()
     args = parser.parse_args()
-    args.func(args) # Calls the appropriate function
+    # eg, run_full_restore is full-restore
+    command = args.func.__name__[len('run_'):].replace('_', '-')
+    with utils.metrics.run('s3restore-' + command, {'command': command},
+            args.profile):
+        args.func(args) # Calls the appropriate function
 
 # BEGIN command functions
 
 def handle_download(bucket, schedule, date, dest):
     ''' Handles the downloading and decrypting of the archive.'''
-   
-    try:
-        if dest != None:
-            archive, is_enc = get_restore_archive(bucket, schedule,
-                    date, dest)
-        else:
-            archive, is_enc = get_restore_archive(bucket, schedule,
-                    date, config.dest_location)
-        
-        if is_enc == True:
-            archive = decrypt(archive)
-    except:
-        raise
+    return download_archive(bucket, find_archive(bucket, schedule, date),
+            dest)
+
+
+def download_archive(bucket, key, dest):
+    '''Downloads the archive key to dest, or config.dest_location if dest
+    is None, and decrypts it. Returns the path of the archive.'''
+    if dest != None:
+        archive, is_enc = get_restore_archive(bucket, key, dest)
+    else:
+        archive, is_enc = get_restore_archive(bucket, key,
+                config.dest_location)
+
+    if is_enc == True:
+        archive = decrypt(archive)
     return archive
 
 
@@ -55,13 +62,14 @@ def run_full_restore(args):
     '''Executes the subcommand "full-restore".'''
 
     def do_restore(archive):
-        '''Restores a tar archive'''
+        '''Restores a tar archive, adding the names of the files it
+        restores to restored.'''
         if config.compression_method == 'zip':
             import zipfile
             arc = zipfile.ZipFile(archive, 'r')
         else:
-            import tarfile
-            arc = tarfile.open(archive, 'r')
+            from utils.pcompress import open_tar
+            arc = open_tar(archive)
 
         if args.force_no_overwrite:
             # Don't overwrite existing files.
@@ -72,15 +80,24 @@ def run_full_restore(args):
             for f in files:
                 filepath = join(root, f)
 
-                if not exists(filepath):
+                # Files from an earlier archive of the chain are replaced
+                if not exists(filepath) or f in restored:
                     log.info('Extracting %s' % f)
-                    arc.extract(f, root)
+                    with utils.metrics.timed('extract', items=1):
+                        arc.extract(f, root)
+                    restored.add(f)
                 else:
                     log.info('%s exists. Not restoring.' % f)
 
         elif args.force == True:
             # Write/overwrite everything
-            arc.extractall(root)
+            if config.compression_method == 'zip':
+                files = arc.namelist()
+            else:
+                files = arc.getnames()
+            with utils.metrics.timed('extract', items=len(files)):
+                arc.extractall(root)
+            restored.update(files)
         else:
             # Ask for each file
             if config.compression_method == 'zip':
@@ -90,27 +107,47 @@ def run_full_restore(args):
             for f in files:
                 do_it = raw_input('Restore %s? [y|n] ' % f)
                 if do_it.lower() == 'y':
-                    arc.extract(f, root)
+                    with utils.metrics.timed('extract', items=1):
+                        arc.extract(f, root)
+                    restored.add(f)
         
         arc.close()
+
+    def do_stream_restore(tar):
+        '''Restores a tar archive opened in stream mode. Each member has to
+        be extracted as soon as it is read.'''
+        for ti in tar:
+            if (args.force_no_overwrite and exists(join(root, ti.name)) and
+                    ti.name not in restored):
+                log.info('%s exists. Not restoring.' % ti.name)
+                continue
+            elif not args.force and not args.force_no_overwrite:
+                do_it = raw_input('Restore %s? [y|n] ' % ti.name)
+                if do_it.lower() != 'y':
+                    continue
+            log.info('Extracting %s' % ti.name)
+            with utils.metrics.timed('extract', ti.size, 1):
+                tar.extract(ti, root)
+            restored.add(ti.name)
+        tar.close()
+
+    def remove_deleted(key):
+        '''Removes the files restored from earlier archives of the chain
+        that were deleted before key was made. Files that were there
+        before the restore are left alone.'''
+        for f in get_deleted_files(bucket, key):
+            if f in restored:
+                log.info('Removing %s, deleted before %s.' % (f, key.key))
+                restored.discard(f)
+                if lexists(join(root, f)):
+                    remove(join(root, f))
  
     # BEGIN do_full_restore main body
 
-    from os.path import exists, join
+    from os import remove
+    from os.path import exists, join, lexists
     from sys import platform
 
-    bucket = s3connect()
-    log.debug('Calling handle_download. args.date = %s' % args.date)
-    archive = handle_download(bucket, args.schedule, args.date,
-            args.download_only)
-
-    # If --download-only was passed, print the destination and exit.
-    if args.download_only != None:
-        log.info('Saved file to %s.' % archive)
-        exit(0)
-    
-    log.debug('Archive: %s' % archive)
-  
     if platform.startswith('win'):
         if len(args.filesystem) == 1:
             if args.filesystem.isalpha():
@@ -121,7 +158,38 @@ def run_full_restore(args):
     else:
         root = '/'
 
-    do_restore(archive)
+    if args.stream and args.download_only != None:
+        log.error('--stream and --download-only cannot be combined.')
+        exit(1)
+
+    bucket = s3connect()
+    # An incremental or differential backup only holds what changed, so the
+    # backups it builds on are restored first.
+    chain = get_restore_chain(bucket, args.schedule,
+            find_archive(bucket, args.schedule, args.date))
+    restored = set()
+    for key in chain:
+        if len(chain) > 1:
+            log.info('Restoring %s.' % key.key)
+        if args.stream:
+            tar, check_hash = stream_archive(bucket, key)
+            do_stream_restore(tar)
+            check_hash()
+            remove_deleted(key)
+            continue
+
+        log.debug('Calling download_archive. key = %s' % key.key)
+        archive = download_archive(bucket, key, args.download_only)
+
+        # If --download-only was passed, print the destination.
+        if args.download_only != None:
+            log.info('Saved file to %s.' % archive)
+            continue
+
+        log.debug('Archive: %s' % archive)
+
+        do_restore(archive)
+        remove_deleted(key)
 
 
 def run_browse_files(args):
@@ -289,17 +357,14 @@ Previous commands: where "number" is the number printed on the listing.
 
     # BEGIN run_browse_files main code
 
-    import tarfile
     from os.path import exists, join
     from sys import platform
+    from utils.pcompress import open_tar
 
     bucket = s3connect()
 
-    # TODO: Instead of printing archive filenames, I want to get the date
-    # and  list the dates backups were made. Probably allow selecting one
-    # here and then browsing it
     if args.archives:
-        print('Implement browse archives')
+        print_archives(bucket, args.schedule, args.refresh)
         exit(0)
 
     archive = handle_download(bucket, args.schedule, args.date,
@@ -307,7 +372,7 @@ Previous commands: where "number" is the number printed on the listing.
     log.debug('Archive: %s' % archive)
 
     try:
-        tar = tarfile.open(archive)
+        tar = open_tar(archive)
     except IOError:
         log.critical('The archive %s does not exist.' % archive)
 
@@ -317,15 +382,120 @@ Previous commands: where "number" is the number printed on the listing.
     do_restore(args.root, tar, lst_to_extract)
 
 
+def print_archives(bucket, schedule=None, full=False):
+    '''Prints the archives of this machine, or of one schedule, from the
+    catalog.'''
+    from utils.catalog import open_catalog
+
+    if schedule is None:
+        schedules = ['daily', 'weekly', 'monthly']
+    else:
+        schedules = [schedule]
+    catalog = open_catalog(bucket, schedules, full)
+    archives = catalog.archives(config.machine_name, schedule)
+    catalog.close()
+
+    row_format = '{:12}{:10}{:9}{:>14}  {:11}{}'
+    print(row_format.format('Date', 'Schedule', 'Format', 'Size',
+            'Encrypted', 'Type'))
+    for key, schedule, date, size, archive_format, encrypted, backup_type \
+            in archives:
+        print(row_format.format('%s-%s-%s' % (date[:4], date[4:6], date[6:]),
+                schedule, archive_format, size, 'yes' if encrypted else 'no',
+                backup_type or 'full'))
+
+
+def run_dedup_restore(args):
+    '''Executes the subcommand "dedup-restore".'''
+    import utils.chunkstore
+
+    bucket = s3connect()
+    date = get_backup_date(bucket, args.schedule, args.date)
+    keyname = '%s/%s/%s.chunks' % (config.machine_name, args.schedule, date)
+    if bucket.get_key(keyname) is None:
+        log.error('There is not a deduplicated %s backup on %s.' %
+                (args.schedule, args.date))
+        exit(1)
+    utils.chunkstore.restore_files(bucket, keyname, args.root)
+
+
+def run_restore_paths(args):
+    '''Executes the subcommand "restore-paths". Only the parts of the
+    archive that hold the files are downloaded.'''
+    import utils.archiveindex
+    from utils.aws import is_encrypted, sibling_key
+    from utils.download import fetch_data
+
+    bucket = s3connect()
+    key, backup_name = build_key(bucket, args.schedule, args.date)
+    if key is None:
+        log.error('There is not a %s backup on %s.' % (args.schedule,
+                args.date))
+        exit(1)
+    index_key = bucket.get_key(sibling_key(key.key, '.index'))
+    if index_key is None:
+        log.error('%s has no index; use full-restore instead.' % backup_name)
+        exit(1)
+    index = utils.archiveindex.load_index(fetch_data(index_key),
+            is_encrypted(index_key))
+
+    names = set()
+    for path in args.paths:
+        # tarfile strips the leading '/' from member names
+        path = path.strip('/')
+        found = [name for name in index['members'] if name == path or
+                name.startswith(path + '/')]
+        if not found:
+            log.error('%s is not in %s.' % (path, backup_name))
+        names.update(found)
+    utils.archiveindex.extract_members(bucket, key.key, index, names,
+            args.root)
+
+
+def run_get_files(args):
+    '''Executes the subcommand "get-files". Restores files uploaded with
+    s3put --list, whether bundled or not.'''
+    import os
+    import utils.bundle
+    from utils.download import download_key
+
+    bucket = s3connect()
+    base = '%s/%s' % (config.machine_name, parse_date(args.date))
+    bundled = utils.bundle.load_index(bucket, base)
+
+    for path in args.paths:
+        # s3put strips the leading '/' from key names
+        path = path.strip('/')
+        names = [name for name in bundled if name == path or
+                name.startswith(path + '/')]
+        restored = 0
+        if names:
+            restored += utils.bundle.restore_files(bucket, bundled, names,
+                    args.root)
+        for key in bucket.list('%s/%s' % (base, path)):
+            name = key.name[len(base) + 1:]
+            if name.startswith('packs/') or (name != path and
+                    not name.startswith(path + '/')):
+                continue
+            dest = os.path.join(args.root, name)
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            download_key(key, dest, config.download_range_size,
+                    config.download_workers)
+            log.info('Restored %s.' % dest)
+            restored += 1
+        if not restored:
+            log.error('%s was not uploaded on %s.' % (path, args.date))
+
+
 # END command functions
 
 
 def s3connect():
     '''Connects to S3 and returns the bucket.'''
-    from boto import connect_s3
+    from utils.aws import connect
     
-    s3 = connect_s3(config.aws_access_key_id, config.aws_secret_access_key)
-    return s3.get_bucket(config.bucket)
+    return connect().get_bucket(config.bucket)
 
 
 def decrypt(archive):
@@ -337,7 +507,7 @@ def decrypt(archive):
 
     decrypted = archive + '.d'
     if decrypt_file(config.enc_key, archive, decrypted,
-            config.enc_piece_size):
+            config.enc_piece_size, config.compression_workers):
         log.debug('Encrypted file: %s' % decrypted)
         remove(archive)
         return decrypted 
@@ -346,19 +516,70 @@ def decrypt(archive):
         exit(1)
 
 
-def get_restore_archive(bucket, schedule, date, path):
-    '''Retrieves the archive from S3, saves it in config.dest_location, and
-    returns the filename.'''
+def stream_archive(bucket, key):
+    '''Opens the archive key on S3 as a tar stream that is downloaded,
+    decrypted and decompressed as it is read; nothing is written to disk.
+    Returns the tarfile and a function that checks the archive's hash once
+    it has been read.'''
+    from utils.aws import get_archive_hash, is_encrypted
+    from utils.download import PrefetchReader
+    import tarfile
+    from utils.blockarchive import BlockArchiveReader
+    from utils.encrypt import HashingReader, open_decrypting_reader
+    from utils.pcompress import get_pool, open_tar_stream
+
+    if config.compression_method == 'zip':
+        log.error('Zip archives cannot be streamed.')
+        exit(1)
+
+    name = key.name.rpartition('/')[2]
+    # s3b archives encrypt each block instead
+    encrypted = (is_encrypted(key) and
+            not name.endswith('.s3b'))
+    if encrypted or name.endswith('.s3b'):
+        # Start the worker processes before the download threads
+        get_pool(config.compression_workers)
+    reader = HashingReader(PrefetchReader(key, config.enc_piece_size * 16))
+    if encrypted:
+        stream = open_decrypting_reader(config.enc_key, reader,
+                config.enc_piece_size, config.compression_workers)
+    else:
+        stream = reader
+
+    def check_hash():
+        '''Reads anything left and compares the hash.'''
+        while reader.read(config.enc_piece_size):
+            pass
+        archive_hash = get_archive_hash(bucket, key)
+        if archive_hash is None:
+            log.warn('No hash stored for %s; cannot verify it.' % key.key)
+        elif archive_hash != reader.hexdigest():
+            log.critical('The archive %s is corrupt; the restored files '
+                    'may be damaged.' % key.key)
+            exit(1)
+
+    if name.endswith('.s3b'):
+        tar = tarfile.open(fileobj=BlockArchiveReader(stream, config.enc_key,
+                config.compression_workers), mode='r|')
+    else:
+        codec = {'tar': None, 'tar.gz': 'gz', 'tar.bz2': 'bz2',
+                'tar.zst': 'zst', 'tar.lz4': 'lz4'}[name.split('.', 1)[1]]
+        tar = open_tar_stream(stream, codec)
+    return tar, check_hash
+
+
+def get_restore_archive(bucket, key, path):
+    '''Retrieves the archive key from S3, saves it in path, and returns the
+    filename and whether it is encrypted.'''
     import os.path
     import boto.exception
+    from utils.aws import get_archive_hash, is_encrypted
+    from utils.download import download_key, verify_download
 
-    key, name = build_key(bucket, schedule, date)
-    try:
-        # Throws AttributeError if the key doesn't exist
-        is_encrypted = key.get_metadata('enc')
-    except AttributeError:
-        log.debug('The key "enc" does not exist.')
-        is_encrypted = False
+    name = key.name.rpartition('/')[2]
+    # s3b archives encrypt each block instead
+    encrypted = (is_encrypted(key) and
+            not name.endswith('.s3b'))
     
     if os.path.isdir(path):
         archive_path = os.path.join(path, name)
@@ -375,15 +596,22 @@ def get_restore_archive(bucket, schedule, date, path):
         exit(1)
 
     try:
-        key.get_contents_to_filename(archive_path)
+        download_key(key, archive_path, config.download_range_size,
+                config.download_workers, resume=True)
     except boto.exception.S3ResponseError:
         log.error('The archive %s does not exist.' % key.key)
         exit(1)
-    except AttributeError:
-        log.info('There is not a %s backup on %s.' % (schedule, date))
+
+    archive_hash = get_archive_hash(bucket, key)
+    if archive_hash is None:
+        log.warn('No hash stored for %s; cannot verify it.' % key.key)
+    elif not verify_download(archive_path, archive_hash):
+        # A rerun must not resume from the bad copy
+        os.remove(archive_path)
+        log.critical('The downloaded archive %s is corrupt.' % archive_path)
         exit(1)
     
-    return archive_path, is_encrypted
+    return archive_path, encrypted
 
 
 def build_key(bucket, backup_type, backup_date): 
@@ -392,30 +620,20 @@ def build_key(bucket, backup_type, backup_date):
     # All uploads begin 'machine/backup-type/date.extension' for
     # archive backups.
     # TODO: Determine extension
-    from time import strftime, strptime
-
-    if backup_date != 'last':
-        try:
-            date = strftime('%Y%m%d', strptime(backup_date, '%m %d %Y'))
-        except ValueError:
-            log.error('Improper date format given.')
-            exit(1)
-    else:
-        # Grab the most recent backup
-        prefix = ('%s/%s/' % (config.machine_name, backup_type))
-        thekey = max(bucket.list(prefix, '/'))
-        try:
-            date = thekey.key.split('/')[2].split('.')[0]
-        except:
-            log.error('Invalid archive filename; last backup not known.')
-            exit(1)
+    date = get_backup_date(bucket, backup_type, backup_date)
 
     if config.compression_method == 'zip':
         extension = 'zip'
-    elif config.compression_method == 'gz':
+    elif config.archive_format == 's3b':
+        extension = 's3b'
+    elif config.compression_method in ('gz', 'pgz'):
         extension = 'tar.gz'
-    elif config.compression_method == 'bz2':
+    elif config.compression_method in ('bz2', 'pbz2'):
         extension = 'tar.bz2'
+    elif config.compression_method == 'zstd':
+        extension = 'tar.zst'
+    elif config.compression_method == 'lz4':
+        extension = 'tar.lz4'
     elif config.compression_method == 'none':
         extension = 'tar'
 
@@ -427,6 +645,91 @@ def build_key(bucket, backup_type, backup_date):
     return key, backup_name
 
 
+def find_archive(bucket, schedule, date):
+    '''Returns the key of the archive of the given schedule and date, as
+    build_key does, exiting if there isn't one.'''
+    key, name = build_key(bucket, schedule, date)
+    if key is None:
+        log.info('There is not a %s backup on %s.' % (schedule, date))
+        exit(1)
+    return key
+
+
+def get_restore_chain(bucket, schedule, key):
+    '''Returns the keys of the archives a full restore of key extracts,
+    oldest first: key alone for a full backup, or the full backup an
+    incremental or differential one builds on and those after it.'''
+    from utils.catalog import open_catalog
+
+    if key.get_metadata('backup-type') in (None, 'full'):
+        return [key]
+    catalog = open_catalog(bucket, [schedule])
+    chain = catalog.restore_chain(config.machine_name, schedule, key.key)
+    catalog.close()
+    if chain is None:
+        log.error('The backups that %s builds on are missing; it cannot be '
+                'restored on its own.' % key.key)
+        exit(1)
+    return [bucket.get_key(keyname) for keyname in chain[:-1]] + [key]
+
+
+def get_deleted_files(bucket, key):
+    '''Returns the names, as they are stored in the archive, of the files
+    that the hash file of an incremental or differential archive lists as
+    deleted.'''
+    from utils.aws import sibling_key
+    from utils.download import fetch_data
+    from utils.manifest import DELETED
+
+    if key.get_metadata('backup-type') in (None, 'full'):
+        return []
+    hash_key = bucket.get_key(sibling_key(key.key, '.hash'))
+    if hash_key is None:
+        log.warn('No hash file stored for %s; files deleted before it was '
+                'made will not be removed.' % key.key)
+        return []
+    # Older versions appended the runs of a day to the same hash file, so
+    # a later line for a file replaces an earlier one.
+    deleted = set()
+    for line in fetch_data(hash_key).splitlines():
+        path, sep, hash = line.rpartition('\t')
+        # tarfile strips the leading '/' from member names
+        if hash == DELETED:
+            deleted.add(path.strip('/'))
+        else:
+            deleted.discard(path.strip('/'))
+    return sorted(deleted)
+
+
+def get_backup_date(bucket, backup_type, backup_date):
+    '''Returns the YYYYMMDD date of a backup given as "MM DD YYYY" or
+    "last".'''
+    if backup_date != 'last':
+        date = parse_date(backup_date)
+    else:
+        # Grab the most recent backup
+        from utils.catalog import open_catalog
+
+        catalog = open_catalog(bucket, [backup_type])
+        date = catalog.last_date(config.machine_name, backup_type)
+        catalog.close()
+        if date is None:
+            log.error('There are no %s backups.' % backup_type)
+            exit(1)
+    return date
+
+
+def parse_date(date):
+    '''Returns the YYYYMMDD form of a date given as "MM DD YYYY".'''
+    from time import strftime, strptime
+
+    try:
+        return strftime('%Y%m%d', strptime(date, '%m %d %Y'))
+    except ValueError:
+        log.error('Improper date format given.')
+        exit(1)
+
+
 def get_args():
     import argparse
     from sys import platform
@@ -434,6 +737,9 @@ def get_args():
     # Parent parser
     mainparser = argparse.ArgumentParser(description='''Restores backups
             created by s3backup.py''')
+    mainparser.add_argument('--profile', choices=['cpu', 'memory'],
+            help='''Profile the run with cProfile (the main thread only) or
+            tracemalloc, writing the results next to the metrics.''')
     mainparser.add_argument('--version', action='version',
             version='s3restore %s; Suite version %s' %
             (version, config.version))
@@ -442,7 +748,8 @@ def get_args():
 
     # Parser for the full-restore command
     fullparser = subparsers.add_parser('full-restore', help='''Restores all
-            files from the backup.''')
+            files from the backup, and from the backups that an incremental
+            or differential backup builds on.''')
     fullparser.add_argument('schedule', choices=['daily', 'weekly',
             'monthly'], help='Specifies the backup type to restore.')
     fullparser.add_argument('date', help='''The date the backup was made. A
@@ -457,6 +764,9 @@ def get_args():
     fullparser.add_argument('-d', '--download-only', metavar='DIR',
             help='''Download and decrypt (if necessary) the archive to the
             given directory, but do not extract.''')
+    fullparser.add_argument('--stream', action='store_true',
+            help='''Extract files while the archive downloads, without
+            saving it to disk. Not supported for zip archives.''')
     if platform.startswith('win'):
         fullparser.add_argument('-f', '--filesystem', default='C',
                 help='''The filesystem to use. Defaults to "C"''')
@@ -472,8 +782,11 @@ def get_args():
             was made. A string of the format "MM DD YYYY". A value of
             "last" browses the most recent backup.''')
     browseparser.add_argument('--archives', action='store_true',
-            help='''Prints the list of archives. If given, all other
-            arguments are ignored.''')
+            help='''Prints the list of archives, of the given schedule
+            only if -s is given. All other arguments are ignored.''')
+    browseparser.add_argument('--refresh', action='store_true',
+            help='''With --archives, lists every archive in S3 again rather
+            than only new ones, dropping those that were deleted.''')
     if platform.startswith('win'):
         browseparser.add_argument('r', '--root', default='C',
                 help='The root filesystem to restore to. Defaults to "C"')
@@ -482,6 +795,46 @@ def get_args():
                 help='''The root directory to restore to.''')
     browseparser.set_defaults(func=run_browse_files)
 
+    # Parser for the dedup-restore command
+    dedupparser = subparsers.add_parser('dedup-restore', help='''Restores
+            all files from a deduplicated backup (s3backup --dedup).''')
+    dedupparser.add_argument('schedule', choices=['daily', 'weekly',
+            'monthly'], help='Specifies the backup type to restore.')
+    dedupparser.add_argument('date', help='''The date the backup was made.
+            A quoted string of the format "MM DD YYYY". A value of "last"
+            restores the most recent backup.''')
+    dedupparser.add_argument('-r', '--root', default='/',
+            help='''The root directory to restore to.''')
+    dedupparser.set_defaults(func=run_dedup_restore)
+
+    # Parser for the restore-paths command
+    pathsparser = subparsers.add_parser('restore-paths', help='''Restores
+            the given files and directories, downloading only the parts of
+            the archive that hold them. Needs a tar archive that is
+            uncompressed or made with a parallel compression method.''')
+    pathsparser.add_argument('schedule', choices=['daily', 'weekly',
+            'monthly'], help='Specifies the backup type to restore.')
+    pathsparser.add_argument('date', help='''The date the backup was made.
+            A quoted string of the format "MM DD YYYY". A value of "last"
+            restores the most recent backup.''')
+    pathsparser.add_argument('paths', nargs='+', help='''The files and
+            directories to restore, as they were backed up.''')
+    pathsparser.add_argument('-r', '--root', default='/',
+            help='''The root directory to restore to.''')
+    pathsparser.set_defaults(func=run_restore_paths)
+
+    # Parser for the get-files command
+    getparser = subparsers.add_parser('get-files', help='''Downloads
+            files uploaded with s3put --list, including those bundled with
+            --bundle.''')
+    getparser.add_argument('date', help='''The date the files were
+            uploaded. A quoted string of the format "MM DD YYYY".''')
+    getparser.add_argument('paths', nargs='+', help='''The files and
+            directories to download, as they were uploaded.''')
+    getparser.add_argument('-r', '--root', default='/',
+            help='''The root directory to restore to.''')
+    getparser.set_defaults(func=run_get_files)
+
     return mainparser
 
 
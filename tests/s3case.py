@@ -0,0 +1,131 @@
+# s3case.py - A TestCase that runs the suite against a local FakeS3
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Not a test module itself; the tests that need S3 subclass S3TestCase.
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+import config
+
+# Settings the code under test reads, so no s3backup.conf is needed
+config.company = 'test'
+config.log_file = os.devnull
+config.log_file_level = config.log_console_level = 'CRITICAL'
+config.log_queue = False
+config.log_raise_errs = True
+config.bandwidth_limit = 0
+config.autotune_transfers = False
+
+
+class S3TestCase(unittest.TestCase):
+    '''Starts a FakeS3 for each test and points the settings that reach S3
+    or write locally at it and at a temporary directory. The tree to back
+    up is self.tree, and the bucket self.bucket.'''
+
+    def setUp(self):
+        import utils.aws
+        import utils.fakes3
+
+        self.dir = tempfile.mkdtemp(prefix='s3test-')
+        self.tree = os.path.join(self.dir, 'tree')
+        os.makedirs(self.tree)
+        self.server = utils.fakes3.start(os.path.join(self.dir, 's3'))
+        settings = {'s3_host': self.server.host, 's3_port': self.server.port,
+                's3_is_secure': False, 'aws_access_key_id': 'fake',
+                'aws_secret_access_key': 'fake', 'bucket': 'test',
+                'machine_name': 'host.example.com',
+                'dest_location': os.path.join(self.dir, 'dest'),
+                'hash_file_path': os.path.join(self.dir, 'hash'),
+                'metrics_path': os.path.join(self.dir, 'metrics'),
+                'compression_method': 'gz', 'archive_format': 'tar',
+                'compression_level': 6, 'enc_backup': False,
+                'enc_key': hashlib.sha256(b'password').digest(),
+                'stream_backup': False, 'delete_archive_when_finished': False,
+                'upload_part_size': 5, 'upload_max_part_size': 1024 ** 2,
+                'upload_workers': 2,
+                'download_range_size': 5, 'download_workers': 2,
+                'stale_upload_days': 7, 'put_workers': 2}
+        for name, value in settings.items():
+            setattr(config, name, value)
+        # Off, since the cache stays open at the first test's path
+        config.hash_cache = ''
+        config.catalog = os.path.join(config.hash_file_path, 'catalog.db')
+        config.chunk_index = os.path.join(config.hash_file_path, 'chunks.db')
+        config.upload_checkpoints = os.path.join(config.hash_file_path,
+                'uploads')
+        for schedule in ('daily', 'weekly', 'monthly'):
+            backup_list = os.path.join(self.dir, schedule + '.s3')
+            with open(backup_list, 'w') as outf:
+                outf.write(self.tree + '\n')
+            setattr(config, schedule + '_backup_list', backup_list)
+        for path in (config.dest_location, config.hash_file_path):
+            os.makedirs(path)
+        self.bucket = utils.aws.get_bucket()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir, True)
+
+    def write(self, name, data):
+        '''Writes data to the file name under the tree.'''
+        path = os.path.join(self.tree, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as outf:
+            outf.write(data)
+        # Make the change visible to a size and mtime comparison
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 1))
+
+    def read_tree(self):
+        '''Returns {name: contents} of the files under the tree.'''
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.tree):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                with open(path, 'rb') as inf:
+                    files[os.path.relpath(path, self.tree)] = inf.read()
+        return files
+
+
+@contextmanager
+def fake_date(date):
+    '''Makes today's YYYYMMDD date, as the archive and file keys use it,
+    date.'''
+    strftime = time.strftime
+
+    def fake_strftime(format, t=None):
+        if format == '%Y%m%d' and t is None:
+            return date
+        if t is None:
+            return strftime(format)
+        return strftime(format, t)
+
+    time.strftime = fake_strftime
+    try:
+        yield
+    finally:
+        time.strftime = strftime
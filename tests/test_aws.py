@@ -0,0 +1,83 @@
+# test_aws.py - Tests for utils/aws.py
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top directory with: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+from utils import aws
+
+
+class FakeKey(object):
+
+    def __init__(self, key, metadata=None):
+        self.key = key
+        self.metadata = metadata or {}
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+
+class FakeBucket(object):
+
+    def __init__(self, keys):
+        self.keys = dict((key.key, key) for key in keys)
+
+    def get_key(self, keyname):
+        return self.keys.get(keyname)
+
+
+class SiblingKeyTest(unittest.TestCase):
+
+    def test_plain_machine_name(self):
+        self.assertEqual(aws.sibling_key('host/daily/20261018.tar.gz',
+                '.hash'), 'host/daily/20261018.hash')
+
+    def test_dotted_machine_name(self):
+        self.assertEqual(aws.sibling_key(
+                'host.example.com/daily/20261018.tar.gz', '.index'),
+                'host.example.com/daily/20261018.index')
+
+    def test_no_directory(self):
+        self.assertEqual(aws.sibling_key('20261018.s3b', '.hash'),
+                '20261018.hash')
+
+
+class GetArchiveHashTest(unittest.TestCase):
+
+    def test_hash_on_archive(self):
+        key = FakeKey('host/daily/20261018.tar', {'hash': 'abc'})
+        self.assertEqual(aws.get_archive_hash(FakeBucket([]), key), 'abc')
+
+    def test_streamed_archive_with_dotted_machine_name(self):
+        key = FakeKey('host.example.com/daily/20261018.tar.gz')
+        bucket = FakeBucket([key, FakeKey(
+                'host.example.com/daily/20261018.hash',
+                {'archive-hash': 'def'})])
+        self.assertEqual(aws.get_archive_hash(bucket, key), 'def')
+
+    def test_no_hash(self):
+        key = FakeKey('host.example.com/daily/20261018.tar')
+        self.assertEqual(aws.get_archive_hash(FakeBucket([key]), key), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
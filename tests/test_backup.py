@@ -0,0 +1,133 @@
+# test_backup.py - Tests of s3backup and s3restore full-restore
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top directory with: python -m unittest discover tests
+
+import argparse
+import os
+import shutil
+import unittest
+
+from s3case import S3TestCase, fake_date
+
+import config
+import s3backup
+import s3restore
+
+
+class BackupChainTest(S3TestCase):
+
+    def restore(self, schedule):
+        '''Restores the last backup of schedule in place of the tree and
+        returns what was restored.'''
+        shutil.rmtree(self.tree)
+        s3restore.run_full_restore(argparse.Namespace(schedule=schedule,
+                date='last', force=True, force_no_overwrite=False,
+                download_only=None, stream=False))
+        return self.read_tree()
+
+    def test_full_and_incremental_on_one_day(self):
+        self.write('a', b'a1')
+        self.write('b', b'b1')
+        self.write('sub/c', b'c1')
+        with fake_date('20260101'):
+            s3backup.do_backup('daily', False, 'full')
+
+        self.write('a', b'a2')
+        os.remove(os.path.join(self.tree, 'b'))
+        self.write('d', b'd1')
+        with fake_date('20260102'):
+            s3backup.do_backup('weekly', False, 'full')
+            weekly = self.read_tree()
+            self.write('sub/c', b'c2')
+            s3backup.do_backup('daily', False, 'incremental')
+        daily = self.read_tree()
+
+        # Each run keeps its own hash file and state
+        hash_files = sorted(name for name in os.listdir(
+                config.hash_file_path) if name.endswith('.hash'))
+        self.assertEqual(hash_files, ['bak20260101-daily-full.tar.gz.hash',
+                'bak20260102-daily-incremental.tar.gz.hash',
+                'bak20260102-weekly-full.tar.gz.hash'])
+        lines = self.bucket.get_key('host.example.com/daily/20260102.hash'
+                ).get_contents_as_string().splitlines()
+        self.assertEqual(sorted(line.split('\t')[0][len(self.tree) + 1:]
+                for line in lines), ['a', 'b', 'd', 'sub/c'])
+        self.assertIn(os.path.join(self.tree, 'b') + '\tDELETED', lines)
+
+        chain = s3restore.get_restore_chain(self.bucket, 'daily',
+                s3restore.find_archive(self.bucket, 'daily', 'last'))
+        self.assertEqual([key.name for key in chain],
+                ['host.example.com/daily/%s.tar.gz' % date
+                for date in ('20260101', '20260102')])
+        self.assertEqual(self.restore('daily'), daily)
+        self.assertEqual(self.restore('weekly'), weekly)
+
+    def test_differential(self):
+        self.write('a', b'a1')
+        self.write('b', b'b1')
+        with fake_date('20260101'):
+            s3backup.do_backup('daily', False, 'full')
+        self.write('a', b'a2')
+        with fake_date('20260102'):
+            s3backup.do_backup('daily', False, 'incremental')
+        os.remove(os.path.join(self.tree, 'b'))
+        with fake_date('20260103'):
+            s3backup.do_backup('daily', False, 'differential')
+        self.assertEqual(self.restore('daily'), {'a': b'a2'})
+
+    def test_restore_paths_of_encrypted_backup(self):
+        config.enc_backup = True
+        # Only archives that can be read from the middle get an index
+        config.compression_method = 'pgz'
+        self.write('a', b'a1')
+        self.write('sub/b', b'b1')
+        with fake_date('20260101'):
+            s3backup.do_backup('daily', False, 'full')
+        index_key = self.bucket.get_key('host.example.com/daily/'
+                '20260101.index')
+        self.assertEqual(index_key.get_metadata('enc-format'), 'data')
+
+        # The index is read as its key's metadata says, not as configured
+        config.enc_backup = False
+        shutil.rmtree(self.tree)
+        s3restore.run_restore_paths(argparse.Namespace(schedule='daily',
+                date='01 01 2026', paths=[self.tree + '/sub'], root='/'))
+        self.assertEqual(self.read_tree(), {'sub/b': b'b1'})
+
+    def test_dedup_with_encryption_turned_on(self):
+        self.write('a', b'a1' * 1000)
+        with fake_date('20260101'):
+            s3backup.do_backup('daily', False, 'dedup')
+        # The new backup reuses the chunk of a, stored unencrypted
+        config.enc_backup = True
+        self.write('b', b'b1' * 1000)
+        with fake_date('20260102'):
+            s3backup.do_backup('daily', False, 'dedup')
+        manifest = self.bucket.get_key('host.example.com/daily/'
+                '20260102.chunks')
+        self.assertEqual(manifest.get_metadata('enc-format'), 'data')
+        expected = self.read_tree()
+
+        config.enc_backup = False
+        shutil.rmtree(self.tree)
+        s3restore.run_dedup_restore(argparse.Namespace(schedule='daily',
+                date='01 02 2026', root='/'))
+        self.assertEqual(self.read_tree(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
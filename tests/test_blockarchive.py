@@ -0,0 +1,166 @@
+# test_blockarchive.py - Tests for utils/blockarchive.py
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top directory with: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+import config
+from utils import blockarchive
+from utils import encrypt
+
+# Settings the code under test reads, so no s3backup.conf is needed
+config.company = 'test'
+config.log_file = os.devnull
+config.log_file_level = config.log_console_level = 'CRITICAL'
+config.log_queue = False
+config.log_raise_errs = True
+
+KEY = b'k' * 32
+BLOCK_SIZE = 1024
+
+
+class KeptBytesIO(BytesIO):
+    '''Keeps its contents when closed.'''
+
+    def close(self):
+        self.contents = self.getvalue()
+
+
+def write_archive(data, key=KEY, codec='gz'):
+    out = KeptBytesIO()
+    writer = blockarchive.BlockArchiveWriter(out, codec, 6, 2, BLOCK_SIZE,
+            key)
+    # Each write that fills the buffer ends a block
+    for i in range(0, len(data), BLOCK_SIZE):
+        writer.write(data[i:i + BLOCK_SIZE])
+    writer.close()
+    return out.contents, writer.blocks
+
+
+def read_archive(stored, key=KEY):
+    return blockarchive.BlockArchiveReader(BytesIO(stored), key, 2).read()
+
+
+def write_v1_archive(data, codec='gz'):
+    '''Writes an archive as version 1 did, its blocks encrypted with
+    encrypt_data.'''
+    from utils.pcompress import compress_block
+
+    stored = blockarchive.HEADER.pack(blockarchive.MAGIC, 1,
+            blockarchive.ENCRYPTED, codec.encode('ascii'), BLOCK_SIZE)
+    for i in range(0, len(data), BLOCK_SIZE):
+        block = encrypt.encrypt_data(KEY, compress_block(codec, 6,
+                data[i:i + BLOCK_SIZE]))
+        stored += blockarchive.BLOCK_HEADER.pack(len(block)) + block
+    return stored + blockarchive.BLOCK_HEADER.pack(0)
+
+
+class BlockArchiveTest(unittest.TestCase):
+
+    data = os.urandom(BLOCK_SIZE * 3 // 2) * 3
+
+    def test_round_trip(self):
+        stored, blocks = write_archive(self.data)
+        self.assertEqual(len(blocks), 5)
+        self.assertEqual(read_archive(stored), self.data)
+
+    def test_round_trip_unencrypted(self):
+        stored, blocks = write_archive(self.data, None, None)
+        self.assertEqual(read_archive(stored, None), self.data)
+
+    def test_seek(self):
+        stored, blocks = write_archive(self.data)
+        reader = blockarchive.BlockArchiveReader(BytesIO(stored), KEY, 2)
+        reader.seek(len(self.data) - 10)
+        self.assertEqual(reader.read(), self.data[-10:])
+        reader.seek(BLOCK_SIZE + 3)
+        self.assertEqual(reader.read(5), self.data[BLOCK_SIZE + 3:
+                BLOCK_SIZE + 8])
+
+    def test_seek_from_end(self):
+        stored, blocks = write_archive(self.data)
+        reader = blockarchive.BlockArchiveReader(BytesIO(stored), KEY, 2)
+        reader.seek(-10, 2)
+        self.assertEqual(reader.tell(), len(self.data) - 10)
+        self.assertEqual(reader.read(), self.data[-10:])
+
+    def test_seek_back_after_end(self):
+        stored, blocks = write_archive(self.data)
+        reader = blockarchive.BlockArchiveReader(BytesIO(stored), KEY, 2)
+        self.assertEqual(reader.read(), self.data)
+        self.assertTrue(reader.ended)
+        reader.seek(0)
+        # The end of the archive is checked for again
+        self.assertFalse(reader.ended)
+        self.assertEqual(reader.read(), self.data)
+        self.assertTrue(reader.ended)
+
+    def test_seek_in_empty_archive(self):
+        for key in (KEY, None):
+            stored, blocks = write_archive(b'', key)
+            self.assertEqual(blocks, [])
+            reader = blockarchive.BlockArchiveReader(BytesIO(stored), key, 2)
+            reader.seek(0, 2)
+            self.assertEqual(reader.tell(), 0)
+            self.assertEqual(reader.read(), b'')
+
+    def test_changed_block(self):
+        stored, blocks = write_archive(self.data)
+        offset = blocks[1][2] + blockarchive.BLOCK_HEADER.size
+        changed = (stored[:offset] + bytearray([ord(stored[offset:offset +
+                1]) ^ 1]) + stored[offset + 1:])
+        self.assertRaises(IOError, read_archive, bytes(changed))
+
+    def test_swapped_blocks(self):
+        stored, blocks = write_archive(self.data)
+        first = stored[blocks[0][2]:blocks[0][2] + blocks[0][3]]
+        second = stored[blocks[1][2]:blocks[1][2] + blocks[1][3]]
+        swapped = (stored[:blocks[0][2]] + second + first +
+                stored[blocks[1][2] + blocks[1][3]:])
+        self.assertRaises(IOError, read_archive, swapped)
+
+    def test_dropped_blocks(self):
+        stored, blocks = write_archive(self.data)
+        cut = (stored[:blocks[-1][2]] +
+                blockarchive.BLOCK_HEADER.pack(0))
+        self.assertRaises(IOError, read_archive, cut)
+
+    def test_unpack_block_by_number(self):
+        stored, blocks = write_archive(self.data)
+        header = blockarchive.cipher_header(stored)
+        offset, size, stored_offset, stored_size = blocks[2]
+        block = stored[stored_offset + blockarchive.BLOCK_HEADER.size:
+                stored_offset + stored_size]
+        self.assertEqual(blockarchive.unpack_block('gz', KEY, block, header,
+                2), self.data[offset:offset + size])
+        self.assertRaises(IOError, blockarchive.unpack_block, 'gz', KEY,
+                block, header, 3)
+
+    def test_version_1(self):
+        stored = write_v1_archive(self.data)
+        self.assertEqual(blockarchive.cipher_header(stored), None)
+        self.assertEqual(read_archive(stored), self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
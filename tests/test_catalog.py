@@ -0,0 +1,156 @@
+# test_catalog.py - Tests for utils/catalog.py
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top directory with: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+import config
+from s3case import S3TestCase
+from utils import catalog
+
+# Settings the code under test reads, so no s3backup.conf is needed
+config.company = 'test'
+config.log_file = os.devnull
+config.log_file_level = config.log_console_level = 'CRITICAL'
+config.log_queue = False
+config.log_raise_errs = True
+
+
+class RestoreChainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = catalog.Catalog(':memory:')
+
+    def tearDown(self):
+        self.catalog.close()
+
+    def add(self, date, backup_type, extension='tar.gz'):
+        keyname = 'host.example.com/daily/%s.%s' % (date, extension)
+        self.catalog.db.execute('INSERT INTO archives VALUES (?, ?, ?, ?, '
+                '?, ?, ?, ?, ?)', (keyname, 'host.example.com', 'daily',
+                date, 0, catalog.FORMATS[extension], 0, backup_type, ''))
+        return keyname
+
+    def chain(self, keyname):
+        return self.catalog.restore_chain('host.example.com', 'daily',
+                keyname)
+
+    def test_full(self):
+        self.add('20120101', 'full')
+        full = self.add('20120102', 'full')
+        self.assertEqual(self.chain(full), [full])
+
+    def test_legacy_archive_is_full(self):
+        full = self.add('20120101', None)
+        incremental = self.add('20120102', 'incremental')
+        self.assertEqual(self.chain(incremental), [full, incremental])
+
+    def test_incremental(self):
+        self.add('20120101', 'full')
+        full = self.add('20120102', 'full')
+        first = self.add('20120103', 'incremental')
+        second = self.add('20120104', 'incremental')
+        self.add('20120105', 'incremental')
+        self.assertEqual(self.chain(second), [full, first, second])
+
+    def test_differential(self):
+        full = self.add('20120101', 'full')
+        self.add('20120102', 'differential')
+        self.add('20120103', 'incremental')
+        differential = self.add('20120104', 'differential')
+        self.assertEqual(self.chain(differential), [full, differential])
+
+    def test_incremental_after_differential(self):
+        full = self.add('20120101', 'full')
+        self.add('20120102', 'incremental')
+        differential = self.add('20120103', 'differential')
+        incremental = self.add('20120104', 'incremental')
+        self.assertEqual(self.chain(incremental), [full, differential,
+                incremental])
+
+    def test_dedup_backups_are_skipped(self):
+        full = self.add('20120101', 'full')
+        self.add('20120102', None, 'chunks')
+        incremental = self.add('20120103', 'incremental')
+        self.assertEqual(self.chain(incremental), [full, incremental])
+
+    def test_missing_base(self):
+        self.add('20120101', 'incremental')
+        differential = self.add('20120102', 'differential')
+        incremental = self.add('20120103', 'incremental')
+        self.assertEqual(self.chain(differential), None)
+        self.assertEqual(self.chain(incremental), None)
+
+    def test_unknown_key(self):
+        self.add('20120101', 'full')
+        self.assertEqual(self.chain('host.example.com/daily/x.tar.gz'),
+                None)
+
+
+class RefreshTest(S3TestCase):
+
+    def put(self, date, backup_type, extension='tar.gz', schedule='daily'):
+        key = self.bucket.new_key('host.example.com/%s/%s.%s' % (schedule,
+                date, extension))
+        key.set_metadata('enc', 'False')
+        if backup_type is not None:
+            key.set_metadata('backup-type', backup_type)
+        key.set_contents_from_string(date)
+        return key.name
+
+    def chain(self, keyname, full=False):
+        store = catalog.open_catalog(self.bucket, ['daily'], full)
+        try:
+            return store.restore_chain('host.example.com', 'daily', keyname)
+        finally:
+            store.close()
+
+    def test_chain_from_bucket(self):
+        full = self.put('20260101', 'full')
+        self.put('20260101', None, 'hash')
+        self.put('20260101', None, 'index')
+        first = self.put('20260102', 'incremental')
+        differential = self.put('20260103', 'differential')
+        weekly = self.put('20260103', 'full', schedule='weekly')
+        incremental = self.put('20260104', 'incremental')
+        self.assertEqual(self.chain(incremental), [full, differential,
+                incremental])
+
+        # Only keys from the newest date on are listed again
+        later = self.put('20260105', 'incremental')
+        self.assertEqual(self.chain(later), [full, differential,
+                incremental, later])
+        store = catalog.open_catalog(self.bucket, ['daily', 'weekly'])
+        self.assertEqual([row[0] for row in store.archives(
+                'host.example.com')], [full, first, differential, weekly,
+                incremental, later])
+        store.close()
+
+        # A full refresh drops archives that are gone
+        self.bucket.delete_key(full)
+        self.assertEqual(self.chain(later), [full, differential,
+                incremental, later])
+        self.assertEqual(self.chain(later, True), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
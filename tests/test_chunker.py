@@ -0,0 +1,90 @@
+# test_chunker.py - Tests for utils/chunker.py
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top directory with: python -m unittest discover tests
+
+import os
+import random
+import sys
+import unittest
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+from utils import chunker
+
+
+def rolling_boundary(data, min_size, mask):
+    '''find_boundary a byte at a time, as the chunk boundaries are
+    defined.'''
+    h = 0
+    for i in range(max(0, min_size - 32), min(min_size, len(data))):
+        h = ((h << 1) + chunker.GEAR[data[i]]) & 0xFFFFFFFF
+    for i in range(min_size, len(data)):
+        h = ((h << 1) + chunker.GEAR[data[i]]) & 0xFFFFFFFF
+        if not h & mask:
+            return i + 1
+    return len(data)
+
+
+def mask_for(bits):
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+class FindBoundaryTest(unittest.TestCase):
+
+    def test_matches_rolling_hash(self):
+        rand = random.Random(1)
+        for trial in range(200):
+            size = rand.choice([0, 1, 31, 32, 33, 5000, 70000, 200000])
+            if rand.random() < 0.8:
+                data = bytearray(rand.getrandbits(8) for i in range(size))
+            else:
+                data = bytearray(size)
+            mask = mask_for(rand.choice([1, 4, 8, 12, 16, 20]))
+            min_size = rand.choice([0, 1, 31, 32, 40, 1000, size // 2])
+            self.assertEqual(chunker.find_boundary(data, min_size, mask),
+                    rolling_boundary(data, min_size, mask),
+                    (size, mask, min_size))
+
+    def test_boundary_across_blocks(self):
+        data = bytearray(os.urandom(3 * chunker.BLOCK_SIZE + 17))
+        for min_size in (chunker.BLOCK_SIZE - 5, chunker.BLOCK_SIZE + 5):
+            self.assertEqual(chunker.find_boundary(data, min_size,
+                    mask_for(14)), rolling_boundary(data, min_size,
+                    mask_for(14)))
+
+
+class ChunkFileTest(unittest.TestCase):
+
+    def test_chunks_rebuild_file(self):
+        data = os.urandom(300000)
+        chunks = list(chunker.chunk_file(BytesIO(data), 4096, 16384, 65536))
+        self.assertEqual(b''.join(chunks), data)
+        self.assertTrue(all(len(chunk) <= 65536 for chunk in chunks))
+        self.assertTrue(all(len(chunk) >= 4096 for chunk in chunks[:-1]))
+
+    def test_insert_keeps_later_chunks(self):
+        data = os.urandom(300000)
+        before = list(chunker.chunk_file(BytesIO(data), 4096, 16384, 65536))
+        after = list(chunker.chunk_file(BytesIO(b'x' + data), 4096, 16384,
+                65536))
+        self.assertEqual(before[-3:], after[-3:])
+
+
+if __name__ == '__main__':
+    unittest.main()
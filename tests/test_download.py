@@ -0,0 +1,96 @@
+# test_download.py - Tests for utils/download.py
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top directory with: python -m unittest discover tests
+
+import json
+import os
+import unittest
+
+from s3case import S3TestCase
+
+from utils import download
+
+DATA = b'0123456789abcdefghijklm'
+
+
+class ResumeTest(S3TestCase):
+
+    def setUp(self):
+        S3TestCase.setUp(self)
+        self.put(DATA)
+        self.path = os.path.join(self.dir, 'archive')
+        self.fetched = []
+        self.fail_at = None
+        self.fetch_range = download.fetch_range
+        download.fetch_range = self.record_fetch
+
+    def tearDown(self):
+        download.fetch_range = self.fetch_range
+        S3TestCase.tearDown(self)
+
+    def put(self, data):
+        self.bucket.new_key('k').set_contents_from_string(data)
+
+    def record_fetch(self, key, outf, start, end, retries=3, tuner=None):
+        if start == self.fail_at:
+            self.fail_at = None
+            raise IOError('Connection reset')
+        self.fetched.append(start)
+        self.fetch_range(key, outf, start, end, retries, tuner)
+
+    def download(self):
+        download.download_key(self.bucket.get_key('k'), self.path, 5, 1,
+                True)
+
+    def interrupt(self):
+        '''Starts a download that fails at byte 10.'''
+        self.fail_at = 10
+        self.assertRaises(IOError, self.download)
+        self.assertFalse(os.path.exists(self.path))
+        with open(self.path + '.part.json') as inf:
+            self.assertEqual(json.load(inf)['ranges'], [[0, 10]])
+        del self.fetched[:]
+
+    def assertDownloaded(self, data):
+        with open(self.path, 'rb') as inf:
+            self.assertEqual(inf.read(), data)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.assertFalse(os.path.exists(self.path + '.part.json'))
+
+    def test_resume_after_failed_range(self):
+        self.interrupt()
+        self.download()
+        self.assertEqual(self.fetched, [10, 15, 20])
+        self.assertDownloaded(DATA)
+
+    def test_changed_key_starts_over(self):
+        self.interrupt()
+        self.put(DATA.upper())
+        self.download()
+        self.assertEqual(self.fetched, [0, 5, 10, 15, 20])
+        self.assertDownloaded(DATA.upper())
+
+    def test_missing_partial_file_starts_over(self):
+        self.interrupt()
+        os.remove(self.path + '.part')
+        self.download()
+        self.assertEqual(self.fetched, [0, 5, 10, 15, 20])
+        self.assertDownloaded(DATA)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+# test_encrypt.py - Tests for encryption format 2 in utils/encrypt.py
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top directory with: python -m unittest discover tests
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+import config
+from utils import encrypt
+
+# Settings the code under test reads, so no s3backup.conf is needed
+config.company = 'test'
+config.log_file = os.devnull
+config.log_file_level = config.log_console_level = 'CRITICAL'
+config.log_queue = False
+config.log_raise_errs = True
+
+KEY = b'k' * 32
+SEGMENT_SIZE = 64
+# A segment as stored, with its tag
+STORED_SIZE = SEGMENT_SIZE + encrypt.TAG_SIZE
+
+
+class KeptBytesIO(BytesIO):
+    '''Keeps its contents when closed.'''
+
+    def close(self):
+        self.contents = self.getvalue()
+
+
+def encrypt_data(data, piece_size=7):
+    '''Encrypts data in format 2, written piece_size bytes at a time.'''
+    out = KeptBytesIO()
+    writer = encrypt.SegmentEncryptingWriter(KEY, out, SEGMENT_SIZE, 2)
+    for i in range(0, len(data), piece_size):
+        writer.write(data[i:i + piece_size])
+    writer.close()
+    return out.contents
+
+
+def decrypt_data(stored, piece_size=-1):
+    '''Decrypts stored, read piece_size bytes at a time.'''
+    inf = BytesIO(stored)
+    reader = encrypt.open_decrypting_reader(KEY, inf, 1024, 2)
+    if piece_size < 0:
+        return reader.read()
+    return b''.join(iter(lambda: reader.read(piece_size), b''))
+
+
+def split(stored):
+    '''Returns the header and the stored segments of stored.'''
+    body = stored[encrypt.HEADER.size:]
+    return stored[:encrypt.HEADER.size], [body[i:i + STORED_SIZE]
+            for i in range(0, len(body), STORED_SIZE)]
+
+
+class SegmentTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for size in (0, 1, SEGMENT_SIZE - 1, SEGMENT_SIZE, SEGMENT_SIZE + 1,
+                3 * SEGMENT_SIZE, 3 * SEGMENT_SIZE + 5):
+            data = os.urandom(size)
+            stored = encrypt_data(data)
+            self.assertTrue(stored.startswith(encrypt.MAGIC))
+            self.assertEqual(decrypt_data(stored), data)
+            self.assertEqual(decrypt_data(stored, 10), data)
+
+    def test_segments(self):
+        header, segments = split(encrypt_data(b'x' * 3 * SEGMENT_SIZE))
+        # A full last segment is held back, so it can be marked as last
+        self.assertEqual([len(segment) for segment in segments],
+                [STORED_SIZE] * 3)
+        header, segments = split(encrypt_data(b''))
+        self.assertEqual([len(segment) for segment in segments],
+                [encrypt.TAG_SIZE])
+
+    def test_flipped_tag_byte(self):
+        stored = bytearray(encrypt_data(b'x' * 3 * SEGMENT_SIZE))
+        stored[encrypt.HEADER.size + 2 * STORED_SIZE - 1] ^= 1
+        self.assertRaises(IOError, decrypt_data, bytes(stored))
+
+    def test_flipped_ciphertext_byte(self):
+        stored = bytearray(encrypt_data(b'x' * 3 * SEGMENT_SIZE))
+        stored[encrypt.HEADER.size + STORED_SIZE] ^= 1
+        self.assertRaises(IOError, decrypt_data, bytes(stored))
+
+    def test_changed_header(self):
+        stored = bytearray(encrypt_data(b'x' * SEGMENT_SIZE))
+        # The last byte of the nonce
+        stored[encrypt.HEADER.size - 1] ^= 1
+        self.assertRaises(IOError, decrypt_data, bytes(stored))
+
+    def test_swapped_segments(self):
+        header, segments = split(encrypt_data(os.urandom(
+                3 * SEGMENT_SIZE + 5)))
+        swapped = [segments[1], segments[0]] + segments[2:]
+        self.assertRaises(IOError, decrypt_data, header + b''.join(swapped))
+        reordered = [segments[2]] + segments[:2] + segments[3:]
+        self.assertRaises(IOError, decrypt_data,
+                header + b''.join(reordered))
+
+    def test_segment_from_another_file(self):
+        first_header, first = split(encrypt_data(b'x' * 2 * SEGMENT_SIZE))
+        second_header, second = split(encrypt_data(b'x' * 2 * SEGMENT_SIZE))
+        self.assertRaises(IOError, decrypt_data, first_header +
+                first[0] + second[1])
+
+    def test_dropped_last_segment(self):
+        # Cut at a segment boundary, so only the missing last flag shows
+        header, segments = split(encrypt_data(b'x' *
+                (2 * SEGMENT_SIZE + 5)))
+        self.assertRaises(IOError, decrypt_data, header +
+                b''.join(segments[:-1]))
+        header, segments = split(encrypt_data(b'x' * 2 * SEGMENT_SIZE))
+        self.assertRaises(IOError, decrypt_data, header +
+                b''.join(segments[:-1]))
+
+    def test_truncated(self):
+        stored = encrypt_data(b'x' * (2 * SEGMENT_SIZE + 5))
+        for size in (encrypt.HEADER.size, encrypt.HEADER.size + 10,
+                len(stored) - 1):
+            self.assertRaises(IOError, decrypt_data, stored[:size])
+
+    def test_decrypt_segment(self):
+        keys = encrypt.derive_keys(KEY)
+        header = encrypt.HEADER.pack(encrypt.MAGIC, encrypt.FORMAT_VERSION,
+                SEGMENT_SIZE, b'n' * 8)
+        segment = encrypt.encrypt_segment(keys, header, 3, True, b'data')
+        self.assertEqual(encrypt.decrypt_segment(keys, header, 3, True,
+                segment), b'data')
+        self.assertEqual(encrypt.decrypt_segment(keys, header, 3, None,
+                segment), b'data')
+        self.assertRaises(IOError, encrypt.decrypt_segment, keys, header, 3,
+                False, segment)
+        self.assertRaises(IOError, encrypt.decrypt_segment, keys, header, 2,
+                True, segment)
+        self.assertRaises(IOError, encrypt.decrypt_segment, keys, header, 3,
+                True, segment[:encrypt.TAG_SIZE - 1])
+
+
+class FileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'archive')
+        self.data = os.urandom(5 * SEGMENT_SIZE + 3)
+        with open(self.path, 'wb') as outf:
+            outf.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        enc_file = encrypt.encrypt_file(KEY, self.path, 1024, SEGMENT_SIZE,
+                2)
+        self.assertTrue(encrypt.decrypt_file(KEY, enc_file, self.path +
+                '.out', 100, 2))
+        with open(self.path + '.out', 'rb') as inf:
+            self.assertEqual(inf.read(), self.data)
+
+    def test_changed_file_fails(self):
+        enc_file = encrypt.encrypt_file(KEY, self.path, 1024, SEGMENT_SIZE,
+                2)
+        with open(enc_file, 'r+b') as f:
+            f.seek(encrypt.HEADER.size + STORED_SIZE + 3)
+            byte = f.read(1)
+            f.seek(-1, 1)
+            f.write(chr(ord(byte) ^ 1))
+        self.assertFalse(encrypt.decrypt_file(KEY, enc_file, self.path +
+                '.out', 100, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
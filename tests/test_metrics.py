@@ -0,0 +1,106 @@
+# test_metrics.py - Tests for utils/metrics.py
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top directory with: python -m unittest discover tests
+
+import json
+import os
+import re
+import unittest
+
+from s3case import S3TestCase, fake_date
+
+import config
+import s3backup
+from utils import metrics
+
+
+class RunTest(S3TestCase):
+
+    def setUp(self):
+        S3TestCase.setUp(self)
+        metrics._stages.clear()
+
+    def report(self, name):
+        with open(os.path.join(config.metrics_path, name + '.json')) as inf:
+            return json.load(inf)
+
+    def test_backup_run(self):
+        self.write('a', b'a' * 1000)
+        self.write('b', b'b' * 2000)
+        with fake_date('20260101'):
+            with metrics.run('s3backup-daily', {'schedule': 'daily'}):
+                s3backup.do_backup('daily', False, 'full')
+        report = self.report('s3backup-daily')
+        self.assertEqual((report['name'], report['labels'],
+                report['success']), ('s3backup-daily', {'schedule':
+                'daily'}, True))
+        self.assertTrue(report['seconds'] > 0)
+        self.assertEqual((report['stages']['read']['bytes'],
+                report['stages']['read']['items']), (3000, 2))
+        # Everything in the bucket was sent by this run
+        self.assertEqual(report['stages']['upload']['bytes'],
+                sum(key.size for key in self.bucket.list()))
+        self.assertEqual(report['stages']['upload']['io_seconds'],
+                report['stages']['upload']['seconds'])
+
+        with open(os.path.join(config.metrics_path,
+                's3backup-daily.prom')) as inf:
+            lines = inf.read().splitlines()
+        samples = [line for line in lines if not line.startswith('#')]
+        for line in samples:
+            self.assertTrue(re.match(r's3backup_\w+\{(\w+="[^"]*",?)+\} '
+                    r'\S+$', line), line)
+        self.assertIn('s3backup_stage_bytes{run="s3backup-daily",'
+                'schedule="daily",stage="read"} 3000.0', samples)
+        self.assertIn('s3backup_run_success{run="s3backup-daily",'
+                'schedule="daily"} 1.0', samples)
+        # Each metric is described once
+        self.assertEqual(lines.count('# TYPE s3backup_stage_bytes gauge'), 1)
+
+    def test_streamed_backup_run(self):
+        config.stream_backup = True
+        self.write('a', b'a' * 1000)
+        with fake_date('20260101'):
+            with metrics.run('s3backup-daily'):
+                s3backup.do_backup('daily', False, 'full')
+        hash_key = self.bucket.get_key('host.example.com/daily/'
+                '20260101.hash')
+        self.assertTrue(hash_key.get_metadata('archive-hash'))
+        self.assertEqual(self.report('s3backup-daily')['stages']['upload'][
+                'bytes'], sum(key.size for key in self.bucket.list()))
+
+    def test_failed_run(self):
+        with self.assertRaises(SystemExit):
+            with metrics.run('s3restore', {'path': 'a "b"\\c\n'}):
+                metrics.add('download', 10, 1)
+                raise SystemExit(1)
+        report = self.report('s3restore')
+        self.assertEqual(report['success'], False)
+        self.assertEqual(report['stages']['download']['bytes'], 10)
+        with open(os.path.join(config.metrics_path, 's3restore.prom')) as inf:
+            self.assertIn('s3backup_run_success{path="a \\"b\\"\\\\c\\n",'
+                    'run="s3restore"} 0.0', inf.read().splitlines())
+
+    def test_no_metrics_path(self):
+        config.metrics_path = ''
+        with metrics.run('s3backup-daily'):
+            metrics.add('scan', 0, 1)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'metrics')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# test_put.py - Tests of s3put
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top directory with: python -m unittest discover tests
+
+import argparse
+import os
+import shutil
+import sys
+import unittest
+
+from s3case import S3TestCase, fake_date
+
+import config
+import s3put
+import s3restore
+import utils.upload
+
+
+class PutTest(S3TestCase):
+
+    def setUp(self):
+        S3TestCase.setUp(self)
+        self.file_list = os.path.join(self.dir, 'files.txt')
+        with open(self.file_list, 'w') as outf:
+            outf.write(self.tree + '\n')
+
+    def put(self, *args):
+        '''Runs s3put with the given arguments.'''
+        argv = sys.argv
+        sys.argv = ['s3put.py'] + list(args)
+        try:
+            s3put.main()
+        finally:
+            sys.argv = argv
+
+    def keyname(self, date, name):
+        return 'host.example.com/%s/%s/%s' % (date, self.tree.lstrip('/'),
+                name)
+
+    def contents(self, keyname):
+        return self.bucket.get_key(keyname).get_contents_as_string()
+
+    def test_sync_copies_unchanged_files(self):
+        self.write('a', b'a1')
+        self.write('b', b'b1')
+        with fake_date('20260101'):
+            self.put('--list', '--sync', self.file_list)
+        self.write('b', b'b2')
+
+        copied = []
+        copy_key = utils.upload.copy_key
+
+        def record_copy(bucket, source, keyname):
+            copied.append((source.name, keyname))
+            copy_key(bucket, source, keyname)
+
+        utils.upload.copy_key = record_copy
+        try:
+            with fake_date('20260102'):
+                self.put('--list', '--sync', self.file_list)
+        finally:
+            utils.upload.copy_key = copy_key
+        self.assertEqual(copied, [(self.keyname('20260101', 'a'),
+                self.keyname('20260102', 'a'))])
+        self.assertEqual(self.contents(self.keyname('20260102', 'a')), b'a1')
+        self.assertEqual(self.contents(self.keyname('20260102', 'b')), b'b2')
+
+    def test_bundle_round_trip(self):
+        config.bundle_threshold = 100
+        config.bundle_size = 50
+        for i in range(6):
+            self.write('small/%d' % i, str(i) * 20)
+        self.write('small/empty', b'')
+        self.write('big', b'x' * 200)
+        os.chmod(os.path.join(self.tree, 'small/0'), 0o600)
+        # The index keeps the mode and mtime of bundled files
+        stats = dict((name, os.stat(os.path.join(self.tree, name)))
+                for name in self.read_tree() if name.startswith('small/'))
+        expected = self.read_tree()
+        with fake_date('20260101'):
+            self.put('--list', '--bundle', self.file_list)
+
+        keys = [key.name for key in self.bucket.list('host.example.com/')]
+        self.assertEqual([name for name in keys if '/packs/' not in name],
+                [self.keyname('20260101', 'big')])
+        self.assertEqual(len([name for name in keys
+                if name.endswith('.pack')]), 3)
+
+        # One file alone, which is fetched as a range of its pack
+        shutil.rmtree(self.tree)
+        s3restore.run_get_files(argparse.Namespace(date='01 01 2026',
+                paths=[self.tree + '/small/4'], root='/'))
+        self.assertEqual(self.read_tree(), {'small/4': b'4' * 20})
+
+        s3restore.run_get_files(argparse.Namespace(date='01 01 2026',
+                paths=[self.tree], root='/'))
+        self.assertEqual(self.read_tree(), expected)
+        for name, st in stats.items():
+            restored = os.stat(os.path.join(self.tree, name))
+            self.assertEqual((restored.st_mode, int(restored.st_mtime)),
+                    (st.st_mode, int(st.st_mtime)))
+
+    def test_copy_in_parts(self):
+        # As copy_key copies keys too large for a single copy
+        source = self.bucket.new_key('source')
+        source.set_metadata('enc', 'False')
+        source.set_contents_from_string(b'0123456789')
+        mp = self.bucket.initiate_multipart_upload('copy')
+        mp.copy_part_from_key('test', 'source', 1, 0, 5)
+        mp.copy_part_from_key('test', 'source', 2, 6, 9)
+        mp.complete_upload()
+        self.assertEqual(self.contents('copy'), b'0123456789')
+
+        self.bucket.copy_key('whole', 'test', 'source')
+        whole = self.bucket.get_key('whole')
+        self.assertEqual(whole.get_contents_as_string(), b'0123456789')
+        self.assertEqual(whole.get_metadata('enc'), 'False')
+
+
+if __name__ == '__main__':
+    unittest.main()
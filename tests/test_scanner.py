@@ -0,0 +1,99 @@
+# test_scanner.py - Tests for utils/scanner.py
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top directory with: python -m unittest discover tests
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+import config
+from utils import scanner
+
+# Settings the code under test reads, so no s3backup.conf is needed
+config.company = 'test'
+config.log_file = os.devnull
+config.log_file_level = config.log_console_level = 'CRITICAL'
+config.log_queue = False
+config.log_raise_errs = True
+
+
+class ScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for i in range(20):
+            for j in range(3):
+                path = os.path.join(self.dir, 'd%02d' % i, 's%d' % j)
+                os.makedirs(path)
+                with open(os.path.join(path, 'f'), 'w') as outf:
+                    outf.write('x')
+        self.list_dir = scanner.list_dir
+
+    def tearDown(self):
+        scanner.list_dir = self.list_dir
+        shutil.rmtree(self.dir)
+
+    def slow_listings(self):
+        '''Makes directories take random times to list, so that their
+        listings come back out of order.'''
+        list_dir = self.list_dir
+
+        def slow_list_dir(path, follow_links=False):
+            time.sleep(random.random() * 0.01)
+            return list_dir(path, follow_links)
+
+        scanner.list_dir = slow_list_dir
+
+    def scan(self, workers):
+        return [path for path, st in scanner.scan([self.dir], False,
+                workers)]
+
+    def test_order_is_stable(self):
+        expected = self.scan(1)
+        self.assertEqual(len(expected), 1 + 20 * 7)
+        self.slow_listings()
+        for i in range(3):
+            self.assertEqual(self.scan(8), expected)
+
+    def test_directories_before_contents(self):
+        seen = set()
+        for path in self.scan(8):
+            if path != self.dir:
+                self.assertIn(os.path.dirname(path), seen)
+            seen.add(path)
+
+    def test_closed_early(self):
+        before = threading.active_count()
+        files = scanner.scan([self.dir], False, 2)
+        # Enough to fill the results while the consumer stops
+        for i in range(3):
+            next(files)
+        time.sleep(0.1)
+        files.close()
+        self.assertEqual(threading.active_count(), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+# test_throttle.py - Tests for utils/throttle.py
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top directory with: python -m unittest discover tests
+
+import threading
+import time
+import unittest
+
+from s3case import S3TestCase
+
+import config
+from utils import throttle
+from utils import upload
+
+
+class FakeClock(object):
+    '''Stands in for the time module in throttle; sleeping moves the clock
+    on at once.'''
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class ClockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        throttle.time = self.clock
+
+    def tearDown(self):
+        throttle.time = time
+
+
+class TokenBucketTest(ClockTestCase):
+
+    def test_burst_then_rate(self):
+        bucket = throttle.TokenBucket(100)
+        bucket.consume(100)
+        self.assertEqual(self.clock.slept, [])
+        bucket.consume(50)
+        self.assertEqual(self.clock.slept, [0.5])
+
+    def test_debt_is_waited_out(self):
+        bucket = throttle.TokenBucket(100)
+        bucket.consume(300)
+        self.assertEqual(self.clock.slept, [2.0])
+        # The sleep paid the debt off; nothing is left over
+        bucket.consume(100)
+        self.assertEqual(self.clock.slept, [2.0, 1.0])
+
+    def test_idle_tokens_are_capped_at_burst(self):
+        bucket = throttle.TokenBucket(100, 200)
+        bucket.consume(200)
+        self.clock.now += 60
+        bucket.consume(250)
+        self.assertEqual(self.clock.slept, [0.5])
+
+
+class TunerTest(ClockTestCase):
+
+    def window(self, tuner, size, error=False):
+        '''Records size bytes as the traffic of the next interval.'''
+        self.clock.now += tuner.interval
+        tuner.record(size, error)
+
+    def test_limit_follows_throughput(self):
+        tuner = throttle.Tuner('test', 8)
+        # Fewer requests are tried first
+        self.window(tuner, 1000)
+        self.assertEqual(tuner.limit, 7)
+        # That helped, so keep going
+        self.window(tuner, 2000)
+        self.assertEqual(tuner.limit, 6)
+        # That hurt, so turn back
+        self.window(tuner, 1000)
+        self.assertEqual(tuner.limit, 7)
+        self.window(tuner, 2000)
+        self.assertEqual(tuner.limit, 8)
+        # Never past max_workers
+        self.window(tuner, 4000)
+        self.assertEqual(tuner.limit, 8)
+
+    def test_errors_halve_limit(self):
+        tuner = throttle.Tuner('test', 8)
+        self.window(tuner, 1000, True)
+        self.assertEqual(tuner.limit, 4)
+        self.window(tuner, 0, True)
+        self.window(tuner, 0, True)
+        self.window(tuner, 0, True)
+        self.assertEqual(tuner.limit, 1)
+
+    def test_saturated_bandwidth_limit_holds_requests(self):
+        tuner = throttle.Tuner('test', 8,
+                limiter=throttle.TokenBucket(100))
+        # Rising throughput would otherwise keep changing the limit
+        self.window(tuner, 1000)
+        self.window(tuner, 4000)
+        self.window(tuner, 8000)
+        self.assertEqual((tuner.limit, tuner.step), (8, -1))
+
+    def test_without_autotune(self):
+        tuner = throttle.Tuner('test', 8, False)
+        self.window(tuner, 1000)
+        self.window(tuner, 0, True)
+        self.assertEqual(tuner.limit, 8)
+        self.assertEqual(tuner.part_size(1024), 1024)
+
+    def test_part_size(self):
+        tuner = throttle.Tuner('test', 4)
+        self.assertEqual(tuner.part_size(1024), 1024)
+        # A single request moves 4 KB a second
+        self.window(tuner, 4 * 4 * 1024 * tuner.interval)
+        self.assertEqual(tuner.part_size(1024), 8 * 1024)
+        self.assertEqual(tuner.part_size(1024 ** 2), 1024 ** 2)
+        # More than MAX_PARTS parts are never needed
+        self.assertEqual(tuner.part_size(1024 ** 2,
+                throttle.MAX_PARTS * 1024 ** 2 * 3), 4 * 1024 ** 2)
+        self.assertEqual(throttle.part_sizes(1024 ** 2, 3 * 1024 ** 2),
+                [1024 ** 2, 2 * 1024 ** 2, 4 * 1024 ** 2])
+
+    def test_slot_keeps_to_limit(self):
+        tuner = throttle.Tuner('test', 2, False)
+        release = threading.Event()
+        active = []
+
+        def work():
+            with tuner.slot():
+                active.append(1)
+                release.wait()
+
+        threads = [threading.Thread(target=work) for i in range(3)]
+        for t in threads:
+            t.start()
+        while len(active) < 2:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual((len(active), tuner.active), (2, 2))
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual((len(active), tuner.active), (3, 0))
+
+
+class BandwidthLimitTest(S3TestCase):
+
+    def setUp(self):
+        S3TestCase.setUp(self)
+        config.bandwidth_limit = 100 * 1024
+        config.upload_part_size = 1024 ** 2
+        throttle._limiter = None
+
+    def tearDown(self):
+        config.bandwidth_limit = 0
+        throttle._limiter = None
+        S3TestCase.tearDown(self)
+
+    def test_upload_keeps_to_limit(self):
+        data = b'x' * 300 * 1024
+        start = time.time()
+        upload.send_data(self.bucket, 'k', data)
+        # A second's worth goes at once, the rest at the limit
+        self.assertTrue(time.time() - start >= 1.9)
+        self.assertEqual(self.bucket.get_key('k').get_contents_as_string(),
+                data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,260 @@
+# test_upload.py - Tests for utils/upload.py
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top directory with: python -m unittest discover tests
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+import config
+from s3case import S3TestCase
+from utils import throttle
+from utils import upload
+
+# Settings the code under test reads, so no s3backup.conf is needed
+config.company = 'test'
+config.log_file = os.devnull
+config.log_file_level = config.log_console_level = 'CRITICAL'
+config.log_queue = False
+config.log_raise_errs = True
+config.bandwidth_limit = 0
+config.autotune_transfers = False
+
+
+class FakeMultiPartUpload(object):
+    id = 'fake'
+
+
+class FakeBucket(object):
+
+    def initiate_multipart_upload(self, keyname, metadata=None):
+        return FakeMultiPartUpload()
+
+
+def queued_sizes(uploader):
+    '''Returns the sizes of the parts queued by an uploader with no
+    workers.'''
+    sizes = []
+    while not uploader.queue.empty():
+        sizes.append(len(uploader.queue.get_nowait()[1]))
+    return sizes
+
+
+class StreamedPartSizeTest(unittest.TestCase):
+
+    def test_known_size_keeps_part_size(self):
+        uploader = upload.MultipartUpload(FakeBucket(), 'k', 1, 0,
+                size=3 * upload.PART_GROWTH)
+        uploader.write(b'x' * 3 * upload.PART_GROWTH)
+        self.assertEqual(queued_sizes(uploader),
+                [1] * 3 * upload.PART_GROWTH)
+
+    def test_parts_grow(self):
+        uploader = upload.MultipartUpload(FakeBucket(), 'k', 1, 0)
+        uploader.write(b'x' * 7 * upload.PART_GROWTH)
+        self.assertEqual(queued_sizes(uploader), [1] * upload.PART_GROWTH +
+                [2] * upload.PART_GROWTH + [4] * upload.PART_GROWTH)
+
+    def test_parts_are_cut_from_small_writes(self):
+        uploader = upload.MultipartUpload(FakeBucket(), 'k', 1, 0)
+        for i in range(upload.PART_GROWTH + 4):
+            uploader.write(b'x')
+        self.assertEqual(queued_sizes(uploader),
+                [1] * upload.PART_GROWTH + [2, 2])
+
+    def test_part_size_is_capped(self):
+        uploader = upload.MultipartUpload(FakeBucket(), 'k',
+                upload.MAX_PART_SIZE // 2, 0)
+        uploader.part_num = 5 * upload.PART_GROWTH
+        self.assertEqual(uploader.next_part_size(), upload.MAX_PART_SIZE)
+
+    def test_parts_grow_to_max_part_size(self):
+        uploader = upload.MultipartUpload(FakeBucket(), 'k', 1, 0,
+                max_part_size=2)
+        uploader.write(b'x' * 7 * upload.PART_GROWTH)
+        self.assertEqual(queued_sizes(uploader), [1] * upload.PART_GROWTH +
+                [2] * 3 * upload.PART_GROWTH)
+
+    def test_max_upload_size(self):
+        self.assertEqual(upload.max_upload_size(1, 2),
+                (2 * throttle.MAX_PARTS - upload.PART_GROWTH))
+        self.assertEqual(upload.max_upload_size(1, upload.MAX_PART_SIZE),
+                sum(1 << (i // upload.PART_GROWTH)
+                for i in range(throttle.MAX_PARTS)))
+
+    def test_past_max_parts_with_max_part_size(self):
+        uploader = upload.MultipartUpload(FakeBucket(), 'k', 1, 0,
+                max_part_size=2)
+        uploader.write(b'x' * upload.max_upload_size(1, 2))
+        self.assertEqual(uploader.part_num, throttle.MAX_PARTS)
+        uploader.write(b'x')
+        self.assertRaises(IOError, uploader.close)
+
+    def test_known_size_within_max_part_size(self):
+        # The tuner would pick parts of 4 bytes
+        size = 3 * throttle.MAX_PARTS
+        uploader = upload.MultipartUpload(FakeBucket(), 'k', 1, 0,
+                size=size, max_part_size=3)
+        self.assertEqual(uploader.part_size, 3)
+        self.assertRaises(IOError, upload.MultipartUpload, FakeBucket(), 'k',
+                1, 0, size=size + 1, max_part_size=3)
+
+    def test_past_max_parts(self):
+        # With 1-byte parts to start with, this is exactly MAX_PARTS parts
+        size = sum(1 << (i // upload.PART_GROWTH)
+                for i in range(throttle.MAX_PARTS))
+        uploader = upload.MultipartUpload(FakeBucket(), 'k', 1, 0)
+        uploader.write(b'x' * size)
+        self.assertEqual(uploader.part_num, throttle.MAX_PARTS)
+        self.assertEqual(uploader.buf.tell(), 0)
+        uploader.write(b'x')
+        self.assertRaises(IOError, uploader.close)
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        config.upload_checkpoints = os.path.join(self.dir, 'uploads')
+        self.path = os.path.join(self.dir, 'archive')
+        with open(self.path, 'wb') as f:
+            f.write(b'x' * 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_keys_do_not_share_files(self):
+        first = upload.Checkpoint('a/b_c', self.path)
+        first.start('first', 5)
+        second = upload.Checkpoint('a_b/c', self.path)
+        self.assertEqual(second.state, None)
+        second.start('second', 5)
+        self.assertEqual(upload.Checkpoint('a/b_c', self.path).state[
+                'upload_id'], 'first')
+
+    def test_list_renames_old_files(self):
+        checkpoint = upload.Checkpoint('m/daily/x.tar', self.path)
+        checkpoint.start('id', 5)
+        old = os.path.join(config.upload_checkpoints, 'm_daily_x.tar.json')
+        os.rename(checkpoint.file, old)
+        checkpoints = upload.list_checkpoints('m/daily/')
+        self.assertEqual([c.keyname for c in checkpoints], ['m/daily/x.tar'])
+        self.assertEqual(checkpoints[0].state['upload_id'], 'id')
+        self.assertEqual(os.listdir(config.upload_checkpoints),
+                [upload.checkpoint_name('m/daily/x.tar')])
+
+    def test_list_drops_old_file_of_listed_key(self):
+        checkpoint = upload.Checkpoint('m/daily/x.tar', self.path)
+        checkpoint.start('id', 5)
+        old = os.path.join(config.upload_checkpoints, 'm_daily_x.tar.json')
+        with open(old, 'w') as f:
+            json.dump(checkpoint.state, f)
+        self.assertEqual(len(upload.list_checkpoints('m/')), 1)
+        self.assertFalse(os.path.exists(old))
+
+
+class UploadFilesTest(S3TestCase):
+
+    def test_files_are_sent_at_once(self):
+        files = []
+        for i in range(12):
+            self.write(str(i), str(i) * (i + 1))
+            files.append((os.path.join(self.tree, str(i)), 'files/%d' % i))
+        files.append((os.path.join(self.tree, 'missing'), 'files/missing'))
+        lock = threading.Lock()
+        active = [0]
+        most = [0]
+        send_file = upload.send_file
+
+        def slow_send_file(*args):
+            with lock:
+                active[0] += 1
+                most[0] = max(most[0], active[0])
+            try:
+                time.sleep(0.05)
+                return send_file(*args)
+            finally:
+                with lock:
+                    active[0] -= 1
+
+        upload.send_file = slow_send_file
+        try:
+            report = upload.upload_files(self.bucket, files, 4, 1,
+                    should_send=lambda path, keyname: keyname != 'files/0')
+        finally:
+            upload.send_file = send_file
+        self.assertEqual(most[0], 4)
+        self.assertEqual((report.sent, report.skipped, report.bytes),
+                (11, 1, sum(len(str(i)) * (i + 1) for i in range(1, 12))))
+        self.assertEqual([path for path, error in report.failed],
+                [os.path.join(self.tree, 'missing')])
+        for i in range(1, 12):
+            self.assertEqual(self.bucket.get_key('files/%d' % i)
+                    .get_contents_as_string(), str(i) * (i + 1))
+        self.assertEqual(self.bucket.get_key('files/0'), None)
+
+
+class ResumeTest(S3TestCase):
+
+    def test_resume_after_failed_part(self):
+        path = os.path.join(self.dir, 'archive')
+        with open(path, 'wb') as f:
+            f.write(b'0123456789ab')
+        sent = []
+        failed = []
+        send_part = upload.MultipartUpload._send_part
+
+        def fail_part_2(uploader, mp, part_num, data):
+            if part_num == 2 and not failed:
+                failed.append(part_num)
+                raise IOError('Connection reset')
+            sent.append(part_num)
+            return send_part(uploader, mp, part_num, data)
+
+        upload.MultipartUpload._send_part = fail_part_2
+        try:
+            uploader = upload.MultipartUpload(self.bucket, 'k', 5, 1,
+                    checkpoint=upload.Checkpoint('k', path))
+            self.assertRaises(IOError, uploader.upload_file, path)
+            self.assertEqual(sent, [1])
+            self.assertEqual(self.bucket.get_key('k'), None)
+
+            del sent[:]
+            checkpoint = upload.Checkpoint('k', path)
+            self.assertEqual(checkpoint.state['upload_id'], uploader.mp.id)
+            upload.MultipartUpload(self.bucket, 'k', 5, 1,
+                    checkpoint=checkpoint).upload_file(path)
+        finally:
+            upload.MultipartUpload._send_part = send_part
+        # Only the parts S3 didn't have were sent again
+        self.assertEqual(sent, [2, 3])
+        self.assertEqual(self.bucket.get_key('k').get_contents_as_string(),
+                b'0123456789ab')
+        self.assertFalse(os.path.exists(checkpoint.file))
+        self.assertEqual(list(self.bucket.get_all_multipart_uploads()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,359 @@
+# archiveindex.py - Member offset index for restoring single files
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The index is stored next to the archive as machine/schedule/date.index.
+# For every regular file in a tar archive it holds the offset and size of
+# the file's data in the tar stream, and the range of the stored
+# (compressed and encrypted) archive that holds it. It can only be made
+# for uncompressed tar archives and those made by the block compressor,
+# whose blocks can be decompressed on their own.
+#
+# Archives encrypted with format 1 are AES-CBC after an 8-byte size header,
+# so any part can be decrypted by also fetching the 16 bytes before it to
+# use as the IV. Format 2 segments are fetched whole, with the file's
+# header. The blocks of s3b archives are encrypted one by one; those of
+# version 2 archives are format 2 segments under the archive's header.
+
+version = '0.1'
+
+import json
+import struct
+from bisect import bisect_right
+
+import config
+import log
+
+log = log.get_logger('archiveindex')
+
+# Ranged reads are made in pieces of this size
+PIECE_SIZE = 1024 * 1024
+
+# Members whose ranges are closer than this are fetched in one request
+MERGE_GAP = 1024 * 1024
+
+HEADER_SIZE = struct.calcsize('<Q')
+
+
+class MemberIndex(object):
+    '''Collects the offsets of the files added to a tar archive.'''
+
+    def __init__(self):
+        self.members = {}
+
+    def add(self, tar, tarinfo):
+        '''Records a regular file just added to tar. tar.offset is then the
+        end of its data, rounded up to the tar block size.'''
+        import tarfile
+
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        if remainder:
+            blocks += 1
+        offset = tar.offset - blocks * tarfile.BLOCKSIZE
+        self.members[tarinfo.name] = [offset, tarinfo.size, tarinfo.mode,
+                tarinfo.mtime]
+
+    def save(self, path, codec=None, blocks=None, archive_format='tar'):
+        '''Writes the index, packed like a deduplicated backup's manifest.
+        blocks is the ParallelCompressor's list of blocks; without it the
+        archive is taken to be an uncompressed tar.'''
+        from chunkstore import pack
+
+        index = {'codec': codec, 'blocks': blocks, 'format': archive_format,
+                'encrypted': config.enc_backup == True, 'members': {}}
+        if config.encryption_version != 1:
+            index['encryption'] = 2
+            index['segment_size'] = config.encryption_segment_size
+        for name, member in self.members.items():
+            index['members'][name] = member + list(stored_range(index,
+                    member[0], member[1]))
+        with open(path, 'wb') as outf:
+            outf.write(pack(json.dumps(index)))
+
+
+def load_index(data, encrypted):
+    '''Reads an index saved by MemberIndex.save. encrypted is whether its
+    key is marked as encrypted.'''
+    from chunkstore import unpack
+
+    return json.loads(unpack(data, encrypted))
+
+
+def find_blocks(index, offset, size):
+    '''Returns the first and last block holding the given range of the tar
+    stream.'''
+    starts = [block[0] for block in index['blocks']]
+    first = bisect_right(starts, offset) - 1
+    last = bisect_right(starts, offset + max(size, 1) - 1) - 1
+    return max(first, 0), max(last, 0)
+
+
+def compressed_range(index, offset, size):
+    '''Returns the range of the compressed archive holding the given range
+    of the tar stream.'''
+    if index['blocks'] is None:
+        return offset, offset + size
+    first, last = find_blocks(index, offset, size)
+    blocks = index['blocks']
+    return blocks[first][2], blocks[last][2] + blocks[last][3]
+
+
+def stored_range(index, offset, size):
+    '''Returns the range of the stored archive to fetch for the given range
+    of the tar stream.'''
+    return encrypted_range(index, *compressed_range(index, offset, size))
+
+
+def is_stream_encrypted(index):
+    '''Returns whether the archive was encrypted as a whole.'''
+    return index['encrypted'] and index.get('format', 'tar') == 'tar'
+
+
+def encrypted_range(index, start, end):
+    '''Returns the range of the stored archive to fetch for the given range
+    of the compressed archive.'''
+    if not is_stream_encrypted(index):
+        return start, end
+    if index.get('encryption', 1) == 2:
+        from encrypt import HEADER, TAG_SIZE
+
+        # Whole segments; the last may be shorter than this
+        size = index['segment_size']
+        first = start // size
+        last = (max(end, start + 1) - 1) // size
+        return (HEADER.size + first * (size + TAG_SIZE),
+                HEADER.size + (last + 1) * (size + TAG_SIZE))
+    # Round out to whole AES blocks and include the block before as the IV
+    start -= start % 16
+    if start:
+        start -= 16
+    end += -end % 16
+    return HEADER_SIZE + start, HEADER_SIZE + end
+
+
+def read_header(key, index):
+    '''Returns the header of an archive encrypted with format 2, or of the
+    blocks of an encrypted s3b archive, or None for other archives.'''
+    from download import fetch_data
+    from encrypt import HEADER
+
+    if index['encrypted'] and index.get('format') == 's3b':
+        import blockarchive
+
+        size = blockarchive.HEADER.size + HEADER.size
+        return blockarchive.cipher_header(fetch_data(key,
+                {'Range': 'bytes=0-%d' % (size - 1)}))
+    if not is_stream_encrypted(index) or index.get('encryption', 1) != 2:
+        return None
+    header = fetch_data(key, {'Range': 'bytes=0-%d' % (HEADER.size - 1)})
+    if len(header) != HEADER.size:
+        raise IOError('The archive ended early.')
+    return header
+
+
+class RangeReader(object):
+    '''Reads part of the compressed archive from key: the decrypted bytes
+    from compressed offset start to end, fetched with a single ranged GET.
+    header is the archive's read_header.'''
+
+    def __init__(self, key, index, start, end, header=None):
+        from Crypto.Cipher import AES
+
+        self.key = key
+        self.end = end
+        self.decryptor = None
+        self.header = header
+        self.pending = b''
+        stored_start, stored_end = encrypted_range(index, start, end)
+        self.key.open_read(headers={'Range': 'bytes=%d-%d' % (stored_start,
+                stored_end - 1)})
+        if header is not None:
+            from encrypt import derive_keys
+
+            self.keys = derive_keys(config.enc_key)
+            self.segment_size = index['segment_size']
+            self.segment = start // self.segment_size
+            self.pos = self.segment * self.segment_size
+        elif is_stream_encrypted(index):
+            # The stream starts on an AES block; skip to start after
+            # decrypting
+            if stored_start == HEADER_SIZE:
+                from encrypt import CBC_IV
+                iv = CBC_IV
+            else:
+                iv = self._read_exactly(16)
+            self.decryptor = AES.new(config.enc_key, AES.MODE_CBC, iv)
+            self.pos = start - start % 16
+        else:
+            self.pos = start
+        self.buf = b''
+        self._fill(start - self.pos)
+        self.buf = self.buf[start - self.pos:]
+        self.pos = start
+
+    def _read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            piece = self.key.read(size - len(data))
+            if not piece:
+                raise IOError('The archive ended early.')
+            data += piece
+        return data
+
+    def _fill(self, size):
+        from encrypt import TAG_SIZE, decrypt_segment
+        from metrics import add, timed
+        from throttle import consume
+
+        while len(self.buf) < size:
+            with timed('download', io=True):
+                piece = self.key.read(PIECE_SIZE)
+            add('download', len(piece))
+            consume(len(piece))
+            if self.header is not None:
+                # Decrypt each segment once it is all here
+                self.pending += piece
+                stored_size = self.segment_size + TAG_SIZE
+                while len(self.pending) >= stored_size or (not piece and
+                        self.pending):
+                    self.buf += decrypt_segment(self.keys, self.header,
+                            self.segment, None, self.pending[:stored_size])
+                    self.pending = self.pending[stored_size:]
+                    self.segment += 1
+                if not piece:
+                    break
+                continue
+            if not piece:
+                break
+            if self.decryptor is not None:
+                # Ranges are whole AES blocks, but reads might not be
+                piece = self.pending + piece
+                cut = len(piece) - len(piece) % 16
+                self.pending = piece[cut:]
+                piece = self.decryptor.decrypt(piece[:cut])
+            self.buf += piece
+
+    def read(self, size):
+        '''Returns the next size bytes, never going past end.'''
+        size = min(size, self.end - self.pos)
+        self._fill(size)
+        data = self.buf[:size]
+        self.buf = self.buf[size:]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.key.close()
+
+
+def read_pieces(key, index, offset, size, header=None):
+    '''Yields (offset, data) pieces of the tar stream covering the given
+    range, fetching and decompressing only the blocks that hold it. header
+    is the archive's read_header.'''
+    from blockarchive import BLOCK_HEADER, unpack_block
+    from pcompress import decompress_block
+
+    if index['encrypted']:
+        block_key = config.enc_key
+    else:
+        block_key = None
+    block_header = None
+    if index.get('format') == 's3b':
+        # The blocks are decrypted one by one rather than the range
+        block_header, header = header, None
+    start, end = compressed_range(index, offset, size)
+    reader = RangeReader(key, index, start, end, header)
+    try:
+        if index['blocks'] is None:
+            pos = start
+            while pos < end:
+                data = reader.read(PIECE_SIZE)
+                if not data:
+                    raise IOError('The archive ended early.')
+                yield pos, data
+                pos += len(data)
+        else:
+            first, last = find_blocks(index, offset, size)
+            for number in range(first, last + 1):
+                block = index['blocks'][number]
+                data = reader.read(block[3])
+                if len(data) != block[3]:
+                    raise IOError('The archive ended early.')
+                if index.get('format') == 's3b':
+                    data = unpack_block(index['codec'], block_key,
+                            data[BLOCK_HEADER.size:], block_header, number)
+                else:
+                    data = decompress_block(index['codec'], data)
+                yield block[0], data
+    finally:
+        reader.close()
+
+
+def group_members(index, names, gap=MERGE_GAP):
+    '''Sorts the named members by offset and groups those stored close
+    together, so that each group can be fetched with one request. Returns
+    a list of lists of names.'''
+    members = index['members']
+    groups = []
+    end = None
+    for name in sorted(names, key=lambda name: members[name][0]):
+        start = members[name][4]
+        if end is None or start > end + gap:
+            groups.append([])
+            end = members[name][5]
+        groups[-1].append(name)
+        end = max(end, members[name][5])
+    return groups
+
+
+def extract_members(bucket, keyname, index, names, root):
+    '''Restores the named members of the archive at keyname under root,
+    fetching only the parts of the archive that hold them.'''
+    import os
+
+    members = index['members']
+    header = read_header(bucket.new_key(keyname), index)
+    for group in group_members(index, names):
+        offset = members[group[0]][0]
+        end = max(members[name][0] + members[name][1] for name in group)
+        files = {}
+        try:
+            for name in group:
+                dest = os.path.join(root, name)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                files[name] = open(dest, 'wb')
+            if end == offset:
+                # Only empty files
+                pieces = []
+            else:
+                pieces = read_pieces(bucket.new_key(keyname), index, offset,
+                        end - offset, header)
+            for pos, data in pieces:
+                for name in group:
+                    start, size = members[name][:2]
+                    # The part of this piece inside the member's data
+                    lo = max(start, pos)
+                    hi = min(start + size, pos + len(data))
+                    if lo < hi:
+                        files[name].write(data[lo - pos:hi - pos])
+        finally:
+            for f in files.values():
+                f.close()
+        for name in group:
+            dest = os.path.join(root, name)
+            os.chmod(dest, members[name][2])
+            os.utime(dest, (members[name][3], members[name][3]))
+            log.info('Restored %s.' % dest)
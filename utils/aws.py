@@ -14,23 +14,51 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# Archives uploaded before the enc-format metadata key was added were sent
+# as plaintext even though their enc key said 'True': the setting was
+# compared to True as a string, so nothing was encrypted. Only keys that
+# carry enc-format are decrypted; enc is still written for older versions.
+
 import config
 
 version = '0.1'
 
 def s3connect():
     '''Create/open a bucket and return the key'''
-    import boto
     import boto.s3.key
 
-    s3 = boto.connect_s3(config.aws_access_key_id,
-            config.aws_secret_access_key)
-    bucket = s3.create_bucket(config.bucket)
-    key = boto.s3.key.Key(bucket)
+    key = boto.s3.key.Key(get_bucket())
     
     return key
 
 
+def get_bucket():
+    '''Create/open the bucket and return it'''
+    return connect().create_bucket(config.bucket)
+
+
+def open_bucket():
+    '''Returns the bucket on a new connection without checking that it
+    exists, for threads that want a connection of their own.'''
+    return connect().get_bucket(config.bucket, validate=False)
+
+
+def connect():
+    '''Returns a new S3 connection. If s3_host is set, connects to that
+    endpoint (eg, a local S3 stand-in) instead of Amazon.'''
+    import boto
+
+    if not config.s3_host:
+        return boto.connect_s3(config.aws_access_key_id,
+                config.aws_secret_access_key)
+
+    from boto.s3.connection import OrdinaryCallingFormat
+    return boto.connect_s3(config.aws_access_key_id,
+            config.aws_secret_access_key, host=config.s3_host,
+            port=config.s3_port, is_secure=config.s3_is_secure,
+            calling_format=OrdinaryCallingFormat())
+
+
 def create_file_key(filename):
     '''Creates the key to use for S3. Key will be
     [machine_name]/YYYYMMDD/filename'''
@@ -46,3 +74,38 @@ def create_archive_key(file_extension, backup_type):
     keyname = ('%s/%s/%s%s' % (config.machine_name, backup_type,
         strftime('%Y%m%d'), file_extension))
     return keyname
+
+
+def sibling_key(keyname, extension):
+    '''Returns the name of the key kept alongside an archive key with
+    another extension, eg the .hash or .index key of
+    machine/daily/YYYYMMDD.tar.gz. Only the last part of the name is
+    changed, since machine_name may hold dots.'''
+    directory, sep, name = keyname.rpartition('/')
+    return directory + sep + name.split('.', 1)[0] + extension
+
+
+def get_archive_hash(bucket, key):
+    '''Returns the hash that was stored for an archive key, or None. Streamed
+    archives keep it on the matching .hash key instead.'''
+    archive_hash = key.get_metadata('hash')
+    if archive_hash is None:
+        hash_key = bucket.get_key(sibling_key(key.key, '.hash'))
+        if hash_key is not None:
+            archive_hash = hash_key.get_metadata('archive-hash')
+    return archive_hash
+
+
+def encryption_metadata(enc_format):
+    '''Returns the metadata that marks a key as encrypted in enc_format
+    ('1' or '2' for whole archives, 'blocks' for s3b archives, 'data' for
+    what chunkstore.pack encrypts), or as plaintext if enc_format is
+    None.'''
+    if enc_format is None:
+        return {'enc': 'False'}
+    return {'enc': 'True', 'enc-format': enc_format}
+
+
+def is_encrypted(key):
+    '''Returns whether the contents of a key are encrypted.'''
+    return key.get_metadata('enc-format') is not None
@@ -0,0 +1,324 @@
+# blockarchive.py - The s3b block archive container
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# An s3b file holds a tar archive cut into blocks that are compressed and
+# encrypted independently, so they can be processed in parallel and read
+# in any order:
+#
+#   header   'S3BA', version, flags, codec, block size, and if the
+#            encrypted flag is set, a format 2 encryption header
+#   blocks   each a 4-byte length followed by the packed block, which is
+#            the compressed block, encrypted if the encrypted flag is set
+#   last     if encrypted, an empty block marked as the last
+#   end      a length of 0
+#   table    raw offset, raw size, stored offset, stored size of each
+#            block; the stored offset is that of its length
+#   footer   table offset, block count, 'S3BT'
+#
+# All numbers are little-endian. The end marker lets the blocks be read as
+# a stream; the table lets them be found without reading the rest.
+#
+# Encrypted blocks are format 2 segments (see encrypt.py) numbered in
+# order, so they are authenticated and can't be reordered or swapped with
+# those of another archive; the empty last block shows that none were
+# dropped from the end. The segment size in the encryption header only
+# spaces out the blocks' counters, so it is larger than any block. Version
+# 1 archives encrypted each block with encrypt_data (AES-CBC) instead.
+
+version = '0.1'
+
+import struct
+from collections import deque
+
+import metrics
+from pcompress import ParallelCompressor, compress_block, decompress_block
+
+MAGIC = b'S3BA'
+FOOTER_MAGIC = b'S3BT'
+FORMAT_VERSION = 2
+
+# Header flags
+ENCRYPTED = 1
+
+# The largest multiple of 16 that the header's segment size can hold
+SEGMENT_SPACING = 0xFFFFFFF0
+
+HEADER = struct.Struct('<4sBB4sI')
+BLOCK_HEADER = struct.Struct('<I')
+TABLE_ENTRY = struct.Struct('<QIQI')
+FOOTER = struct.Struct('<QQ4s')
+
+# The codec used for each compression method; none stores the blocks
+CODECS = {'none': None, 'gz': 'gz', 'pgz': 'gz', 'bz2': 'bz2',
+        'pbz2': 'bz2', 'zstd': 'zst', 'lz4': 'lz4'}
+
+
+def pack_block(codec, level, key, data, header=None, number=0,
+        last=False):
+    '''Compresses and, if key is given, encrypts a block as segment number
+    of the encryption header. Returns it with its length in front.'''
+    from encrypt import derive_keys, encrypt_segment
+
+    if codec is not None:
+        data = compress_block(codec, level, data)
+    if key is not None:
+        data = encrypt_segment(derive_keys(key), header, number, last, data)
+    return BLOCK_HEADER.pack(len(data)) + data
+
+
+def unpack_block(codec, key, data, header=None, number=0):
+    '''Reverses pack_block, given the block without its length. Raises
+    IOError if the block is not authentic. Version 1 blocks have no
+    header.'''
+    from encrypt import decrypt_data, decrypt_segment, derive_keys
+
+    if key is not None:
+        if header is None:
+            data = decrypt_data(key, data)
+        else:
+            data = decrypt_segment(derive_keys(key), header, number, False,
+                    data)
+    if codec is not None:
+        data = decompress_block(codec, data)
+    return data
+
+
+def is_last_block(key, header, number, data):
+    '''Returns whether data is the empty block that ends an encrypted
+    archive, as segment number of the encryption header.'''
+    from encrypt import TAG_SIZE, decrypt_segment, derive_keys
+
+    if len(data) != TAG_SIZE:
+        return False
+    try:
+        decrypt_segment(derive_keys(key), header, number, True, data)
+    except IOError:
+        return False
+    return True
+
+
+def cipher_header(data):
+    '''Returns the encryption header of an s3b file whose start is data, or
+    None if its blocks aren't encrypted or are version 1 blocks.'''
+    from encrypt import HEADER as CIPHER_HEADER, MAGIC as CIPHER_MAGIC
+
+    magic, file_version, flags = HEADER.unpack_from(data)[:3]
+    if magic != MAGIC:
+        raise IOError('Not an s3b archive.')
+    if file_version < 2 or not flags & ENCRYPTED:
+        return None
+    header = data[HEADER.size:HEADER.size + CIPHER_HEADER.size]
+    if (len(header) != CIPHER_HEADER.size or
+            not header.startswith(CIPHER_MAGIC)):
+        raise IOError('The s3b encryption header is missing.')
+    return header
+
+
+class BlockArchiveWriter(ParallelCompressor):
+    '''A write-only file object that writes an s3b file to fileobj. Blocks
+    are packed on a pool of worker processes. If key is given the blocks
+    are encrypted with it.'''
+
+    def __init__(self, fileobj, codec, level=9, workers=None,
+            block_size=4 * 1024 * 1024, key=None):
+        import os
+        import encrypt
+
+        ParallelCompressor.__init__(self, fileobj, codec, level, workers,
+                block_size)
+        self.key = key
+        flags = ENCRYPTED if key is not None else 0
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, flags,
+                (codec or '').encode('ascii'), block_size)
+        self.header = None
+        if key is not None:
+            self.header = encrypt.HEADER.pack(encrypt.MAGIC,
+                    encrypt.FORMAT_VERSION, SEGMENT_SPACING, os.urandom(8))
+            header += self.header
+        self.number = 0
+        fileobj.write(header)
+        self.compressed_offset = len(header)
+
+    def _start_block(self, level, data):
+        result = self.pool.apply_async(pack_block,
+                (self.codec, level, self.key, data, self.header, self.number))
+        self.number += 1
+        return result
+
+    def _finish(self):
+        if self.key is not None:
+            last = pack_block(None, None, self.key, b'', self.header,
+                    self.number, True)
+            self.fileobj.write(last)
+            self.compressed_offset += len(last)
+        self.fileobj.write(BLOCK_HEADER.pack(0))
+        table_offset = self.compressed_offset + BLOCK_HEADER.size
+        for block in self.blocks:
+            self.fileobj.write(TABLE_ENTRY.pack(*block))
+        self.fileobj.write(FOOTER.pack(table_offset, len(self.blocks),
+                FOOTER_MAGIC))
+
+
+class BlockArchiveReader(object):
+    '''A read-only file object over the tar archive in an s3b file. Blocks
+    are read ahead and unpacked on a pool of worker processes. If fileobj
+    can seek, so can the reader, using the block table; otherwise it reads
+    the blocks in order.'''
+
+    def __init__(self, fileobj, key=None, workers=None):
+        import multiprocessing
+        from pcompress import check_codec, get_pool
+
+        self.fileobj = fileobj
+        head = self._read_exactly(HEADER.size)
+        magic, file_version, flags, codec, self.block_size = HEADER.unpack(
+                head)
+        if magic != MAGIC:
+            raise IOError('Not an s3b archive.')
+        if file_version > FORMAT_VERSION:
+            raise IOError('s3b version %d is not supported.' % file_version)
+        self.codec = codec.rstrip(b'\0').decode('ascii') or None
+        check_codec(self.codec)
+        self.header = None
+        if flags & ENCRYPTED:
+            if key is None:
+                raise IOError('The archive is encrypted.')
+            self.key = key
+            if file_version >= 2:
+                from encrypt import HEADER as CIPHER_HEADER
+
+                self.header = cipher_header(head + self._read_exactly(
+                        CIPHER_HEADER.size))
+        else:
+            self.key = None
+        # The number of the next block read, and whether the last block of
+        # an encrypted archive has been
+        self.number = 0
+        self.ended = False
+
+        self.pool = get_pool(workers)
+        self.max_pending = 2 * (workers or multiprocessing.cpu_count())
+        self.pending = deque()
+        self.table = None
+        self.eof = False
+        self.buf = b''
+        self.pos = 0
+
+    def _read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            piece = self.fileobj.read(size - len(data))
+            if not piece:
+                raise IOError('The archive ended early.')
+            data += piece
+        return data
+
+    def _fill(self):
+        '''Reads blocks and starts unpacking them until max_pending are in
+        flight or the last block has been read.'''
+        while len(self.pending) < self.max_pending and not self.eof:
+            size = BLOCK_HEADER.unpack(self._read_exactly(
+                    BLOCK_HEADER.size))[0]
+            if size == 0:
+                if self.header is not None and not self.ended:
+                    raise IOError('The archive was cut short.')
+                self.eof = True
+                break
+            data = self._read_exactly(size)
+            if self.header is not None and is_last_block(self.key,
+                    self.header, self.number, data):
+                self.ended = True
+                continue
+            self.pending.append(self.pool.apply_async(unpack_block,
+                    (self.codec, self.key, data, self.header, self.number)))
+            self.number += 1
+
+    def read(self, size=-1):
+        chunks = [self.buf]
+        available = len(self.buf)
+        while size is None or size < 0 or available < size:
+            self._fill()
+            if not self.pending:
+                break
+            with metrics.timed('decompress', items=1):
+                data = self.pending.popleft().get()
+            metrics.add('decompress', len(data))
+            chunks.append(data)
+            available += len(data)
+        data = b''.join(chunks)
+        if size is None or size < 0:
+            size = len(data)
+        self.buf = data[size:]
+        data = data[:size]
+        self.pos += len(data)
+        return data
+
+    def read_table(self):
+        '''Returns the block table: a list of (offset, size, stored offset,
+        stored size).'''
+        if self.table is None:
+            here = self.fileobj.tell()
+            self.fileobj.seek(-FOOTER.size, 2)
+            table_offset, count, magic = FOOTER.unpack(self._read_exactly(
+                    FOOTER.size))
+            if magic != FOOTER_MAGIC:
+                raise IOError('The s3b block table is missing.')
+            self.fileobj.seek(table_offset)
+            data = self._read_exactly(count * TABLE_ENTRY.size)
+            self.table = [TABLE_ENTRY.unpack_from(data, i * TABLE_ENTRY.size)
+                    for i in range(count)]
+            self.starts = [block[0] for block in self.table]
+            self.fileobj.seek(here)
+        return self.table
+
+    def seek(self, offset, whence=0):
+        from bisect import bisect_right
+
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            table = self.read_table()
+            # An archive of nothing has no blocks
+            if table:
+                offset += table[-1][0] + table[-1][1]
+        if 0 <= offset - self.pos <= self.block_size * self.max_pending:
+            # Nearby, and probably read ahead already
+            self.read(offset - self.pos)
+            return
+
+        # Start again from the block that holds offset; blocks in flight
+        # are dropped
+        table = self.read_table()
+        i = max(bisect_right(self.starts, offset) - 1, 0)
+        self.pending.clear()
+        self.buf = b''
+        if i < len(table):
+            self.fileobj.seek(table[i][2])
+            self.eof = False
+            # The last block is read again
+            self.ended = False
+            self.pos = table[i][0]
+            self.number = i
+        else:
+            self.eof = True
+            self.pos = 0
+        self.read(offset - self.pos)
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.fileobj.close()
@@ -0,0 +1,203 @@
+# bundle.py - Packing small files into bundles for s3put
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Files smaller than bundle_threshold are concatenated into pack objects
+# of about bundle_size, stored as base/packs/RUN-NNNN.pack. Each run also
+# stores base/packs/RUN.index, a zlib-compressed JSON object:
+#
+#   {"packs": [[name, size], ...],
+#    "files": {name: [pack number, offset, length, mode, mtime, md5]}}
+#
+# where name is the file's key without base/, as it would have been
+# uploaded. Later runs' indexes override earlier ones for the same name.
+
+version = '0.1'
+
+import hashlib
+import json
+import os
+import zlib
+from io import BytesIO
+
+import log
+
+
+log = log.get_logger('bundle')
+
+# Ranges of a pack closer than this are fetched with one request
+MERGE_GAP = 64 * 1024
+
+
+class Bundler(object):
+    '''Packs small files for upload under base/packs/.'''
+
+    def __init__(self, bucket, base, threshold, pack_size):
+        from time import strftime
+
+        self.bucket = bucket
+        self.base = base
+        self.prefix = '%s/packs/%s' % (base, strftime('%H%M%S'))
+        self.threshold = threshold
+        self.pack_size = pack_size
+        self.packs = []
+        self.files = {}
+        self.pack = BytesIO()
+        # Files in the current pack, which may all be empty
+        self.pack_files = 0
+        self.bundled = 0
+
+    def filter(self, uploads):
+        '''Yields the (path, keyname) uploads that are too big to bundle,
+        and bundles the rest. The packs and the index are uploaded once
+        uploads runs out.'''
+        for path, keyname in uploads:
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Let the uploader report it
+                yield path, keyname
+                continue
+            if st.st_size >= self.threshold:
+                yield path, keyname
+                continue
+            try:
+                self.add(path, keyname[len(self.base) + 1:], st)
+            except IOError:
+                yield path, keyname
+        self.close()
+
+    def add(self, path, name, st):
+        '''Adds a file to the current pack under the given name.'''
+        with open(path, 'rb') as inf:
+            data = inf.read()
+        offset = self.pack.tell()
+        self.pack.write(data)
+        self.files[name] = [len(self.packs), offset, len(data),
+                st.st_mode & 0o7777, st.st_mtime,
+                hashlib.md5(data).hexdigest()]
+        self.pack_files += 1
+        self.bundled += 1
+        if self.pack.tell() >= self.pack_size:
+            self._send_pack()
+
+    def close(self):
+        '''Sends the last pack and the index.'''
+        from upload import send_data
+
+        if self.pack_files:
+            self._send_pack()
+        if not self.files:
+            return
+        index = json.dumps({'packs': self.packs, 'files': self.files})
+        send_data(self.bucket, self.prefix + '.index', zlib.compress(index))
+        log.info('Bundled %d files into %d packs.' % (self.bundled,
+                len(self.packs)))
+
+    def _send_pack(self):
+        from upload import send_data
+
+        name = '%s-%04d.pack' % (self.prefix, len(self.packs))
+        data = self.pack.getvalue()
+        send_data(self.bucket, name, data)
+        self.packs.append([name, len(data)])
+        self.pack = BytesIO()
+        self.pack_files = 0
+
+
+def load_index(bucket, base):
+    '''Returns the combined index of every bundling run under base, as a
+    dict of name to (pack name, pack size, offset, length, mode, mtime,
+    md5).'''
+    from download import fetch_data
+
+    files = {}
+    for key in sorted(bucket.list(base + '/packs/'), key=lambda k: k.name):
+        if not key.name.endswith('.index'):
+            continue
+        index = json.loads(zlib.decompress(fetch_data(key)))
+        for name, entry in index['files'].items():
+            pack_name, pack_size = index['packs'][entry[0]]
+            files[name] = [pack_name, pack_size] + entry[1:]
+    return files
+
+
+def restore_files(bucket, files, names, root):
+    '''Restores the named files of the index under root. A pack that
+    most of is needed is fetched whole; otherwise only the ranges of the
+    files are fetched. Returns the number of files restored.'''
+    from download import fetch_data
+
+    by_pack = {}
+    for path in names:
+        entry = files[path]
+        by_pack.setdefault(entry[0], []).append((entry[2], path))
+
+    restored = 0
+    for pack_name, members in by_pack.items():
+        members.sort()
+        pack_size = files[members[0][1]][1]
+        needed = sum(files[path][3] for offset, path in members)
+        if needed * 2 >= pack_size:
+            log.debug('Fetching all of %s.' % pack_name)
+            ranges = [(0, pack_size, members)]
+        else:
+            ranges = merge_ranges(files, members)
+        for start, end, group in ranges:
+            key = bucket.new_key(pack_name)
+            if end == start:
+                # Only empty files
+                data = b''
+            elif start == 0 and end == pack_size:
+                data = fetch_data(key)
+            else:
+                data = fetch_data(key, {'Range': 'bytes=%d-%d' % (start,
+                        end - 1)})
+            for offset, path in group:
+                entry = files[path]
+                contents = data[offset - start:offset - start + entry[3]]
+                if hashlib.md5(contents).hexdigest() != entry[6]:
+                    log.error('%s is corrupt in %s; not restored.' % (path,
+                            pack_name))
+                    continue
+                write_file(os.path.join(root, path), contents,
+                        entry[4], entry[5])
+                restored += 1
+    return restored
+
+
+def merge_ranges(files, members):
+    '''Groups (offset, path) members, sorted by offset, into (start, end,
+    members) ranges that are fetched together.'''
+    ranges = []
+    for offset, path in members:
+        end = offset + files[path][3]
+        if ranges and offset - ranges[-1][1] <= MERGE_GAP:
+            ranges[-1][1] = max(ranges[-1][1], end)
+            ranges[-1][2].append((offset, path))
+        else:
+            ranges.append([offset, end, [(offset, path)]])
+    return ranges
+
+
+def write_file(dest, data, mode, mtime):
+    '''Writes a restored file and sets its mode and mtime.'''
+    if not os.path.isdir(os.path.dirname(dest)):
+        os.makedirs(os.path.dirname(dest))
+    with open(dest, 'wb') as outf:
+        outf.write(data)
+    os.chmod(dest, mode)
+    os.utime(dest, (mtime, mtime))
+    log.info('Restored %s.' % dest)
@@ -0,0 +1,173 @@
+# catalog.py - Local catalog of the archives in the bucket
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The catalog is an SQLite database of the archives under each
+# machine/schedule/ prefix. Archive keys are named by date, so a refresh
+# only lists the keys from the newest date in the catalog on (that date
+# again, in case it was backed up again). Only new archives need a HEAD
+# request, for their metadata.
+
+version = '0.1'
+
+import sqlite3
+
+import log
+
+
+log = log.get_logger('catalog')
+
+# The extensions of archive keys, and the format each one is in. .hash and
+# .index keys sit next to the archives but aren't listed.
+FORMATS = {'tar': 'tar', 'tar.gz': 'tar.gz', 'tar.bz2': 'tar.bz2',
+        'tar.zst': 'tar.zst', 'tar.lz4': 'tar.lz4', 'zip': 'zip',
+        's3b': 's3b', 'chunks': 'dedup'}
+
+
+class Catalog(object):
+    '''The archives of each machine and schedule, with their dates, sizes,
+    formats, encryption and backup types.'''
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS archives (key TEXT '
+                'PRIMARY KEY, machine TEXT, schedule TEXT, date TEXT, '
+                'size INTEGER, format TEXT, encrypted INTEGER, '
+                'backup_type TEXT, etag TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS archives_date ON '
+                'archives (machine, schedule, date)')
+        self.db.commit()
+
+    def refresh(self, bucket, machine, schedule, full=False):
+        '''Adds the archives uploaded since the last refresh. With full,
+        the prefix is listed from the start and archives that are gone are
+        dropped.'''
+        from aws import is_encrypted
+
+        prefix = '%s/%s/' % (machine, schedule)
+        newest = None
+        if not full:
+            newest = self.db.execute('SELECT MAX(date) FROM archives WHERE '
+                    'machine = ? AND schedule = ?', (machine,
+                    schedule)).fetchone()[0]
+        if newest is None:
+            marker = ''
+            known = {}
+        else:
+            # Sorts before every key of that date
+            marker = prefix + newest
+            known = dict(self.db.execute('SELECT key, etag FROM archives '
+                    'WHERE machine = ? AND schedule = ? AND date >= ?',
+                    (machine, schedule, newest)))
+
+        listed = set()
+        added = 0
+        for key in bucket.list(prefix, '/', marker=marker):
+            name = key.name[len(prefix):]
+            if '.' not in name:
+                continue
+            date, extension = name.split('.', 1)
+            if extension not in FORMATS:
+                continue
+            listed.add(key.name)
+            if known.get(key.name) == key.etag:
+                continue
+            # The listing doesn't include metadata
+            head = bucket.get_key(key.name)
+            if head is None:
+                continue
+            self.db.execute('INSERT OR REPLACE INTO archives VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?)', (key.name, machine,
+                    schedule, date, key.size, FORMATS[extension],
+                    is_encrypted(head),
+                    head.get_metadata('backup-type'), key.etag))
+            added += 1
+        if full:
+            for keyname, in self.db.execute('SELECT key FROM archives WHERE '
+                    'machine = ? AND schedule = ?', (machine,
+                    schedule)).fetchall():
+                if keyname not in listed:
+                    self.db.execute('DELETE FROM archives WHERE key = ?',
+                            (keyname,))
+        self.db.commit()
+        log.debug('Catalog refreshed from %s; %d archives added.' % (prefix,
+                added))
+
+    def archives(self, machine, schedule=None):
+        '''Returns (key, schedule, date, size, format, encrypted,
+        backup_type) for each archive, oldest first.'''
+        query = ('SELECT key, schedule, date, size, format, encrypted, '
+                'backup_type FROM archives WHERE machine = ?')
+        params = (machine,)
+        if schedule is not None:
+            query += ' AND schedule = ?'
+            params += (schedule,)
+        return self.db.execute(query + ' ORDER BY date, schedule, key',
+                params).fetchall()
+
+    def last_date(self, machine, schedule):
+        '''Returns the YYYYMMDD date of the newest archive, or None.'''
+        return self.db.execute('SELECT MAX(date) FROM archives WHERE '
+                'machine = ? AND schedule = ?', (machine,
+                schedule)).fetchone()[0]
+
+    def restore_chain(self, machine, schedule, keyname):
+        '''Returns the keys of the archives to extract, oldest first, to
+        restore the archive keyname: the full backup it builds on, then
+        each incremental or differential backup on the way to it. Returns
+        None if one of them is missing.'''
+        # Deduplicated backups don't take part in the chain
+        rows = self.db.execute('SELECT key, backup_type FROM archives WHERE '
+                'machine = ? AND schedule = ? AND format != ? ORDER BY date, '
+                'key', (machine, schedule, 'dedup')).fetchall()
+        keys = [key for key, backup_type in rows]
+        if keyname not in keys:
+            return None
+
+        # Archives made before backup types were recorded are full ones
+        full = [i for i, (key, backup_type) in enumerate(rows)
+                if backup_type in (None, 'full')]
+        chain = []
+        i = keys.index(keyname)
+        while True:
+            key, backup_type = rows[i]
+            chain.append(key)
+            if backup_type in (None, 'full'):
+                break
+            if backup_type == 'differential':
+                # Differential backups are made against the last full one
+                earlier = [j for j in full if j < i]
+                i = earlier[-1] if earlier else -1
+            else:
+                # Incremental backups are made against the backup before
+                i -= 1
+            if i < 0:
+                return None
+        chain.reverse()
+        return chain
+
+    def close(self):
+        self.db.close()
+
+
+def open_catalog(bucket, schedules, full=False):
+    '''Opens the configured catalog and refreshes it for this machine's
+    given schedules.'''
+    import config
+
+    catalog = Catalog(config.catalog)
+    for schedule in schedules:
+        catalog.refresh(bucket, config.machine_name, schedule, full)
+    return catalog
@@ -0,0 +1,126 @@
+# chunker.py - Content-defined chunking
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Chunk boundaries are chosen with a "gear" rolling hash: a boundary is cut
+# wherever the high bits of the hash are zero. Because the hash only depends
+# on the last few dozen bytes, inserting or removing data only changes the
+# chunks around the edit and the rest still match earlier backups.
+#
+# The hash at each byte is the sum of the gear values of the last 32 bytes,
+# each shifted left by its distance from the byte, mod 2 ** 32. Rather than
+# rolling it a byte at a time in Python, find_boundary works out the
+# hashes of a whole block of bytes at once: the block's gear values are laid
+# out in one long integer, a LANE-byte lane per byte, and five shifted
+# additions sum the 32 terms of every lane together. The masked bits of
+# each lane are then tested for zero with a few more operations on the
+# whole integer.
+
+version = '0.2'
+
+import binascii
+import random
+
+# A fixed table of random values, one per byte value. It must never change
+# or chunk boundaries (and so deduplication) change with it.
+_rand = random.Random(0x53334241)
+GEAR = [_rand.getrandbits(32) for i in range(256)]
+del _rand
+
+# The sum of 32 shifted 32-bit values fits in 68 bits
+LANE = 9
+LANE_BITS = LANE * 8
+
+# Translation tables giving each byte of GEAR's values, lowest first
+GEAR_BYTES = [b''.join(chr((value >> (8 * i)) & 0xFF) for value in GEAR)
+        for i in range(4)]
+
+# Bytes scanned at a time; larger blocks do more work past the boundary
+BLOCK_SIZE = 64 * 1024
+
+_lane_constants = {}
+
+
+def chunk_file(fileobj, min_size=256 * 1024, avg_size=1024 * 1024,
+        max_size=4 * 1024 * 1024):
+    '''Yields the content-defined chunks of a file. avg_size must be a power
+    of two.'''
+    # Test the high bits; they depend on the last 32 bytes, the low bits on
+    # only the last few.
+    bits = len(bin(avg_size)) - 3
+    mask = ((1 << bits) - 1) << (32 - bits)
+    buf = b''
+    eof = False
+    while True:
+        if not eof and len(buf) < max_size:
+            data = fileobj.read(max_size)
+            if not data:
+                eof = True
+            buf += data
+        if not buf:
+            return
+        if eof and len(buf) <= min_size:
+            yield buf
+            return
+
+        cut = find_boundary(bytearray(buf[:max_size]), min_size, mask)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+
+def find_boundary(data, min_size, mask):
+    '''Returns the length of the first chunk of data (a bytearray): the
+    first position after min_size where the hash's masked bits are zero,
+    or all of data.'''
+    start = min_size
+    while start < len(data):
+        end = min(start + BLOCK_SIZE, len(data))
+        # The hash at start needs the 31 bytes before it
+        first = max(0, start - 31)
+        count = end - first
+        block = data[first:end]
+        # Lane i (the most significant first) holds the gear value of
+        # block[i]
+        lanes = bytearray(count * LANE)
+        for i in range(4):
+            lanes[LANE - 1 - i::LANE] = block.translate(GEAR_BYTES[i])
+        hashes = int(binascii.hexlify(lanes), 16)
+        # Add each lane's 1, 2, 4, 8 then 16 predecessors, shifted
+        for shift in (1, 2, 4, 8, 16):
+            hashes += hashes >> (shift * LANE_BITS - shift)
+        masks, ones, carries = lane_constants(count, mask)
+        # A lane's bit 32 is set after adding ones unless its masked bits
+        # are all zero
+        zero = ((hashes & masks) + ones & carries) ^ carries
+        # Leave out the lanes before start
+        zero &= (1 << ((end - start) * LANE_BITS)) - 1
+        if zero:
+            return end - (zero.bit_length() - 1) // LANE_BITS
+        start = end
+    return len(data)
+
+
+def lane_constants(count, mask):
+    '''Returns integers of count lanes holding mask, 2 ** 32 - 1 and
+    2 ** 32 in every lane.'''
+    constants = _lane_constants.get((count, mask))
+    if constants is None:
+        lanes = ((1 << (count * LANE_BITS)) - 1) // ((1 << LANE_BITS) - 1)
+        constants = (lanes * mask, lanes * 0xFFFFFFFF, lanes << 32)
+        # Nearly every block has the same size; don't keep odd ones
+        if len(_lane_constants) > 8:
+            _lane_constants.clear()
+        _lane_constants[(count, mask)] = constants
+    return constants
@@ -0,0 +1,243 @@
+# chunkstore.py - Deduplicating, content-addressed chunk storage on S3
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Chunks are stored under chunk_prefix/ab/abcd..., where the name is an
+# HMAC of the chunk's contents keyed with the encryption key. Machines that
+# share a password share chunks, and the names reveal nothing about the
+# data. Each chunk is compressed, then encrypted if encryption is on; the
+# chunk's key records which, so a chunk stored with encryption off can be
+# reused once it is turned on, and the other way round.
+#
+# A backup is a manifest (a JSON list of files and their chunk names)
+# stored at machine_name/schedule/YYYYMMDD.chunks, compressed and
+# encrypted the same way.
+#
+# The chunk names of each file are kept in the hash cache, so a file
+# whose inode, size, mtime and ctime haven't changed since the last backup
+# isn't read again, as long as all of its chunks are still in the store.
+
+version = '0.1'
+
+import hmac
+import hashlib
+import json
+import os
+import sqlite3
+import zlib
+
+import config
+import log
+
+
+log = log.get_logger('chunkstore')
+
+
+class ChunkStore(object):
+    '''Uploads chunks that aren't already in the bucket. A local index of
+    known chunks saves a request per chunk; if the index is empty it is
+    filled with one listing of the chunk prefix.'''
+
+    def __init__(self, bucket, index_path):
+        self.bucket = bucket
+        self.prefix = config.chunk_prefix.strip('/')
+        self.db = sqlite3.connect(index_path, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS chunks '
+                '(name TEXT PRIMARY KEY)')
+        if self.db.execute('SELECT COUNT(*) FROM chunks').fetchone()[0] == 0:
+            self.sync_index()
+        self.sent = 0
+        self.skipped = 0
+
+    def sync_index(self):
+        '''Rebuilds the index from a listing of the chunk prefix.'''
+        log.debug('Listing %s/ to build the chunk index.' % self.prefix)
+        names = ((key.name.rsplit('/', 1)[-1],)
+                for key in self.bucket.list(self.prefix + '/'))
+        self.db.executemany('INSERT OR IGNORE INTO chunks VALUES (?)', names)
+        self.db.commit()
+
+    def put(self, data):
+        '''Stores a chunk unless it's already stored. Returns its name.'''
+        from upload import send_data
+
+        name = chunk_name(data)
+        if self.db.execute('SELECT 1 FROM chunks WHERE name = ?',
+                (name,)).fetchone():
+            self.skipped += 1
+            return name
+
+        send_data(self.bucket, self.chunk_key(name), pack(data),
+                metadata=pack_metadata())
+        self.db.execute('INSERT OR IGNORE INTO chunks VALUES (?)', (name,))
+        self.sent += 1
+        return name
+
+    def reuse(self, names):
+        '''Returns whether every chunk in names is stored, counting them as
+        skipped if so.'''
+        for name in set(names):
+            if not self.db.execute('SELECT 1 FROM chunks WHERE name = ?',
+                    (name,)).fetchone():
+                return False
+        self.skipped += len(names)
+        return True
+
+    def get(self, name):
+        '''Downloads and returns a chunk.'''
+        from aws import is_encrypted
+        from download import fetch_data
+
+        # The GET fills in the key's metadata
+        key = self.bucket.new_key(self.chunk_key(name))
+        data = unpack(fetch_data(key), is_encrypted(key))
+        if chunk_name(data) != name:
+            raise IOError('Chunk %s is corrupt.' % name)
+        return data
+
+    def chunk_key(self, name):
+        return '%s/%s/%s' % (self.prefix, name[:2], name)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def chunk_list_algorithm():
+    '''Returns the name chunk lists are kept under in the hash cache. It
+    changes with the chunk sizes and the encryption key, which the chunk
+    names depend on.'''
+    return 'chunks-%d-%d-%d-%s' % (config.chunk_min_size,
+            config.chunk_avg_size, config.chunk_max_size, chunk_name(b'')[:16])
+
+
+def chunk_name(data):
+    '''Returns the name a chunk is stored under.'''
+    return hmac.new(config.enc_key, data, hashlib.sha256).hexdigest()
+
+
+def pack(data):
+    '''Compresses, and if configured encrypts, data for upload.'''
+    from encrypt import encrypt_data
+
+    data = zlib.compress(data)
+    if config.enc_backup == True:
+        data = encrypt_data(config.enc_key, data)
+    return data
+
+
+def unpack(data, encrypted):
+    '''Reverses pack(). encrypted is whether data was encrypted, as the
+    metadata of its key records it.'''
+    from encrypt import decrypt_data
+
+    if encrypted:
+        data = decrypt_data(config.enc_key, data)
+    return zlib.decompress(data)
+
+
+def pack_metadata():
+    '''Returns the metadata to store on the key of what pack() returns.'''
+    from aws import encryption_metadata
+
+    if config.enc_backup == True:
+        return encryption_metadata('data')
+    return encryption_metadata(None)
+
+
+def backup_files(bucket, paths, follow_links, manifest_key):
+    '''Chunks every file under paths into the store and uploads the
+    manifest of the backup to manifest_key.'''
+    import stat
+    from filesystem import walk_files
+    from hashcache import get_cache
+    from log import FileProgress
+    from upload import send_data
+
+    store = ChunkStore(bucket, config.chunk_index)
+    cache = get_cache()
+    algorithm = chunk_list_algorithm()
+    files = []
+    unchanged = 0
+    progress = FileProgress(log, 'Added')
+    try:
+        for path, st in walk_files(paths, follow_links):
+            entry = {'path': path, 'size': st.st_size,
+                    'mtime': st.st_mtime, 'mode': st.st_mode}
+            if stat.S_ISLNK(st.st_mode):
+                entry['link'] = os.readlink(path)
+            else:
+                chunks = None
+                if cache is not None:
+                    chunks = cache.get(st, algorithm)
+                if chunks is not None and store.reuse(chunks.split()):
+                    entry['chunks'] = chunks.split()
+                    unchanged += 1
+                else:
+                    try:
+                        entry['chunks'] = chunk_path(store, path)
+                    except IOError:
+                        log.error('Cannot read %s.' % path)
+                        continue
+                    if cache is not None:
+                        cache.put(path, st, algorithm,
+                                ' '.join(entry['chunks']))
+            files.append(entry)
+            progress.add(path, st.st_size)
+        progress.finish()
+    finally:
+        store.close()
+
+    send_data(bucket, manifest_key, pack(json.dumps({'files': files})),
+            metadata=pack_metadata())
+    log.info('Sent %d new chunks; %d were already stored. %d files were '
+            'unchanged and not read.' % (store.sent, store.skipped,
+            unchanged))
+
+
+def chunk_path(store, path):
+    '''Stores the chunks of the file at path and returns their names.'''
+    from chunker import chunk_file
+
+    with open(path, 'rb') as inf:
+        return [store.put(chunk) for chunk in chunk_file(inf,
+                config.chunk_min_size, config.chunk_avg_size,
+                config.chunk_max_size)]
+
+
+def restore_files(bucket, manifest_key, root):
+    '''Restores every file in the manifest at manifest_key under root.'''
+    from aws import is_encrypted
+
+    store = ChunkStore(bucket, config.chunk_index)
+    key = bucket.get_key(manifest_key)
+    manifest = json.loads(unpack(key.get_contents_as_string(),
+            is_encrypted(key)))
+    try:
+        for entry in manifest['files']:
+            dest = os.path.join(root, entry['path'].lstrip('/'))
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            if 'link' in entry:
+                os.symlink(entry['link'], dest)
+                continue
+            with open(dest, 'wb') as outf:
+                for name in entry['chunks']:
+                    outf.write(store.get(name))
+            os.chmod(dest, entry['mode'] & 0o7777)
+            os.utime(dest, (entry['mtime'], entry['mtime']))
+            log.info('Restored %s.' % dest)
+    finally:
+        store.close()
@@ -0,0 +1,307 @@
+# download.py - Downloads from S3 in parallel byte ranges
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A resumable download writes to path.part and records the ETag and size
+# of the key and the byte ranges finished so far in path.part.json. A
+# later download of the same key to the same path fetches only the ranges
+# that are missing, unless the key has changed since, and renames the file
+# into place once it is complete.
+
+version = '0.3'
+
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import aws
+import log
+import metrics
+import throttle
+
+
+log = log.get_logger('download')
+
+
+def download_key(key, path, range_size, workers=1, resume=False):
+    '''Downloads key to path, fetching byte ranges of range_size bytes with
+    a pool of worker threads. The file is preallocated and each range is
+    written at its offset. Raises the first error if any range fails.
+
+    The download tuner may run fewer ranges at once, and hand out larger
+    ones than range_size as it learns the throughput. With resume the
+    download goes through a PartialDownload, so an interrupted one can be
+    finished later.'''
+    import os
+
+    size = key.size
+    if resume:
+        partial = PartialDownload(key, path)
+        out_path = partial.file
+        todo = partial.missing()
+        if todo != [[0, size]]:
+            log.info('Resuming the download of %s; %d of %d bytes to go.' %
+                    (key.key, sum(end - start for start, end in todo), size))
+    else:
+        partial = None
+        out_path = path
+        todo = [[0, size]]
+    if partial is None or not os.path.exists(out_path):
+        with open(out_path, 'wb') as outf:
+            outf.truncate(size)
+
+    tuner = throttle.get_tuner('download', workers)
+    lock = threading.Lock()
+    errors = []
+
+    def next_range():
+        '''Hands out the start of the first missing span.'''
+        with lock:
+            while todo and todo[0][0] >= todo[0][1]:
+                todo.pop(0)
+            if not todo:
+                return None
+            start = todo[0][0]
+            end = min(start + tuner.part_size(range_size), todo[0][1])
+            todo[0][0] = end
+            return start, end - 1
+
+    def worker():
+        '''Fetches ranges until there are none left.'''
+        remote = None
+        with open(out_path, 'r+b') as outf:
+            while not errors:
+                item = next_range()
+                if item is None:
+                    return
+                start, end = item
+                try:
+                    if remote is None:
+                        remote = aws.open_bucket().new_key(key.key)
+                    fetch_range(remote, outf, start, end, tuner=tuner)
+                    if partial is not None:
+                        # Only once the range is on disk
+                        outf.flush()
+                        os.fsync(outf.fileno())
+                        partial.add_range(start, end + 1)
+                except Exception as e:
+                    log.error('Failed to fetch bytes %d-%d of %s: %s' %
+                            (start, end, key.key, e))
+                    errors.append(e)
+
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    if partial is not None:
+        partial.finish()
+    log.debug('Downloaded %s (%d bytes) to %s.' % (key.key, size, path))
+
+
+class PartialDownload(object):
+    '''The state of a resumable download of key to path: the partial file
+    path.part, and the sidecar path.part.json holding the key's ETag and
+    size and the [start, end) ranges already written. A partial download of
+    a key that has changed since is discarded.'''
+
+    def __init__(self, key, path):
+        import os
+
+        self.key = key
+        self.path = path
+        self.file = path + '.part'
+        self.sidecar = self.file + '.json'
+        self.lock = threading.Lock()
+        self.state = read_sidecar(self.sidecar)
+        if self.state is not None and not os.path.exists(self.file):
+            self.state = None
+        if self.state is not None and (self.state['etag'] != key.etag or
+                self.state['size'] != key.size):
+            log.info('%s changed since it was partly downloaded; starting '
+                    'over.' % key.key)
+            self.state = None
+        if self.state is None:
+            self.discard()
+            self.state = {'key': key.key, 'etag': key.etag,
+                    'size': key.size, 'ranges': []}
+
+    def missing(self):
+        '''Returns the [start, end) ranges not downloaded yet, in order.'''
+        missing = []
+        pos = 0
+        for start, end in self.state['ranges']:
+            if start > pos:
+                missing.append([pos, start])
+            pos = max(pos, end)
+        if pos < self.state['size']:
+            missing.append([pos, self.state['size']])
+        return missing
+
+    def add_range(self, start, end):
+        '''Records that bytes start to end (exclusive) are written.'''
+        with self.lock:
+            ranges = sorted(self.state['ranges'] + [[start, end]])
+            merged = [ranges[0]]
+            for r in ranges[1:]:
+                if r[0] <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], r[1])
+                else:
+                    merged.append(r)
+            self.state['ranges'] = merged
+            self.save()
+
+    def save(self):
+        '''Writes the sidecar, replacing the old one atomically.'''
+        import json
+        import os
+
+        tmp = self.sidecar + '.tmp'
+        with open(tmp, 'w') as outf:
+            json.dump(self.state, outf)
+        os.rename(tmp, self.sidecar)
+
+    def finish(self):
+        '''Moves the complete file to path and removes the sidecar.'''
+        import os
+
+        if self.missing():
+            raise IOError('The download of %s is incomplete.' % self.key.key)
+        os.rename(self.file, self.path)
+        os.remove(self.sidecar)
+
+    def discard(self):
+        '''Removes the partial file and the sidecar.'''
+        import os
+
+        for fp in (self.file, self.sidecar):
+            if os.path.exists(fp):
+                os.remove(fp)
+
+
+def read_sidecar(path):
+    '''Returns the state saved in a partial download's sidecar, or None.'''
+    import json
+
+    try:
+        with open(path) as inf:
+            return json.load(inf)
+    except (IOError, ValueError):
+        return None
+
+
+def fetch_range(key, outf, start, end, retries=3, tuner=None):
+    '''Writes bytes start through end (inclusive) of key to the same
+    offset in outf, retrying on failure, within the download tuner's limit
+    and the bandwidth limit.'''
+    if tuner is None:
+        tuner = throttle.get_tuner('download')
+    for attempt in range(retries):
+        try:
+            outf.seek(start)
+            with tuner.slot():
+                key.get_file(throttle.wrap(outf),
+                        headers={'Range': 'bytes=%d-%d' % (start, end)})
+            if outf.tell() != end + 1:
+                raise IOError('Short read of bytes %d-%d of %s' %
+                        (start, end, key.key))
+            tuner.record(end + 1 - start)
+            return
+        except Exception as e:
+            tuner.record(0, True)
+            key.close()
+            if attempt == retries - 1:
+                raise
+            log.warn('Retrying bytes %d-%d: %s' % (start, end, e))
+
+
+def fetch_data(key, headers=None):
+    '''Returns the contents of key, or the range given in headers, within
+    the download tuner's limit and the bandwidth limit.'''
+    tuner = throttle.get_tuner('download')
+    try:
+        with tuner.slot():
+            data = key.get_contents_as_string(headers=headers)
+    except Exception:
+        tuner.record(0, True)
+        raise
+    throttle.consume(len(data))
+    tuner.record(len(data))
+    return data
+
+
+def verify_download(path, expected_hash):
+    '''Returns True if the MD5 hash of the file at path matches
+    expected_hash.'''
+    from encrypt import get_file_hash
+
+    actual = get_file_hash(path, use_cache=False)
+    if actual != expected_hash:
+        log.error('Hash mismatch for %s: expected %s, got %s' % (path,
+                expected_hash, actual))
+        return False
+    return True
+
+
+class PrefetchReader(object):
+    '''A read-only file object over the contents of key. A background
+    thread downloads up to depth pieces of piece_size bytes ahead of the
+    reader, so the download continues while the data is being used. It
+    keeps to the bandwidth limit.'''
+
+    def __init__(self, key, piece_size=1024 * 1024, depth=8):
+        self.key = key
+        self.piece_size = piece_size
+        self.pieces = queue.Queue(depth)
+        self.buf = b''
+        self.eof = False
+        self.thread = threading.Thread(target=self._download)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _download(self):
+        try:
+            while True:
+                with metrics.timed('download', io=True):
+                    data = self.key.read(self.piece_size)
+                metrics.add('download', len(data))
+                throttle.consume(len(data))
+                self.pieces.put(data)
+                if not data:
+                    return
+        except Exception as e:
+            log.error('Failed to download %s: %s' % (self.key.key, e))
+            self.pieces.put(e)
+
+    def read(self, size=-1):
+        while not self.eof and (size is None or size < 0 or
+                len(self.buf) < size):
+            data = self.pieces.get()
+            if isinstance(data, Exception):
+                raise data
+            if not data:
+                self.eof = True
+            self.buf += data
+        if size is None or size < 0:
+            size = len(self.buf)
+        data = self.buf[:size]
+        self.buf = self.buf[size:]
+        return data
@@ -15,24 +15,68 @@
 # limitations under the License.
 
 
-version = '0.4'
+version = '0.5'
 
 import struct
+from collections import deque
+
 import log
+import metrics
 
 
 log = log.get_logger('encrypt')
 
+# pycrypto before 2.6 defaulted to an all-zero IV for CBC; archives have
+# always been written that way, so pass it explicitly.
+CBC_IV = b'\0' * 16
+
+# Written in place of the file size by EncryptingWriter, which can't know
+# the size up front. The real size follows the ciphertext.
+STREAM_SIZE = 0xFFFFFFFFFFFFFFFF
+
+# Format 2 files are cut into segments that are encrypted with AES-CTR and
+# authenticated with HMAC-SHA256 independently, so they can be processed
+# in parallel:
+#
+#   header   MAGIC, version, segment size, nonce
+#   segments each the encrypted segment followed by its tag; only the
+#            last is shorter than the segment size, and it may be empty
+#
+# Each segment's counter starts where the previous one's ended. Its tag
+# covers the header, its number, whether it is the last, and the
+# ciphertext, so segments can't be changed, reordered or dropped. Format 1
+# files (AES-CBC) start with their size instead; read as a size MAGIC
+# would be over 2 ** 63 bytes.
+MAGIC = b'S3ENC\xff\xff\xfe'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sBI8s')
+TAG_SIZE = 32
+
 
-def encrypt_file(key, filename, piece_size):
+def encrypt_file(key, filename, piece_size, segment_size=None,
+        workers=None):
+    '''Encrypts a file to filename.enc and returns that name. With
+    segment_size the file is written in format 2, using workers processes;
+    otherwise in format 1.'''
     import os
     from Crypto.Cipher import AES
 
-    encryptor = AES.new(key, AES.MODE_CBC)
+    enc_file = filename + '.enc'
+    if segment_size is not None:
+        writer = SegmentEncryptingWriter(key, open(enc_file, 'wb'),
+                segment_size, workers)
+        try:
+            with open(filename, 'rb') as inf:
+                for piece in iter(lambda: inf.read(segment_size), b''):
+                    writer.write(piece)
+        finally:
+            writer.close()
+        return enc_file
+
+    encryptor = AES.new(key, AES.MODE_CBC, CBC_IV)
     # Store the file size for when we decrypt
     fsize = os.path.getsize(filename)
-    enc_file = filename + '.enc'
-    
+
     with open(filename, 'rb') as inf:
         with open(enc_file, 'wb') as outf:
             outf.write(struct.pack('<Q', fsize))
@@ -48,35 +92,442 @@ def encrypt_file(key, filename, piece_size):
                         # For Python 3 - TODO: Test decryptor
                         piece += bytes(' ',
                                 'ascii') * (16 - len(piece) % 16)
-                outf.write(encryptor.encrypt(piece))
+                with metrics.timed('encrypt', len(piece)):
+                    piece = encryptor.encrypt(piece)
+                outf.write(piece)
     return enc_file
 
 
-def decrypt_file(key, encrypted_file, decrypted_file, piece_size):
-    '''Decrypts and writes a file. Returns True on success, False on fail'''
+def decrypt_file(key, encrypted_file, decrypted_file, piece_size,
+        workers=None):
+    '''Decrypts and writes a file in either format. Returns True on success,
+    False on fail'''
 
     from Crypto.Cipher import AES
 
     try:
         with open(encrypted_file, 'rb') as inf:
-            size = struct.unpack('<Q', inf.read(struct.calcsize('Q')))[0]
-            decryptor = AES.new(key, AES.MODE_CBC)
+            header = inf.read(struct.calcsize('Q'))
+            if header == MAGIC:
+                reader = SegmentDecryptingReader(key, inf, workers)
+                with open(decrypted_file, 'wb') as outf:
+                    for piece in iter(lambda: reader.read(piece_size), b''):
+                        outf.write(piece)
+                return True
+            size = struct.unpack('<Q', header)[0]
+            end = None
+            if size == STREAM_SIZE:
+                # Streamed archive; the size is stored after the data
+                inf.seek(-struct.calcsize('Q'), 2)
+                end = inf.tell()
+                size = struct.unpack('<Q', inf.read(struct.calcsize('Q')))[0]
+                inf.seek(struct.calcsize('Q'))
+            decryptor = AES.new(key, AES.MODE_CBC, CBC_IV)
 
             with open(decrypted_file, 'wb') as outf:
                 while True:
-                    piece = inf.read(piece_size)
+                    if end is not None:
+                        piece = inf.read(min(piece_size, end - inf.tell()))
+                    else:
+                        piece = inf.read(piece_size)
                     if not piece:
                         break
-                    outf.write(decryptor.decrypt(piece))
+                    with metrics.timed('decrypt', len(piece)):
+                        piece = decryptor.decrypt(piece)
+                    outf.write(piece)
                 outf.truncate(size)
         return True
+    except IOError as e:
+        log.error(str(e))
+        return False
     except:
         return False
 
 
-def get_file_hash(file, algorithm='MD5'):
+def encrypt_data(key, data):
+    '''Encrypts a string with AES-CBC and a random IV. The result holds the
+    size, the IV and the ciphertext.'''
+    import os
+    from Crypto.Cipher import AES
+
+    iv = os.urandom(16)
+    size = len(data)
+    if size % 16 != 0:
+        data += b' ' * (16 - size % 16)
+    return (struct.pack('<Q', size) + iv +
+            AES.new(key, AES.MODE_CBC, iv).encrypt(data))
+
+
+def decrypt_data(key, data):
+    '''Decrypts a string encrypted by encrypt_data.'''
+    from Crypto.Cipher import AES
+
+    size = struct.unpack('<Q', data[:8])[0]
+    iv = data[8:24]
+    return AES.new(key, AES.MODE_CBC, iv).decrypt(data[24:])[:size]
+
+
+def derive_keys(key):
+    '''Returns the AES key and the HMAC key of format 2, derived from the
+    encryption key so that neither is used for both.'''
+    import hashlib
+    import hmac
+
+    return (hmac.new(key, b'encrypt', hashlib.sha256).digest(),
+            hmac.new(key, b'authenticate', hashlib.sha256).digest())
+
+
+def segment_tag(mac_key, header, number, last, ciphertext):
+    import hashlib
+    import hmac
+
+    mac = hmac.new(mac_key, header, hashlib.sha256)
+    mac.update(struct.pack('<QB', number, last))
+    mac.update(ciphertext)
+    return mac.digest()
+
+
+def segment_cipher(aes_key, header, number):
+    '''Returns the AES-CTR cipher for the given segment.'''
+    from Crypto.Cipher import AES
+    from Crypto.Util import Counter
+
+    segment_size, nonce = HEADER.unpack(header)[2:]
+    counter = Counter.new(64, prefix=nonce,
+            initial_value=number * (segment_size // 16))
+    return AES.new(aes_key, AES.MODE_CTR, counter=counter)
+
+
+def encrypt_segment(keys, header, number, last, data):
+    '''Encrypts a format 2 segment and returns it followed by its tag.'''
+    data = segment_cipher(keys[0], header, number).encrypt(data)
+    return data + segment_tag(keys[1], header, number, last, data)
+
+
+def decrypt_segment(keys, header, number, last, data):
+    '''Checks the tag of a format 2 segment and decrypts it. If last is
+    None, the segment may or may not be the last one. Raises IOError if
+    the segment is not authentic.'''
+    import hmac
+
+    if len(data) < TAG_SIZE:
+        raise IOError('The encrypted file is truncated.')
+    ciphertext, tag = data[:-TAG_SIZE], data[-TAG_SIZE:]
+    if last is None:
+        choices = (False, True)
+    else:
+        choices = (last,)
+    for choice in choices:
+        if hmac.compare_digest(tag, segment_tag(keys[1], header, number,
+                choice, ciphertext)):
+            return segment_cipher(keys[0], header, number).decrypt(
+                    ciphertext)
+    raise IOError('Segment %d of the encrypted file is damaged or was '
+            'changed.' % number)
+
+
+class EncryptingWriter(object):
+    '''A write-only file object that encrypts everything written to it and
+    passes the result on to fileobj. The output has the same format as
+    encrypt_file, except that the size is written after the data, so it
+    can be decrypted with decrypt_file.'''
+
+    def __init__(self, key, fileobj, piece_size):
+        from Crypto.Cipher import AES
+
+        self.fileobj = fileobj
+        self.piece_size = piece_size
+        self.encryptor = AES.new(key, AES.MODE_CBC, CBC_IV)
+        self.size = 0
+        self.buf = b''
+        self.closed = False
+        self.fileobj.write(struct.pack('<Q', STREAM_SIZE))
+
+    def write(self, data):
+        self.size += len(data)
+        self.buf += data
+        if len(self.buf) >= self.piece_size:
+            # Encrypt as much as we can; CBC needs whole 16-byte blocks
+            cut = len(self.buf) - len(self.buf) % 16
+            with metrics.timed('encrypt', cut):
+                data = self.encryptor.encrypt(self.buf[:cut])
+            self.fileobj.write(data)
+            self.buf = self.buf[cut:]
+
+    def close(self):
+        '''Pads and encrypts the remaining data, writes the size and
+        closes fileobj.'''
+        if self.closed:
+            return
+        self.closed = True
+        if len(self.buf) % 16 != 0:
+            self.buf += b' ' * (16 - len(self.buf) % 16)
+        if self.buf:
+            self.fileobj.write(self.encryptor.encrypt(self.buf))
+        self.buf = b''
+        self.fileobj.write(struct.pack('<Q', self.size))
+        self.fileobj.close()
+
+
+class SegmentEncryptingWriter(object):
+    '''A write-only file object that encrypts everything written to it in
+    format 2 and passes the result on to fileobj. Segments are encrypted
+    on a pool of worker processes.'''
+
+    def __init__(self, key, fileobj, segment_size, workers=None):
+        import multiprocessing
+        import os
+        from pcompress import get_pool
+
+        if segment_size % 16 != 0:
+            raise ValueError('The segment size must be a multiple of 16.')
+        self.fileobj = fileobj
+        self.keys = derive_keys(key)
+        self.segment_size = segment_size
+        self.header = HEADER.pack(MAGIC, FORMAT_VERSION, segment_size,
+                os.urandom(8))
+        self.pool = get_pool(workers)
+        self.max_pending = 2 * (workers or multiprocessing.cpu_count())
+        self.pending = deque()
+        self.number = 0
+        self.buf = b''
+        self.closed = False
+        self.fileobj.write(self.header)
+
+    def _start_segment(self, data, last=False):
+        metrics.add('encrypt', len(data), 1)
+        self.pending.append(self.pool.apply_async(encrypt_segment,
+                (self.keys, self.header, self.number, last, data)))
+        self.number += 1
+        while len(self.pending) > self.max_pending:
+            self._write_segment()
+
+    def _write_segment(self):
+        # Only the wait counts; the writing is the next stage's
+        with metrics.timed('encrypt'):
+            data = self.pending.popleft().get()
+        self.fileobj.write(data)
+
+    def write(self, data):
+        self.buf += data
+        # Hold back a whole segment; the last one has to be marked
+        while len(self.buf) > self.segment_size:
+            self._start_segment(self.buf[:self.segment_size])
+            self.buf = self.buf[self.segment_size:]
+
+    def close(self):
+        '''Encrypts the last segment, waits for the rest and closes
+        fileobj.'''
+        if self.closed:
+            return
+        self.closed = True
+        self._start_segment(self.buf, True)
+        self.buf = b''
+        while self.pending:
+            self._write_segment()
+        self.fileobj.close()
+
+
+class SegmentDecryptingReader(object):
+    '''A read-only file object that decrypts format 2 as it reads it from
+    fileobj, which is past MAGIC. Segments are read ahead and decrypted on
+    a pool of worker processes.'''
+
+    def __init__(self, key, fileobj, workers=None):
+        import multiprocessing
+        from pcompress import get_pool
+
+        self.fileobj = fileobj
+        self.keys = derive_keys(key)
+        rest = read_fully(fileobj, HEADER.size - len(MAGIC))
+        if len(rest) != HEADER.size - len(MAGIC):
+            raise IOError('The encrypted file is truncated.')
+        self.header = MAGIC + rest
+        file_version, self.segment_size = HEADER.unpack(self.header)[1:3]
+        if file_version > FORMAT_VERSION:
+            raise IOError('Encryption format %d is not supported.' %
+                    file_version)
+        self.pool = get_pool(workers)
+        self.max_pending = 2 * (workers or multiprocessing.cpu_count())
+        self.pending = deque()
+        self.number = 0
+        self.next = read_fully(fileobj, self.segment_size + TAG_SIZE)
+        self.eof = False
+        self.buf = b''
+
+    def _fill(self):
+        '''Reads segments and starts decrypting them until max_pending are
+        in flight or the last segment has been read.'''
+        while len(self.pending) < self.max_pending and not self.eof:
+            data = self.next
+            self.next = read_fully(self.fileobj,
+                    self.segment_size + TAG_SIZE)
+            # Only the last segment isn't followed by another
+            self.eof = not self.next
+            self.pending.append(self.pool.apply_async(decrypt_segment,
+                    (self.keys, self.header, self.number, self.eof, data)))
+            self.number += 1
+
+    def read(self, size=-1):
+        chunks = [self.buf]
+        available = len(self.buf)
+        while size is None or size < 0 or available < size:
+            self._fill()
+            if not self.pending:
+                break
+            with metrics.timed('decrypt', items=1):
+                data = self.pending.popleft().get()
+            metrics.add('decrypt', len(data))
+            chunks.append(data)
+            available += len(data)
+        data = b''.join(chunks)
+        if size is None or size < 0:
+            size = len(data)
+        self.buf = data[size:]
+        return data[:size]
+
+
+def read_fully(fileobj, size):
+    '''Reads size bytes from fileobj, or fewer only at the end of it.'''
+    data = b''
+    while len(data) < size:
+        piece = fileobj.read(size - len(data))
+        if not piece:
+            break
+        data += piece
+    return data
+
+
+def open_decrypting_reader(key, fileobj, piece_size, workers=None):
+    '''Returns a read-only file object that decrypts fileobj, in either
+    format.'''
+    header = read_fully(fileobj, len(MAGIC))
+    if header == MAGIC:
+        return SegmentDecryptingReader(key, fileobj, workers)
+    return DecryptingReader(key, fileobj, piece_size, header)
+
+
+class DecryptingReader(object):
+    '''A read-only file object that decrypts the output of encrypt_file or
+    EncryptingWriter (format 1) as it reads it from fileobj. header is
+    whatever has already been read from fileobj.'''
+
+    def __init__(self, key, fileobj, piece_size, header=b''):
+        from Crypto.Cipher import AES
+
+        self.fileobj = fileobj
+        self.piece_size = piece_size
+        self.decryptor = AES.new(key, AES.MODE_CBC, CBC_IV)
+        while len(header) < 8:
+            data = fileobj.read(8 - len(header))
+            if not data:
+                raise IOError('The encrypted file is truncated.')
+            header += data
+        self.size = struct.unpack('<Q', header)[0]
+        # A streamed file's size is in its last 8 bytes, so that much
+        # ciphertext is held back until the end.
+        self.streamed = self.size == STREAM_SIZE
+        self.ciphertext = b''
+        self.buf = b''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        hold = 8 if self.streamed else 0
+        while len(self.buf) < size + 16 and not self.eof:
+            data = self.fileobj.read(self.piece_size)
+            if not data:
+                self.eof = True
+                if self.streamed:
+                    if len(self.ciphertext) != 8:
+                        raise IOError('The encrypted file is truncated.')
+                    self.size = struct.unpack('<Q', self.ciphertext)[0]
+                break
+            self.ciphertext += data
+            usable = len(self.ciphertext) - hold
+            usable -= usable % 16
+            if usable > 0:
+                with metrics.timed('decrypt', usable):
+                    self.buf += self.decryptor.decrypt(
+                            self.ciphertext[:usable])
+                self.ciphertext = self.ciphertext[usable:]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while not self.eof:
+                self._fill(len(self.buf) + self.piece_size)
+            size = len(self.buf)
+        else:
+            self._fill(size)
+        if self.eof or not self.streamed:
+            # Drop the padding
+            available = min(len(self.buf), self.size - self.pos)
+        else:
+            # The last block may be padding; keep it until the size is
+            # known.
+            available = len(self.buf) - 16
+        data = self.buf[:max(0, min(size, available))]
+        self.buf = self.buf[len(data):]
+        self.pos += len(data)
+        return data
+
+
+class HashingWriter(object):
+    '''A write-only file object that hashes everything written to it before
+    passing it on to fileobj.'''
+
+    def __init__(self, fileobj, algorithm='MD5'):
+        self.fileobj = fileobj
+        self.hash = new_hash(algorithm)
+
+    def write(self, data):
+        self.hash.update(data)
+        self.fileobj.write(data)
+
+    def close(self):
+        self.fileobj.close()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class HashingReader(object):
+    '''A read-only file object that hashes everything read from fileobj.'''
+
+    def __init__(self, fileobj, algorithm='MD5'):
+        self.fileobj = fileobj
+        self.hash = new_hash(algorithm)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        with metrics.timed('hash', len(data)):
+            self.hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def new_hash(algorithm='MD5'):
+    '''Returns a new hash object for the given algorithm. Supported
+    algorithms are the same as get_file_hash.'''
+    if algorithm == 'SHA256':
+        from Crypto.Hash import SHA256
+        return SHA256.new()
+    elif algorithm == 'SHA512':
+        from Crypto.Hash import SHA512
+        return SHA512.new()
+    elif algorithm == 'MD5':
+        from Crypto.Hash import MD5
+        return MD5.new()
+    else:
+        raise ValueError('Unsupported hash algorithm: %s' % algorithm)
+
+
+def get_file_hash(file, algorithm='MD5', use_cache=True):
     '''Returns a hexadecimal hash of the given file. Currently supported
-    algorithms are "SHA256", "SHA512" and "MD5"'''
+    algorithms are "SHA256", "SHA512" and "MD5". Unless use_cache is
+    False, hashes of unchanged files come from the hash cache.'''
 
     def getSHA256(file):
         '''Returns a hexadecimal-format SHA256 hash.'''
@@ -117,12 +568,54 @@ def get_file_hash(file, algorithm='MD5'):
         
         return hash.hexdigest()
    
+    if algorithm not in ('SHA256', 'SHA512', 'MD5'):
+        log.error('Unsupported hash algorithm given.')
+        return None
+
     if algorithm == 'SHA256':
-        return getSHA256(file)
+        compute = getSHA256
     elif algorithm == 'SHA512':
-        return getSHA512(file)
-    elif algorithm == 'MD5':
-        return getMD5(file)
+        compute = getSHA512
     else:
-        log.error('Unsupported hash algorithm given.')
-        return None
+        compute = getMD5
+    return cached_hash(file, algorithm, compute, use_cache)
+
+
+def get_multipart_etag(file, part_size, use_cache=True):
+    '''Returns the ETag S3 gives the file when it is uploaded in parts of
+    part_size bytes: the MD5 of the parts' MD5s, a dash and the number of
+    parts.'''
+    from Crypto.Hash import MD5
+
+    def compute(file):
+        digests = []
+        with open(file, 'rb') as f:
+            for part in iter(lambda: f.read(part_size), b''):
+                digests.append(MD5.new(part).digest())
+        return '%s-%d' % (MD5.new(b''.join(digests)).hexdigest(),
+                len(digests))
+
+    return cached_hash(file, 'ETAG-%d' % part_size, compute, use_cache)
+
+
+def cached_hash(file, algorithm, compute, use_cache=True):
+    '''Returns compute(file), or the hash cache's copy of it if the file
+    hasn't changed. algorithm names the kind of hash in the cache.'''
+    cache = None
+    if use_cache:
+        from hashcache import get_cache
+        cache = get_cache()
+    if cache is not None:
+        import os
+        st = os.stat(file)
+        hash = cache.get(st, algorithm)
+        if hash is not None:
+            return hash
+
+    import os
+    with metrics.timed('hash', os.path.getsize(file), 1):
+        hash = compute(file)
+
+    if cache is not None:
+        cache.put(file, st, algorithm, hash)
+    return hash
@@ -0,0 +1,534 @@
+# fakes3.py - A local S3 stand-in for benchmarks
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# FakeS3 serves the part of the S3 REST API the suite uses (buckets,
+# objects with metadata and ranged GETs, copies, listings and multipart
+# uploads, with parts copied from other objects)
+# over HTTP from threads of the calling process. Point s3_host and s3_port
+# at it. Objects are kept as files under a directory rather than in
+# memory, so they don't add to the memory used by what is being measured,
+# but its threads' CPU time does count against the process.
+
+version = '0.1'
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+import log
+
+log = log.get_logger('fakes3')
+
+# Request and response bodies are copied in pieces of this size
+COPY_SIZE = 1024 * 1024
+
+ISO_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+HTTP_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
+
+
+class FakeS3(ThreadingMixIn, HTTPServer):
+    '''An S3 endpoint on host and port (any free port by default) keeping
+    its objects under root, or a temporary directory removed by stop.'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root=None, host='localhost', port=0):
+        HTTPServer.__init__(self, (host, port), Handler)
+        self.host, self.port = self.server_address[:2]
+        self.own_root = root is None
+        self.root = root or tempfile.mkdtemp(prefix='fakes3-')
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.lock = threading.Lock()
+        # bucket: {key: (file, size, etag, mtime, headers)}
+        self.buckets = {}
+        # upload id: (bucket, key, headers, started, {number: (file, size,
+        # etag)})
+        self.uploads = {}
+        # The sockets of open connections, which stop closes
+        self.connections = set()
+        self.thread = None
+
+    def start(self):
+        '''Serves requests from a background thread.'''
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        log.debug('Fake S3 listening on %s:%d.' % (self.host, self.port))
+        return self
+
+    def stop(self):
+        import socket
+
+        self.shutdown()
+        self.server_close()
+        # Otherwise the threads of kept-alive connections wait for another
+        # request until the interpreter exits
+        with self.lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if self.own_root:
+            shutil.rmtree(self.root, True)
+
+    def new_file(self):
+        '''Returns the path of a new file under root.'''
+        return os.path.join(self.root, uuid.uuid4().hex)
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''Handles one connection to FakeS3 as S3 would, with path-style
+    bucket names.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections.add(self.request)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.request)
+        BaseHTTPRequestHandler.finish(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        '''Splits the request into bucket, key and query.'''
+        from urllib import unquote
+
+        url = urlparse(self.path)
+        parts = unquote(url.path).lstrip('/').split('/', 1)
+        self.bucket = parts[0]
+        self.key = parts[1] if len(parts) > 1 else ''
+        self.query = dict((k, v[0]) for k, v in parse_qs(url.query,
+                keep_blank_values=True).items())
+
+    def do_HEAD(self):
+        self.parse()
+        self.read_body()
+        if self.key:
+            self.get_object(False)
+        elif self.bucket in self.server.buckets:
+            self.reply(200)
+        else:
+            self.reply(404)
+
+    def do_GET(self):
+        self.parse()
+        self.read_body()
+        if not self.key:
+            if self.bucket not in self.server.buckets:
+                return self.error(404, 'NoSuchBucket')
+            if 'uploads' in self.query:
+                return self.list_uploads()
+            if 'location' in self.query:
+                return self.reply(200, '<LocationConstraint/>')
+            return self.list_objects()
+        if 'uploadId' in self.query:
+            return self.list_parts()
+        self.get_object(True)
+
+    def do_PUT(self):
+        self.parse()
+        if not self.key:
+            self.read_body()
+            with self.server.lock:
+                self.server.buckets.setdefault(self.bucket, {})
+            return self.reply(200, headers={'Location': '/' + self.bucket})
+        if self.bucket not in self.server.buckets:
+            self.read_body()
+            return self.error(404, 'NoSuchBucket')
+        if 'x-amz-copy-source' in self.headers:
+            self.read_body()
+            return self.copy_object()
+        path, size, etag = self.save_body()
+        if etag is None:
+            return self.error(400, 'BadDigest')
+        if 'uploadId' in self.query:
+            if not self.add_part(path, size, etag):
+                return self.error(404, 'NoSuchUpload')
+            return self.reply(200, headers={'ETag': etag})
+        self.store(path, size, etag, self.object_headers())
+        self.reply(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        self.parse()
+        body = self.read_body()
+        if 'uploads' in self.query:
+            upload_id = uuid.uuid4().hex
+            with self.server.lock:
+                self.server.uploads[upload_id] = (self.bucket, self.key,
+                        self.object_headers(), time.time(), {})
+            return self.reply(200, '<InitiateMultipartUploadResult>'
+                    '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                    '</InitiateMultipartUploadResult>' % (escape(self.bucket),
+                    escape(self.key), upload_id))
+        if 'uploadId' in self.query:
+            return self.complete_upload(body)
+        self.error(400, 'InvalidRequest')
+
+    def do_DELETE(self):
+        self.parse()
+        self.read_body()
+        if 'uploadId' in self.query:
+            with self.server.lock:
+                upload = self.server.uploads.pop(self.query['uploadId'], None)
+            if upload is None:
+                return self.error(404, 'NoSuchUpload')
+            for path, size, etag in upload[4].values():
+                os.remove(path)
+            return self.reply(204)
+        with self.server.lock:
+            entry = self.server.buckets.get(self.bucket, {}).pop(self.key,
+                    None)
+        if entry is not None:
+            os.remove(entry[0])
+        self.reply(204)
+
+    # Requests
+
+    def get_object(self, send_body):
+        import re
+
+        with self.server.lock:
+            entry = self.server.buckets.get(self.bucket, {}).get(self.key)
+            # Open now, in case the object is replaced while it is sent
+            if entry is not None and send_body:
+                inf = open(entry[0], 'rb')
+        if entry is None:
+            if not send_body:
+                return self.reply(404)
+            return self.error(404, 'NoSuchKey')
+        path, size, etag, mtime, headers = entry
+        headers = dict(headers)
+        headers['ETag'] = etag
+        headers['Last-Modified'] = time.strftime(HTTP_FORMAT,
+                time.gmtime(mtime))
+        headers['Accept-Ranges'] = 'bytes'
+        start, end = 0, size - 1
+        status = 200
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range',
+                ''))
+        if match and size:
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start > end:
+                if send_body:
+                    inf.close()
+                return self.error(416, 'InvalidRange')
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+        if not send_body:
+            return
+        with inf:
+            inf.seek(start)
+            left = end + 1 - start
+            while left > 0:
+                data = inf.read(min(COPY_SIZE, left))
+                if not data:
+                    break
+                self.wfile.write(data)
+                left -= len(data)
+
+    def copy_object(self):
+        '''Copies the object named by x-amz-copy-source to the key, or the
+        range of it in x-amz-copy-source-range to a part of an upload.'''
+        import re
+        from urllib import unquote
+
+        bucket, sep, key = unquote(self.headers['x-amz-copy-source']
+                ).lstrip('/').partition('/')
+        with self.server.lock:
+            entry = self.server.buckets.get(bucket, {}).get(key)
+            if entry is not None:
+                inf = open(entry[0], 'rb')
+        if entry is None:
+            return self.error(404, 'NoSuchKey')
+        source_size = entry[1]
+        start, end = 0, source_size - 1
+        match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get(
+                'x-amz-copy-source-range', ''))
+        if match and 'uploadId' in self.query:
+            start, end = int(match.group(1)), int(match.group(2))
+            if start > end or end >= source_size:
+                inf.close()
+                return self.error(400, 'InvalidArgument')
+        path = self.server.new_file()
+        md5 = hashlib.md5()
+        with inf:
+            with open(path, 'wb') as outf:
+                inf.seek(start)
+                left = end + 1 - start
+                while left > 0:
+                    data = inf.read(min(COPY_SIZE, left))
+                    if not data:
+                        break
+                    md5.update(data)
+                    outf.write(data)
+                    left -= len(data)
+        size = end + 1 - start
+        etag = '"%s"' % md5.hexdigest()
+        if 'uploadId' in self.query:
+            if not self.add_part(path, size, etag):
+                return self.error(404, 'NoSuchUpload')
+            result = 'CopyPartResult'
+        else:
+            if self.headers.get('x-amz-metadata-directive',
+                    'COPY').upper() == 'REPLACE':
+                headers = self.object_headers()
+            else:
+                headers = entry[4]
+            self.store(path, size, etag, headers)
+            result = 'CopyObjectResult'
+        self.reply(200, '<%s><LastModified>%s</LastModified><ETag>%s</ETag>'
+                '</%s>' % (result, time.strftime(ISO_FORMAT, time.gmtime()),
+                escape(etag), result))
+
+    def list_objects(self):
+        prefix = self.query.get('prefix', '')
+        delimiter = self.query.get('delimiter', '')
+        marker = self.query.get('marker', '')
+        max_keys = int(self.query.get('max-keys', 1000))
+        with self.server.lock:
+            names = sorted(name for name in self.server.buckets[self.bucket]
+                    if name.startswith(prefix) and name > marker)
+            entries = dict((name, self.server.buckets[self.bucket][name])
+                    for name in names)
+        contents = []
+        prefixes = []
+        truncated = False
+        last = None
+        for name in names:
+            if len(contents) + len(prefixes) >= max_keys:
+                truncated = True
+                break
+            if delimiter and delimiter in name[len(prefix):]:
+                common = name[:name.index(delimiter, len(prefix)) +
+                        len(delimiter)]
+                if prefixes and prefixes[-1] == common:
+                    continue
+                prefixes.append(common)
+                last = common
+                continue
+            path, size, etag, mtime, headers = entries[name]
+            contents.append('<Contents><Key>%s</Key><LastModified>%s'
+                    '</LastModified><ETag>%s</ETag><Size>%d</Size>'
+                    '<StorageClass>STANDARD</StorageClass></Contents>' % (
+                    escape(name), time.strftime(ISO_FORMAT,
+                    time.gmtime(mtime)), escape(etag), size))
+            last = name
+        body = ['<ListBucketResult><Name>%s</Name><Prefix>%s</Prefix>'
+                '<Marker>%s</Marker><MaxKeys>%d</MaxKeys><IsTruncated>%s'
+                '</IsTruncated>' % (escape(self.bucket), escape(prefix),
+                escape(marker), max_keys, str(truncated).lower())]
+        if truncated and last is not None:
+            body.append('<NextMarker>%s</NextMarker>' % escape(last))
+        body.extend(contents)
+        for common in prefixes:
+            body.append('<CommonPrefixes><Prefix>%s</Prefix>'
+                    '</CommonPrefixes>' % escape(common))
+        body.append('</ListBucketResult>')
+        self.reply(200, ''.join(body))
+
+    def list_uploads(self):
+        prefix = self.query.get('prefix', '')
+        body = ['<ListMultipartUploadsResult><Bucket>%s</Bucket>'
+                '<IsTruncated>false</IsTruncated>' % escape(self.bucket)]
+        with self.server.lock:
+            uploads = sorted(self.server.uploads.items(),
+                    key=lambda item: (item[1][1], item[1][3]))
+        for upload_id, (bucket, key, headers, started, parts) in uploads:
+            if bucket != self.bucket or not key.startswith(prefix):
+                continue
+            body.append('<Upload><Key>%s</Key><UploadId>%s</UploadId>'
+                    '<Initiated>%s</Initiated><StorageClass>STANDARD'
+                    '</StorageClass></Upload>' % (escape(key), upload_id,
+                    time.strftime(ISO_FORMAT, time.gmtime(started))))
+        body.append('</ListMultipartUploadsResult>')
+        self.reply(200, ''.join(body))
+
+    def list_parts(self):
+        with self.server.lock:
+            upload = self.server.uploads.get(self.query['uploadId'])
+            if upload is not None:
+                parts = sorted((number, part[1], part[2]) for number, part in
+                        upload[4].items())
+        if upload is None:
+            return self.error(404, 'NoSuchUpload')
+        marker = int(self.query.get('part-number-marker') or 0)
+        max_parts = int(self.query.get('max-parts', 1000))
+        parts = [part for part in parts if part[0] > marker]
+        truncated = len(parts) > max_parts
+        parts = parts[:max_parts]
+        body = ['<ListPartsResult><Bucket>%s</Bucket><Key>%s</Key>'
+                '<UploadId>%s</UploadId><PartNumberMarker>%d'
+                '</PartNumberMarker><MaxParts>%d</MaxParts><IsTruncated>%s'
+                '</IsTruncated>' % (escape(self.bucket), escape(self.key),
+                self.query['uploadId'], marker, max_parts,
+                str(truncated).lower())]
+        if parts:
+            body.append('<NextPartNumberMarker>%d</NextPartNumberMarker>' %
+                    parts[-1][0])
+        for number, size, etag in parts:
+            body.append('<Part><PartNumber>%d</PartNumber><LastModified>%s'
+                    '</LastModified><ETag>%s</ETag><Size>%d</Size></Part>' % (
+                    number, time.strftime(ISO_FORMAT), escape(etag), size))
+        body.append('</ListPartsResult>')
+        self.reply(200, ''.join(body))
+
+    def complete_upload(self, body):
+        import re
+        from binascii import unhexlify
+
+        numbers = [int(n) for n in re.findall(r'<PartNumber>(\d+)'
+                '</PartNumber>', body)]
+        with self.server.lock:
+            upload = self.server.uploads.get(self.query['uploadId'])
+            if upload is not None and all(n in upload[4] for n in numbers):
+                del self.server.uploads[self.query['uploadId']]
+            else:
+                upload = None
+        if upload is None or not numbers:
+            return self.error(400, 'InvalidPart')
+        bucket, key, headers, started, parts = upload
+        path = self.server.new_file()
+        digests = hashlib.md5()
+        size = 0
+        with open(path, 'wb') as outf:
+            for number in numbers:
+                part_path, part_size, etag = parts.pop(number)
+                digests.update(unhexlify(etag.strip('"')))
+                size += part_size
+                with open(part_path, 'rb') as inf:
+                    shutil.copyfileobj(inf, outf, COPY_SIZE)
+                os.remove(part_path)
+        for part_path, part_size, etag in parts.values():
+            os.remove(part_path)
+        etag = '"%s-%d"' % (digests.hexdigest(), len(numbers))
+        self.store(path, size, etag, headers, bucket, key)
+        self.reply(200, '<CompleteMultipartUploadResult><Location>/%s/%s'
+                '</Location><Bucket>%s</Bucket><Key>%s</Key><ETag>%s</ETag>'
+                '</CompleteMultipartUploadResult>' % (escape(bucket),
+                escape(key), escape(bucket), escape(key), escape(etag)))
+
+    # Helpers
+
+    def object_headers(self):
+        '''Returns the request's headers that are stored with an object.'''
+        headers = {}
+        for name, value in self.headers.items():
+            name = name.lower()
+            if name.startswith('x-amz-meta-') or name in ('content-type',
+                    'content-encoding', 'content-disposition'):
+                headers[name] = value
+        return headers
+
+    def add_part(self, path, size, etag):
+        '''Adds the file at path as the requested part of its upload.
+        Returns False if there is no such upload.'''
+        with self.server.lock:
+            upload = self.server.uploads.get(self.query['uploadId'])
+            if upload is not None:
+                old = upload[4].get(int(self.query['partNumber']))
+                upload[4][int(self.query['partNumber'])] = (path, size, etag)
+        if upload is None:
+            os.remove(path)
+            return False
+        if old is not None:
+            os.remove(old[0])
+        return True
+
+    def store(self, path, size, etag, headers, bucket=None, key=None):
+        bucket = bucket or self.bucket
+        key = key or self.key
+        with self.server.lock:
+            old = self.server.buckets[bucket].get(key)
+            self.server.buckets[bucket][key] = (path, size, etag,
+                    time.time(), headers)
+        if old is not None:
+            os.remove(old[0])
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def save_body(self):
+        '''Writes the request body to a new file. Returns its path, size and
+        ETag; the ETag is None if the body doesn't match its Content-MD5.'''
+        from base64 import b64encode
+
+        left = int(self.headers.get('Content-Length') or 0)
+        path = self.server.new_file()
+        md5 = hashlib.md5()
+        size = left
+        with open(path, 'wb') as outf:
+            while left > 0:
+                data = self.rfile.read(min(COPY_SIZE, left))
+                if not data:
+                    break
+                md5.update(data)
+                outf.write(data)
+                left -= len(data)
+        expected = self.headers.get('Content-MD5')
+        if left or (expected and expected != b64encode(md5.digest())):
+            os.remove(path)
+            return None, None, None
+        return path, size, '"%s"' % md5.hexdigest()
+
+    def reply(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body:
+            body = '<?xml version="1.0" encoding="UTF-8"?>\n' + body
+            self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def error(self, status, code):
+        self.reply(status, '<Error><Code>%s</Code><Message>%s</Message>'
+                '<Resource>/%s/%s</Resource></Error>' % (code, code,
+                escape(self.bucket), escape(self.key)))
+
+
+def start(root=None, host='localhost', port=0):
+    '''Starts a FakeS3 and returns it.'''
+    return FakeS3(root, host, port).start()
@@ -21,3 +21,122 @@ def read_file_list(file_list):
     with open(file_list, 'r') as flist:
         return flist.readlines()
     
+
+def walk_files(paths, follow_links=False):
+    '''Yields a (path, stat) tuple for every regular file or symbolic link
+    in paths, descending into directories.'''
+    import stat
+    from config import scan_workers
+    from scanner import scan
+
+    for path, st in scan(paths, follow_links, scan_workers):
+        if not stat.S_ISDIR(st.st_mode):
+            yield path, st
+
+
+# uid and gid to name lookups can be slow; they're cached here
+_user_names = {}
+_group_names = {}
+
+
+def get_tarinfo(tar, path, st):
+    '''Returns the TarInfo for adding path to tar, like tar.gettarinfo
+    but using a stat the caller already has. Returns None for sockets.'''
+    import os
+    import stat
+    import tarfile
+
+    arcname = os.path.splitdrive(path)[1].replace(os.sep, '/').lstrip('/')
+    tarinfo = tar.tarinfo(arcname)
+    mode = st.st_mode
+    if stat.S_ISREG(mode):
+        tarinfo.type = tarfile.REGTYPE
+        tarinfo.size = st.st_size
+        inode = (st.st_ino, st.st_dev)
+        if (not tar.dereference and st.st_nlink > 1 and
+                tar.inodes.get(inode, arcname) != arcname):
+            # A hard link to a file already in the archive
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = tar.inodes[inode]
+            tarinfo.size = 0
+        elif inode[0]:
+            tar.inodes[inode] = arcname
+    elif stat.S_ISDIR(mode):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(path)
+    elif stat.S_ISFIFO(mode):
+        tarinfo.type = tarfile.FIFOTYPE
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        if stat.S_ISCHR(mode):
+            tarinfo.type = tarfile.CHRTYPE
+        else:
+            tarinfo.type = tarfile.BLKTYPE
+        tarinfo.devmajor = os.major(st.st_rdev)
+        tarinfo.devminor = os.minor(st.st_rdev)
+    else:
+        return None
+
+    tarinfo.mode = mode
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.mtime = st.st_mtime
+    tarinfo.uname = _get_name(_user_names, 'pwd', 'getpwuid', st.st_uid)
+    tarinfo.gname = _get_name(_group_names, 'grp', 'getgrgid', st.st_gid)
+    return tarinfo
+
+
+def _get_name(cache, module, function, id):
+    if id not in cache:
+        try:
+            cache[id] = getattr(__import__(module), function)(id)[0]
+        except (ImportError, KeyError):
+            # No pwd or grp module on Windows
+            cache[id] = ''
+    return cache[id]
+
+
+class FileLock(object):
+    '''An exclusive lock on the file at path, held within a with block.
+    Waits for another process that holds it.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.fileobj = None
+
+    def __enter__(self):
+        import os
+
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self.fileobj = open(self.path, 'a+')
+        try:
+            import fcntl
+        except ImportError:
+            # Windows locks a byte range from the file position
+            import msvcrt
+            import time
+
+            self.fileobj.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.fileobj.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except IOError:
+                    time.sleep(1)
+        else:
+            fcntl.flock(self.fileobj.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            import msvcrt
+        except ImportError:
+            pass
+        else:
+            self.fileobj.seek(0)
+            msvcrt.locking(self.fileobj.fileno(), msvcrt.LK_UNLCK, 1)
+        # Closing the file releases the flock
+        self.fileobj.close()
+        self.fileobj = None
@@ -0,0 +1,146 @@
+# hashcache.py - Persistent cache of file hashes
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Hashes are stored in an SQLite database keyed by the file's device,
+# inode, size, mtime and ctime and the hash algorithm, so any change to
+# the file (including one that restores its mtime) misses the cache.
+# SQLite's locking lets overlapping runs share the cache safely.
+
+version = '0.1'
+
+import sqlite3
+import threading
+import time
+
+import config
+import log
+
+
+log = log.get_logger('hashcache')
+
+_cache = None
+
+
+def get_cache():
+    '''Returns the configured HashCache, or None if caching is disabled.'''
+    global _cache
+    if _cache is None and config.hash_cache:
+        _cache = HashCache(config.hash_cache, config.hash_cache_entries)
+    return _cache
+
+
+def stat_key(st):
+    '''Returns the (device, inode, size, mtime_ns, ctime_ns) of a stat
+    result.'''
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(st.st_mtime * 1000000000)
+    ctime = getattr(st, 'st_ctime_ns', None)
+    if ctime is None:
+        ctime = int(st.st_ctime * 1000000000)
+    return (st.st_dev, st.st_ino, st.st_size, mtime, ctime)
+
+
+class HashCache(object):
+    '''A cache of file hashes that holds at most max_entries; the least
+    recently used entries are evicted first. Each thread gets its own
+    database connection.'''
+
+    # Evict after this many new entries rather than on every insert
+    evict_interval = 1000
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.inserts = 0
+
+    def db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, '
+                    'ino INTEGER, size INTEGER, mtime INTEGER, '
+                    'ctime INTEGER, algorithm TEXT, hash TEXT, '
+                    'used INTEGER, PRIMARY KEY (dev, ino, size, mtime, '
+                    'ctime, algorithm))')
+            db.execute('CREATE INDEX IF NOT EXISTS hashes_used '
+                    'ON hashes (used)')
+            db.commit()
+            self.local.db = db
+        return db
+
+    def get(self, st, algorithm):
+        '''Returns the cached hash for a file's stat result, or None.'''
+        key = stat_key(st) + (algorithm,)
+        try:
+            db = self.db()
+            row = db.execute('SELECT hash, used FROM hashes WHERE dev = ? '
+                    'AND ino = ? AND size = ? AND mtime = ? AND ctime = ? '
+                    'AND algorithm = ?', key).fetchone()
+            if row is None:
+                return None
+            # Only record use once a day to keep lookups read-only
+            today = int(time.time()) // 86400
+            if row[1] < today:
+                db.execute('UPDATE hashes SET used = ? WHERE dev = ? AND '
+                        'ino = ? AND size = ? AND mtime = ? AND ctime = ? '
+                        'AND algorithm = ?', (today,) + key)
+                db.commit()
+            return str(row[0])
+        except sqlite3.Error as e:
+            log.warn('Hash cache lookup failed: %s' % e)
+            return None
+
+    def put(self, path, st, algorithm, hash):
+        '''Caches the hash of the file at path, whose stat result before
+        hashing was st.'''
+        import os
+
+        # If the file changed while it was hashed, or was modified so
+        # recently that another change could keep the same mtime, the
+        # hash can't be trusted later.
+        try:
+            if stat_key(os.stat(path)) != stat_key(st) or \
+                    st.st_mtime >= time.time() - 2:
+                return
+        except OSError:
+            return
+
+        try:
+            db = self.db()
+            db.execute('INSERT OR REPLACE INTO hashes VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?)', stat_key(st) +
+                    (algorithm, hash, int(time.time()) // 86400))
+            db.commit()
+            self.inserts += 1
+            if self.inserts % self.evict_interval == 0:
+                self.evict()
+        except sqlite3.Error as e:
+            log.warn('Cannot update the hash cache: %s' % e)
+
+    def evict(self):
+        '''Removes the least recently used entries beyond max_entries.'''
+        db = self.db()
+        count = db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+        if count > self.max_entries:
+            db.execute('DELETE FROM hashes WHERE rowid IN (SELECT rowid '
+                    'FROM hashes ORDER BY used LIMIT ?)',
+                    (count - self.max_entries,))
+            db.commit()
+            log.debug('Evicted %d hashes.' % (count - self.max_entries))
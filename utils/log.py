@@ -14,61 +14,235 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# With log_queue set, the company logger's only handler puts records on a
+# queue, and a listener thread formats and writes them to the file and
+# console handlers, so callers never wait on either. Loops over files log
+# through FileProgress, which writes all, a sample or none of the
+# per-file debug messages, at most file_log_rate a second, and a summary
+# every progress_interval seconds.
+#
+# Nothing is set up when log is imported: get_logger returns a stand-in that
+# opens the log file and builds the handlers the first time it is used,
+# so that commands which log nothing don't read the config for it.
+
 import logging
 import logging.config
+import threading
+import time
 
-from config import log_file
-from config import company
-from config import log_raise_errs
+import config
 
 # TODO: log handler to email on all failed backups (CRITICAL)
 
-LOGGING = {
-    'version': 1,
-    'formatters': {
-        'withtime': {
-            'format': '%(asctime)s: %(name)-12s (%(lineno)-3d)- %(message)s'
+_configured = False
+_lock = threading.Lock()
+
+
+def logging_config():
+    '''Returns the dictConfig of the handlers.'''
+    return {
+        'version': 1,
+        'formatters': {
+            'withtime': {
+                'format': '%(asctime)s: %(name)-12s (%(lineno)-3d)- '
+                        '%(message)s'
+            },
+            'notime': {
+                'format': '%(name)-12s: %(levelname)-8s %(message)s'
+            }
         },
-        'notime': {
-            'format': '%(name)-12s: %(levelname)-8s %(message)s'
-        }
-    },
-    'handlers': {
-        'tofile': {
-            'level': 'DEBUG', # 'WARN',
-            'class': 'logging.FileHandler',
-            'formatter': 'withtime',
-            'filename': log_file
+        'handlers': {
+            'tofile': {
+                'level': config.log_file_level,
+                'class': 'logging.FileHandler',
+                'formatter': 'withtime',
+                'filename': config.log_file
+            },
+            'toconsole': {
+                'level': config.log_console_level,
+                'class': 'logging.StreamHandler',
+                'formatter': 'notime'
+            }
         },
-        'toconsole': {
-            'level': 'DEBUG',
-            'class': 'logging.StreamHandler',
-            'formatter': 'notime'
-        }
-    },
-    'loggers': {
-        company : {
-            'handlers': ['tofile', 'toconsole'],
-            'level': 'DEBUG'
+        'loggers': {
+            config.company : {
+                'handlers': ['tofile', 'toconsole'],
+                # Nothing below what a handler writes is even made into a
+                # record
+                'level': min(logging.getLevelName(config.log_file_level),
+                        logging.getLevelName(config.log_console_level))
+            }
         }
     }
-}
 
-logging.config.dictConfig(LOGGING)
 
-logging.raiseExceptions = log_raise_errs
+class QueueHandler(logging.Handler):
+    '''Puts each record on a queue for a QueueListener, without formatting
+    it. (Python 2's logging has no QueueHandler.)'''
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    '''Passes the records put on a queue by a QueueHandler to handlers,
+    each keeping to its own level, from a thread.'''
+
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        '''Writes the records still queued and stops the thread.'''
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+
+def start_queue():
+    '''Moves the company logger's handlers behind a QueueListener, which
+    is stopped (writing what is left) at exit.'''
+    import atexit
+    try:
+        import Queue as queue
+    except ImportError:
+        import queue
+
+    logger = logging.getLogger(config.company)
+    records = queue.Queue()
+    listener = QueueListener(records, logger.handlers[:])
+    for handler in listener.handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(records))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class FileProgress(object):
+    '''Logs the files handled by a loop: "verb path." at debug level, as
+    set by file_log, and every progress_interval seconds, and at the end,
+    how many files and bytes have been handled. Safe to use from several
+    threads.'''
+
+    def __init__(self, logger, verb):
+        self.logger = logger
+        self.verb = verb
+        self.every = {'all': 1, 'sample': max(config.file_log_sample, 1),
+                'none': 0}[config.file_log]
+        self.rate = config.file_log_rate
+        self.interval = config.progress_interval
+        self.files = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.start = self.summary_time = self.rate_time = time.time()
+        self.rate_count = 0
+
+    def add(self, path, size=0):
+        '''Counts a file of size bytes, logging it if it is its turn.'''
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            now = time.time()
+            write = (self.every and self.files % self.every == 0 and
+                    self.logger.isEnabledFor(logging.DEBUG))
+            if write and self.rate:
+                if now - self.rate_time >= 1:
+                    self.rate_time = now
+                    self.rate_count = 0
+                write = self.rate_count < self.rate
+                self.rate_count += write
+            summary = (self.interval and
+                    now - self.summary_time >= self.interval)
+            if summary:
+                self.summary_time = now
+                files, size = self.files, self.bytes
+        if write:
+            self.logger.debug('%s %s.' % (self.verb, path))
+        if summary:
+            self.logger.info('%s %d files (%.1f MB) so far; %.0f files/s.' %
+                    (self.verb, files, size / 1048576.0, files /
+                    max(now - self.start, 1e-6)))
+
+    def finish(self):
+        '''Logs the totals.'''
+        elapsed = time.time() - self.start
+        if self.interval or self.every != 1:
+            self.logger.info('%s %d files (%.1f MB) in %.1f s.' % (self.verb,
+                    self.files, self.bytes / 1048576.0, elapsed))
+
+
+def configure():
+    '''Sets up the handlers from the config, once.'''
+    global _configured
+
+    with _lock:
+        if _configured:
+            return
+        logging.config.dictConfig(logging_config())
+        if config.log_queue:
+            start_queue()
+
+        logging.raiseExceptions = config.log_raise_errs
+
+        # Optimize
+        # logging._srcfile = None
+        logging.logThreads = 0
+        logging.logProcesses = 0
+        _configured = True
+
+
+class LazyLogger(object):
+    '''Stands in for the logger called name until it is first used, then
+    configures logging and passes everything to the logger. Its methods
+    are kept once looked up, so later calls cost no more than on the
+    logger itself.'''
+
+    def __init__(self, name):
+        self.name = name
+        self._logger = None
+
+    def __getattr__(self, attr):
+        if self._logger is None:
+            configure()
+            self._logger = logging.getLogger(config.company + '.' +
+                    self.name)
+        value = getattr(self._logger, attr)
+        if callable(value):
+            setattr(self, attr, value)
+        return value
 
-# Optimize
-# logging._srcfile = None
-logging.logThreads = 0
-logging.logProcesses = 0
 
 def get_logger(name):
     '''Returns a logger. Messages propogate to the root handler.'''
-    logger = logging.getLogger(company + '.' + name)
-
-    return logger
+    return LazyLogger(name)
 
 
 if __name__ == '__main__':
-    print(log_file)
+    print(config.log_file)
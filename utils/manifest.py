@@ -0,0 +1,148 @@
+# manifest.py - Reads and writes file manifests used for incremental
+# backups
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A manifest has one line per file: path<TAB>hash<TAB>size<TAB>mtime. Hash
+# files written by older versions only have the first two columns.
+# Deleted files are listed with DELETED as the hash.
+
+version = '0.1'
+
+import os
+
+import log
+
+
+log = log.get_logger('manifest')
+
+DELETED = 'DELETED'
+
+
+def get_state_path(schedule, full=False):
+    '''Returns the path of the manifest recording the state of the tree
+    after the last backup of the given schedule, or after the last full
+    backup if full is True.'''
+    from config import hash_file_path
+
+    if full:
+        return os.path.join(hash_file_path, schedule + '.full.state')
+    return os.path.join(hash_file_path, schedule + '.state')
+
+
+def lock_state(schedule):
+    '''Returns a lock to hold while a backup of the given schedule reads
+    and records the state of the tree, so that runs of one schedule don't
+    overlap.'''
+    from config import hash_file_path
+    from filesystem import FileLock
+
+    return FileLock(os.path.join(hash_file_path, schedule + '.lock'))
+
+
+def read_manifest(path):
+    '''Reads a manifest and returns a dict of path: (hash, size, mtime).
+    Size and mtime are None for lines without them. Returns an empty dict
+    if the manifest doesn't exist.'''
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+
+    with open(path, 'r') as mf:
+        for line in mf:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 4:
+                entries[fields[0]] = (fields[1], int(fields[2]),
+                        float(fields[3]))
+            elif len(fields) >= 2:
+                entries[fields[0]] = (fields[1], None, None)
+    return entries
+
+
+def write_manifest(path, entries):
+    '''Writes a dict of path: (hash, size, mtime) to a manifest. The file
+    is replaced atomically so a failed run leaves the old one intact.'''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as mf:
+        for name in sorted(entries):
+            hash, size, mtime = entries[name]
+            mf.write('%s\t%s\t%d\t%r\n' % (name, hash, size, mtime))
+    os.rename(tmp, path)
+
+
+class ManifestWriter(object):
+    '''Appends path<TAB>hash lines to a hash file through a single buffered
+    file handle.'''
+
+    def __init__(self, path):
+        self.mf = open(path, 'a', 1024 * 1024)
+
+    def add(self, path, hash):
+        self.mf.write('%s\t%s\n' % (path, hash))
+
+    def close(self):
+        self.mf.close()
+
+
+def find_changes(paths, reference, follow_links, hash_changed=True):
+    '''Compares the files under paths against a reference manifest.
+    Files whose size and mtime match are assumed unchanged; otherwise the
+    file is hashed and compared. If hash_changed is False, such files are
+    reported as changed without being read and their hash is None.
+    Returns a tuple of the new state, the list of new or changed files and
+    the list of deleted files.'''
+    import stat
+    from filesystem import walk_files
+    from encrypt import get_file_hash
+
+    state = {}
+    changed = []
+    for path, st in walk_files(paths, follow_links):
+        old = reference.get(path)
+        if old is not None and old[1] == st.st_size and \
+                old[2] == st.st_mtime:
+            state[path] = old
+            continue
+
+        if not hash_changed:
+            state[path] = (None, st.st_size, st.st_mtime)
+            changed.append(path)
+            continue
+        if stat.S_ISREG(st.st_mode):
+            hash = get_file_hash(path)
+        else:
+            # Links are compared by their target
+            hash = 'link:' + os.readlink(path)
+        state[path] = (hash, st.st_size, st.st_mtime)
+        if old is None or old[0] != hash:
+            changed.append(path)
+
+    deleted = sorted(name for name in reference if name not in state)
+    log.debug('%d files, %d changed, %d deleted.' % (len(state),
+            len(changed), len(deleted)))
+    return state, changed, deleted
+
+
+def fill_hashes(state, hash_file):
+    '''Fills in the missing hashes in state from the hash file written
+    while archiving. Files that weren't archived are dropped.'''
+    archived = read_manifest(hash_file)
+    for path, (hash, size, mtime) in list(state.items()):
+        if hash is not None:
+            continue
+        if path in archived:
+            state[path] = (archived[path][0], size, mtime)
+        else:
+            del state[path]
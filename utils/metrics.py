@@ -0,0 +1,256 @@
+# metrics.py - Per-stage counters and timers for each run
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Each stage of a backup or restore (scan, read, hash, compress, encrypt,
+# upload; download, decrypt, decompress, extract) adds the bytes and items
+# it handled, the time it took and how much of that was spent blocked on
+# I/O. Times are summed over the threads doing the stage, so stages that
+# run in parallel, or alongside each other while streaming, can add up to
+# more than the run's wall time. Work done in the compression pool's
+# processes shows up as the time spent waiting for it.
+#
+# At the end of a run, run writes the totals to NAME.json and, for the
+# Prometheus node exporter's textfile collector, NAME.prom in
+# metrics_path.
+
+version = '0.1'
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import log
+
+log = log.get_logger('metrics')
+
+# The fields of each stage, in the order they are kept
+FIELDS = ('bytes', 'items', 'seconds', 'io_seconds')
+
+_stages = {}
+_lock = threading.Lock()
+
+
+def add(stage, size=0, items=0, seconds=0.0, io_seconds=0.0):
+    '''Adds to the totals of stage.'''
+    with _lock:
+        totals = _stages.get(stage)
+        if totals is None:
+            totals = _stages[stage] = [0, 0, 0.0, 0.0]
+        totals[0] += size
+        totals[1] += items
+        totals[2] += seconds
+        totals[3] += io_seconds
+
+
+@contextmanager
+def timed(stage, size=0, items=0, io=False):
+    '''Adds the time the block takes to stage, as time blocked on I/O if
+    io is set, along with size bytes and items items.'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        add(stage, size, items, elapsed, elapsed if io else 0.0)
+
+
+class MeteredFile(object):
+    '''Wraps a file object so that the bytes read from or written to it,
+    and the time that takes, count against stage as I/O. Everything else
+    is passed through.'''
+
+    def __init__(self, fileobj, stage):
+        self.fileobj = fileobj
+        self.stage = stage
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self.fileobj.read(size)
+        elapsed = time.time() - start
+        add(self.stage, len(data), 0, elapsed, elapsed)
+        return data
+
+    def write(self, data):
+        start = time.time()
+        self.fileobj.write(data)
+        elapsed = time.time() - start
+        add(self.stage, len(data), 0, elapsed, elapsed)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def snapshot():
+    '''Returns the totals so far as a dict of stage to a dict of FIELDS.'''
+    with _lock:
+        return dict((stage, dict(zip(FIELDS, totals))) for stage, totals in
+                _stages.items())
+
+
+@contextmanager
+def run(name, labels=None, profile=None):
+    '''Runs the block as a run called name (eg, "s3backup-daily"), then
+    writes the metrics, whether or not it succeeded. labels are added to
+    the report and to each Prometheus sample. profile is None, "cpu" for
+    cProfile (of the main thread only) or "memory" for tracemalloc; its
+    output goes next to the metrics.'''
+    import resource
+
+    started = time.time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime
+    profiler = start_profile(profile)
+    success = False
+    try:
+        yield
+        success = True
+    except SystemExit as e:
+        success = not e.code
+        raise
+    finally:
+        stop_profile(profiler, name)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        report = {'name': name, 'labels': labels or {}, 'started': started,
+                'seconds': time.time() - started, 'success': success,
+                'cpu_seconds': usage.ru_utime + usage.ru_stime - cpu,
+                'peak_rss': usage.ru_maxrss * 1024, 'stages': snapshot()}
+        try:
+            write_report(name, report)
+        except (IOError, OSError) as e:
+            log.error('Cannot write the metrics of %s: %s' % (name, e))
+
+
+def write_report(name, report):
+    '''Writes a report from run to NAME.json and NAME.prom in
+    metrics_path, unless metrics_path is empty.'''
+    import json
+    import config
+
+    if not config.metrics_path:
+        return
+    if not os.path.isdir(config.metrics_path):
+        os.makedirs(config.metrics_path)
+    path = os.path.join(config.metrics_path, name)
+    write_atomic(path + '.json', json.dumps(report, indent=2,
+            sort_keys=True))
+    write_atomic(path + '.prom', prometheus_text(report))
+    log.debug('Wrote the metrics of %s to %s.json and .prom.' % (name,
+            path))
+
+
+def prometheus_text(report):
+    '''Returns a report in the Prometheus text format.'''
+    labels = dict(report['labels'])
+    labels['run'] = report['name']
+    lines = []
+
+    def sample(metric, help, value, extra=None):
+        all_labels = dict(labels)
+        all_labels.update(extra or {})
+        if not any(line.startswith('# HELP %s ' % metric) for line in
+                lines):
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s gauge' % metric)
+        lines.append('%s{%s} %s' % (metric, ','.join('%s="%s"' % (key,
+                escape_label(all_labels[key])) for key in
+                sorted(all_labels)), repr(float(value))))
+
+    sample('s3backup_run_success', 'Whether the last run succeeded.',
+            int(report['success']))
+    sample('s3backup_run_start_time_seconds', 'When the last run started, '
+            'in seconds since the epoch.', report['started'])
+    sample('s3backup_run_seconds', 'The wall time of the last run.',
+            report['seconds'])
+    sample('s3backup_run_cpu_seconds', 'The CPU time of the last run, not '
+            'counting the compression processes.', report['cpu_seconds'])
+    sample('s3backup_run_peak_rss_bytes', 'The most memory the last run '
+            'had resident.', report['peak_rss'])
+    helps = {'bytes': 'Bytes handled by each stage in the last run.',
+            'items': 'Files, blocks or requests handled by each stage in '
+                'the last run.',
+            'seconds': 'Time spent in each stage in the last run, summed '
+                'over threads.',
+            'io_seconds': 'Time each stage spent blocked on I/O in the '
+                'last run, summed over threads.'}
+    for field in FIELDS:
+        for stage in sorted(report['stages']):
+            sample('s3backup_stage_%s' % field, helps[field],
+                    report['stages'][stage][field], {'stage': stage})
+    return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+
+
+def write_atomic(path, text):
+    '''Writes a file so that readers never see it half written.'''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as outf:
+        outf.write(text)
+    os.rename(tmp, path)
+
+
+def start_profile(profile):
+    '''Starts the given profiler (see run) and returns it, or None.'''
+    if profile == 'cpu':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    if profile == 'memory':
+        try:
+            import tracemalloc
+        except ImportError:
+            log.error('tracemalloc is not available on this Python; not '
+                    'profiling memory.')
+            return None
+        tracemalloc.start(25)
+        return tracemalloc
+    return None
+
+
+def stop_profile(profiler, name):
+    '''Stops a profiler from start_profile and writes its output to
+    NAME.prof (cProfile, for pstats) or NAME.tracemalloc (the biggest
+    allocations) in metrics_path, or hash_file_path if there is none.'''
+    import config
+
+    if profiler is None:
+        return
+    directory = config.metrics_path or config.hash_file_path
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, name)
+    if profiler.__class__.__name__ == 'Profile':
+        profiler.disable()
+        profiler.dump_stats(path + '.prof')
+        log.info('Wrote the CPU profile to %s.prof.' % path)
+        return
+    snapshot = profiler.take_snapshot()
+    current, peak = profiler.get_traced_memory()
+    profiler.stop()
+    with open(path + '.tracemalloc', 'w') as outf:
+        outf.write('Peak traced memory: %d bytes; at the end: %d bytes\n\n' %
+                (peak, current))
+        for stat in snapshot.statistics('traceback')[:25]:
+            outf.write('%s\n' % stat)
+            for line in stat.traceback.format():
+                outf.write('%s\n' % line)
+            outf.write('\n')
+    log.info('Wrote the memory profile to %s.tracemalloc.' % path)
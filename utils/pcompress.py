@@ -0,0 +1,375 @@
+# pcompress.py - Parallel block compression (gzip, bzip2, zstd and lz4)
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The data is cut into blocks that are compressed independently in a
+# process pool. Each block is a complete gzip member, bzip2 stream, zstd
+# frame or lz4 frame; concatenated, they are valid files that the usual
+# tools can read. Python 2's bz2 module stops after the first stream, so
+# archives must be read with open_tar.
+#
+# zstd and lz4 need the zstandard and lz4 packages.
+
+version = '0.2'
+
+import bz2
+import zlib
+from collections import deque
+
+import metrics
+
+# The compression methods that use the block compressor, and the codec
+# (also the file extension) each one writes
+PARALLEL = {'pgz': 'gz', 'pbz2': 'bz2', 'zstd': 'zst', 'lz4': 'lz4'}
+
+# The level used for data that won't compress. gzip and lz4 can store it
+# as is; zstd stores incompressible blocks raw but has to try first, and
+# bzip2 has no way to store data.
+STORE_LEVEL = {'gz': 0, 'bz2': 1, 'zst': 1, 'lz4': 0}
+
+# Files smaller than this are always compressed; starting a new block for
+# each would cost more than it saves.
+MIN_SKIP_SIZE = 256 * 1024
+
+_pool = None
+
+
+def get_pool(workers=None):
+    '''Returns the process pool used for compression, starting it if
+    needed. Start it before any threads so they aren't forked with it.'''
+    global _pool
+    import atexit
+    import multiprocessing
+
+    if _pool is None:
+        _pool = multiprocessing.Pool(workers or None)
+        # Runs before multiprocessing terminates the pool
+        atexit.register(finish_pool)
+    return _pool
+
+
+def finish_pool():
+    '''Waits for the tasks still in flight, as after an error, to finish.
+    A worker terminated while sending its result would keep the result
+    queue locked, and terminating the pool would never return.'''
+    _pool.close()
+    _pool.join()
+
+
+def compress_block(codec, level, data):
+    '''Compresses data as one complete gzip member, bzip2 stream, zstd
+    frame or lz4 frame.'''
+    if codec == 'gz':
+        # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif codec == 'bz2':
+        return bz2.compress(data, level)
+    elif codec == 'zst':
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    elif codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress(data, compression_level=level)
+    raise ValueError('Unknown codec %s' % codec)
+
+
+def decompress_block(codec, data):
+    '''Decompresses one block written by compress_block.'''
+    if codec == 'gz':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif codec == 'bz2':
+        return bz2.decompress(data)
+    elif codec == 'zst':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress(data)
+    raise ValueError('Unknown codec %s' % codec)
+
+
+def check_codec(codec):
+    '''Raises ImportError with a useful message if the module a codec
+    needs isn't installed.'''
+    try:
+        if codec == 'zst':
+            import zstandard
+        elif codec == 'lz4':
+            import lz4.frame
+    except ImportError:
+        raise ImportError('The %s compression method needs the %s package.'
+                % (codec, {'zst': 'zstandard', 'lz4': 'lz4'}[codec]))
+
+
+def should_compress(path, size):
+    '''Returns False for files that are most likely already compressed:
+    those with a known extension, or whose samples barely compress.'''
+    import os
+    from config import incompressible_extensions
+
+    if size < MIN_SKIP_SIZE:
+        return True
+    ext = os.path.splitext(path)[1].lower().lstrip('.')
+    if ext in incompressible_extensions:
+        return False
+
+    # Sample 16 KB from the start, middle and end
+    sample_size = 16 * 1024
+    try:
+        with open(path, 'rb') as inf:
+            samples = []
+            for offset in (0, size // 2, size - sample_size):
+                inf.seek(offset)
+                samples.append(inf.read(sample_size))
+    except IOError:
+        return True
+    sample = b''.join(samples)
+    return len(zlib.compress(sample, 1)) < len(sample) * 0.95
+
+
+class ParallelCompressor(object):
+    '''A write-only file object that compresses what is written to it in
+    blocks of block_size bytes on a pool of workers processes, writing the
+    blocks to fileobj in order. Up to 2 * workers blocks are in flight.
+    set_compress(False) switches to storing data until it is switched
+    back. blocks lists (offset, size, compressed offset, compressed size)
+    for each block written.'''
+
+    def __init__(self, fileobj, codec, level=9, workers=None,
+            block_size=4 * 1024 * 1024):
+        import multiprocessing
+
+        check_codec(codec)
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        self.compress = True
+        self.block_size = block_size
+        self.pool = get_pool(workers)
+        self.max_pending = 2 * (workers or multiprocessing.cpu_count())
+        self.pending = deque()
+        self.buf = []
+        self.buf_size = 0
+        self.offset = 0
+        self.compressed_offset = 0
+        self.blocks = []
+        self.closed = False
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_size += len(data)
+        if self.buf_size >= self.block_size:
+            self._submit()
+
+    def set_compress(self, compress):
+        '''Sets whether following data is compressed or stored. The data
+        written so far is ended as a block.'''
+        if compress != self.compress and self.buf_size:
+            self._submit()
+        self.compress = compress
+
+    def close(self):
+        '''Compresses what's left, writes every block and closes
+        fileobj.'''
+        if self.closed:
+            return
+        self.closed = True
+        if self.buf_size:
+            self._submit()
+        while self.pending:
+            self._write_block()
+        self._finish()
+        self.fileobj.close()
+
+    def _submit(self):
+        data = b''.join(self.buf)
+        self.buf = []
+        self.buf_size = 0
+        if self.compress:
+            level = self.level
+        else:
+            level = STORE_LEVEL.get(self.codec)
+        metrics.add('compress', len(data), 1)
+        self.pending.append((self.offset, len(data),
+                self._start_block(level, data)))
+        self.offset += len(data)
+        while len(self.pending) > self.max_pending:
+            self._write_block()
+
+    def _start_block(self, level, data):
+        '''Starts compressing a block; returns the AsyncResult.'''
+        return self.pool.apply_async(compress_block,
+                (self.codec, level, data))
+
+    def _finish(self):
+        '''Called after the last block is written, before fileobj is
+        closed.'''
+        pass
+
+    def _write_block(self):
+        offset, size, result = self.pending.popleft()
+        # Only the wait counts; the writing is the next stage's
+        with metrics.timed('compress'):
+            data = result.get()
+        self.fileobj.write(data)
+        self.blocks.append((offset, size, self.compressed_offset, len(data)))
+        self.compressed_offset += len(data)
+
+
+class DecompressingFile(object):
+    '''A read-only file object over a file of one or more concatenated
+    gzip members, bzip2 streams, zstd frames or lz4 frames. Seeking
+    backwards rereads from the start, as tarfile only does it rarely; it
+    isn't possible if fileobj can't seek.'''
+
+    def __init__(self, fileobj, codec, piece_size=1024 * 1024):
+        check_codec(codec)
+        self.codec = codec
+        self.piece_size = piece_size
+        self.inf = fileobj
+        self.pos = 0
+        self._open()
+
+    def _rewind(self):
+        self.inf.seek(0)
+        self.pos = 0
+        self._open()
+
+    def _open(self):
+        if self.codec == 'zst':
+            import zstandard
+            self.reader = zstandard.ZstdDecompressor().stream_reader(
+                    self.inf, read_across_frames=True)
+        elif self.codec == 'lz4':
+            import lz4.frame
+            self.reader = lz4.frame.LZ4FrameFile(self.inf)
+        elif self.codec == 'gz':
+            self.reader = StreamsReader(self.inf, self.piece_size,
+                    lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+        else:
+            self.reader = StreamsReader(self.inf, self.piece_size,
+                    bz2.BZ2Decompressor)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                data = self.reader.read(self.piece_size)
+                if not data:
+                    break
+                chunks.append(data)
+        else:
+            # The readers may return less than asked for
+            chunks = []
+            remaining = size
+            while remaining > 0:
+                data = self.reader.read(remaining)
+                if not data:
+                    break
+                chunks.append(data)
+                remaining -= len(data)
+        data = b''.join(chunks)
+        self.pos += len(data)
+        metrics.add('decompress', len(data))
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            raise IOError('Cannot seek from the end of a compressed file.')
+        if offset < self.pos:
+            self._rewind()
+        while self.pos < offset:
+            if not self.read(min(self.piece_size, offset - self.pos)):
+                break
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.inf.close()
+
+
+class StreamsReader(object):
+    '''Reads the decompressed data of concatenated gzip or bzip2 streams.
+    new_decompressor returns a decompressor for one stream.'''
+
+    def __init__(self, fileobj, piece_size, new_decompressor):
+        self.fileobj = fileobj
+        self.piece_size = piece_size
+        self.new_decompressor = new_decompressor
+        self.decompressor = new_decompressor()
+        self.buf = b''
+        self.eof = False
+
+    def read(self, size):
+        while len(self.buf) < size and not self.eof:
+            data = self.fileobj.read(self.piece_size)
+            if not data:
+                self.eof = True
+                break
+            while data:
+                try:
+                    with metrics.timed('decompress'):
+                        self.buf += self.decompressor.decompress(data)
+                except EOFError:
+                    # The last stream ended with the previous read
+                    self.decompressor = self.new_decompressor()
+                    continue
+                # Anything after the end of a stream is the next stream
+                data = self.decompressor.unused_data
+                if data:
+                    self.decompressor = self.new_decompressor()
+        data = self.buf[:size]
+        self.buf = self.buf[size:]
+        return data
+
+
+# The first bytes of each kind of file that DecompressingFile reads
+MAGIC = {b'BZh': 'bz2', b'\x28\xb5\x2f\xfd': 'zst',
+        b'\x04\x22\x4d\x18': 'lz4'}
+
+
+def open_tar(path):
+    '''Opens a tar archive for reading, including bzip2 archives made of
+    several streams, zstd and lz4 archives and s3b archives.'''
+    import tarfile
+    import blockarchive
+    import config
+
+    with open(path, 'rb') as inf:
+        head = inf.read(4)
+    if head == blockarchive.MAGIC:
+        return tarfile.open(fileobj=blockarchive.BlockArchiveReader(
+                open(path, 'rb'), config.enc_key, config.compression_workers),
+                mode='r:')
+    for magic, codec in MAGIC.items():
+        if head.startswith(magic):
+            return tarfile.open(fileobj=DecompressingFile(open(path, 'rb'),
+                    codec), mode='r:')
+    return tarfile.open(path, 'r')
+
+
+def open_tar_stream(fileobj, codec):
+    '''Opens a tar archive for reading in stream mode from a file object
+    that can't seek. codec is gz, bz2, zst, lz4 or None.'''
+    import tarfile
+
+    if codec is not None:
+        fileobj = DecompressingFile(fileobj, codec)
+    return tarfile.open(fileobj=fileobj, mode='r|')
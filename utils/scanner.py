@@ -0,0 +1,169 @@
+# scanner.py - Parallel directory tree scanner
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Directories are listed by a pool of threads, so that on network
+# filesystems many listings and stats are waiting on the server at once.
+# scandir (os.scandir, or the scandir package on Python 2) tells
+# directories from files without a stat call; without it we fall back to
+# listdir and lstat.
+
+version = '0.1'
+
+import os
+import stat
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import log
+import metrics
+
+log = log.get_logger('scanner')
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def list_dir(path, follow_links=False):
+    '''Returns a (path, stat, is_dir) tuple for each entry of a directory,
+    sorted by name. is_dir is False for links to directories unless
+    follow_links is set.'''
+    entries = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                st = entry.stat(follow_symlinks=follow_links)
+                is_dir = entry.is_dir(follow_symlinks=follow_links)
+            except OSError:
+                # Removed, or a broken link being followed
+                continue
+            entries.append((entry.path, st, is_dir))
+    else:
+        if follow_links:
+            get_stat = os.stat
+        else:
+            get_stat = os.lstat
+        for name in os.listdir(path):
+            fp = os.path.join(path, name)
+            try:
+                st = get_stat(fp)
+            except OSError:
+                continue
+            entries.append((fp, st, stat.S_ISDIR(st.st_mode)))
+    entries.sort()
+    return entries
+
+
+def scan(paths, follow_links=False, workers=8):
+    '''Yields a (path, stat) tuple for each of paths and for everything in
+    the directories among them, including the directories themselves. A
+    directory always comes before its contents, and each directory's
+    entries are in order. Directories are listed in parallel, but their
+    listings are handed out in the order the directories were found, so
+    the order is the same from run to run. Paths that don't exist are
+    skipped.'''
+    if follow_links:
+        get_stat = os.stat
+    else:
+        get_stat = os.lstat
+
+    todo = queue.Queue()
+    # Bounded so listings don't pile up while the consumer is busy
+    results = queue.Queue(4 * max(workers, 1))
+    # Directories already scanned, so that followed links can't loop
+    seen = set()
+
+    # The number of each directory queued, in the order they were found
+    queued = [0]
+
+    def add_dir(path, st):
+        '''Queues a directory to be listed; returns False if it was already
+        queued.'''
+        if (st.st_dev, st.st_ino) in seen:
+            return False
+        seen.add((st.st_dev, st.st_ino))
+        todo.put((queued[0], path))
+        queued[0] += 1
+        return True
+
+    def work():
+        while True:
+            item = todo.get()
+            if item is None:
+                break
+            number, path = item
+            try:
+                with metrics.timed('scan', io=True):
+                    entries = list_dir(path, follow_links)
+                metrics.add('scan', items=len(entries))
+            except OSError:
+                log.warn('Cannot read directory %s.' % path)
+                entries = []
+            results.put((number, entries))
+
+    threads = [threading.Thread(target=work) for i in range(max(workers, 1))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        pending = 0
+        for path in paths:
+            try:
+                st = get_stat(path)
+            except OSError:
+                continue
+            yield path, st
+            if stat.S_ISDIR(st.st_mode) and add_dir(path, st):
+                pending += 1
+
+        # Listings that came in ahead of their turn
+        listed = {}
+        number = 0
+        while pending:
+            while number not in listed:
+                done, entries = results.get()
+                listed[done] = entries
+            entries = listed.pop(number)
+            number += 1
+            pending -= 1
+            for fp, st, is_dir in entries:
+                yield fp, st
+                if is_dir and add_dir(fp, st):
+                    pending += 1
+    finally:
+        # Drop the directories not listed yet if we were stopped early
+        while True:
+            try:
+                todo.get_nowait()
+            except queue.Empty:
+                break
+        for t in threads:
+            todo.put(None)
+        # Workers may be waiting for room to hand in a listing
+        for t in threads:
+            while t.is_alive():
+                try:
+                    results.get_nowait()
+                except queue.Empty:
+                    t.join(0.01)
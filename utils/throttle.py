@@ -0,0 +1,270 @@
+# throttle.py - Bandwidth limit and transfer autotuning
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Every transfer to or from S3 takes its bytes from one token bucket, so
+# that all of them together stay under bandwidth_limit. Uploads and
+# downloads each have a Tuner that decides how many requests may run at
+# once: every few seconds it compares the throughput with that of the
+# last period and keeps changing the limit in the same direction while
+# that helps, turns back when it hurts, and halves it when requests fail.
+# The Tuner also picks part and range sizes from the throughput of a
+# single transfer, so that each request is long enough to be worth its
+# overhead.
+
+version = '0.1'
+
+import threading
+import time
+from contextlib import contextmanager
+
+import log
+import metrics
+
+log = log.get_logger('throttle')
+
+# S3 allows at most this many parts in a multipart upload
+MAX_PARTS = 10000
+
+# Part sizes are the configured size times a power of two up to this,
+# unless more is needed to stay under MAX_PARTS
+MAX_PART_SCALE = 8
+
+# Parts are made larger until one takes about this many seconds
+PART_SECONDS = 2.0
+
+_limiter = None
+_tuners = {}
+_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    '''Limits a flow to rate bytes a second. After a pause up to burst
+    bytes (a second's worth by default) can go at once.'''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or self.rate
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        '''Takes size tokens, sleeping until they have built up. The bucket
+        can go into debt, which later callers wait out, so large takes are
+        fine.'''
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                    self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledFile(object):
+    '''Wraps a file object so that its reads and writes take their bytes
+    from limiter. Everything else is passed through.'''
+
+    def __init__(self, fileobj, limiter):
+        self.fileobj = fileobj
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.limiter.consume(len(data))
+        return data
+
+    def write(self, data):
+        self.limiter.consume(len(data))
+        self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class Tuner(object):
+    '''Lets at most limit requests run at once, out of max_workers. With
+    autotune the limit and the part size follow the throughput recorded
+    over each interval seconds; otherwise the limit is max_workers and
+    part sizes are only raised to stay under MAX_PARTS.'''
+
+    interval = 5.0
+
+    def __init__(self, name, max_workers, autotune=True, limiter=None):
+        self.name = name
+        self.max_workers = max(max_workers, 1)
+        self.autotune = autotune
+        self.limiter = limiter
+        self.limit = self.max_workers
+        # Try fewer requests first; more only help if the link has room
+        self.step = -1
+        self.active = 0
+        self.cond = threading.Condition()
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_errors = 0
+        self.last_rate = None
+        # Bytes a second of a single request
+        self.stream_rate = None
+
+    def grow(self, max_workers):
+        '''Raises max_workers, for a caller with more threads.'''
+        with self.cond:
+            if max_workers > self.max_workers:
+                if self.limit == self.max_workers or not self.autotune:
+                    self.limit = max_workers
+                self.max_workers = max_workers
+                self.cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        '''Waits until fewer than limit requests are running, then runs the
+        block as one. Its time counts as I/O in the metrics stage named
+        after the tuner.'''
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+        try:
+            with metrics.timed(self.name, io=True):
+                yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+
+    def record(self, size, error=False):
+        '''Records a finished request of size bytes, or a failed one.'''
+        if not error:
+            metrics.add(self.name, size, 1)
+        with self.cond:
+            self.window_bytes += size
+            if error:
+                self.window_errors += 1
+            if self.autotune and (time.time() - self.window_start >=
+                    self.interval):
+                self._adjust()
+
+    def _adjust(self):
+        now = time.time()
+        rate = self.window_bytes / (now - self.window_start)
+        old = self.limit
+        if self.window_bytes:
+            self.stream_rate = rate / self.limit
+        if self.window_errors:
+            # S3 is throttling us or the link is failing; back off, and
+            # measure again from there
+            self.limit = max(self.limit // 2, 1)
+            self.step = -1
+            rate = None
+        elif not self.window_bytes:
+            # Nothing was sent; there is nothing to compare
+            rate = self.last_rate
+        elif (self.limiter is not None and
+                rate >= 0.9 * self.limiter.rate):
+            # More requests would only share the same bandwidth
+            self.step = -1
+        elif self.last_rate is not None and rate < 0.95 * self.last_rate:
+            # The last change made things worse
+            self.step = -self.step
+            self.limit += self.step
+        elif self.last_rate is None or rate > 1.05 * self.last_rate:
+            self.limit += self.step
+        else:
+            # No better; use fewer connections for the same throughput
+            self.step = -1
+            self.limit -= 1
+        self.limit = min(max(self.limit, 1), self.max_workers)
+        if self.limit != old:
+            log.debug('%s: %.0f KB/s with %d requests; now %d.' % (
+                    self.name, self.window_bytes / 1024.0 /
+                    (now - self.window_start), old, self.limit))
+            self.cond.notify_all()
+        self.last_rate = rate
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_errors = 0
+
+    def part_size(self, base, size=None):
+        '''Returns the size of the parts or ranges to transfer size bytes
+        in (size may be unknown): base times a power of two. See
+        part_sizes.'''
+        scale = 1
+        if self.autotune and self.stream_rate:
+            while (scale < MAX_PART_SCALE and
+                    base * scale < self.stream_rate * PART_SECONDS):
+                scale *= 2
+        if size is not None:
+            while base * scale * MAX_PARTS < size:
+                scale *= 2
+        return base * scale
+
+
+def part_sizes(base, size):
+    '''Returns every part size Tuner.part_size might have chosen for size
+    bytes, smallest first.'''
+    sizes = [base]
+    while sizes[-1] < size:
+        sizes.append(sizes[-1] * 2)
+    return sizes
+
+
+def get_limiter():
+    '''Returns the TokenBucket for bandwidth_limit, or None if there is no
+    limit.'''
+    global _limiter
+    import config
+
+    if not config.bandwidth_limit:
+        return None
+    with _lock:
+        if _limiter is None:
+            _limiter = TokenBucket(config.bandwidth_limit)
+        return _limiter
+
+
+def get_tuner(name, workers=None):
+    '''Returns the Tuner for name ('upload' or 'download'), making sure it
+    allows at least workers requests at once.'''
+    import config
+
+    limiter = get_limiter()
+    with _lock:
+        tuner = _tuners.get(name)
+        if tuner is None:
+            tuner = Tuner(name, workers or 1, config.autotune_transfers,
+                    limiter)
+            _tuners[name] = tuner
+    if workers:
+        tuner.grow(workers)
+    return tuner
+
+
+def wrap(fileobj):
+    '''Returns fileobj throttled to bandwidth_limit, if there is one.'''
+    limiter = get_limiter()
+    if limiter is None:
+        return fileobj
+    return ThrottledFile(fileobj, limiter)
+
+
+def consume(size):
+    '''Takes size bytes from the bandwidth limit, if there is one.'''
+    limiter = get_limiter()
+    if limiter is not None:
+        limiter.consume(size)
@@ -0,0 +1,668 @@
+# upload.py - Uploads to S3 in parallel pieces
+
+# Copyright 2012 Ryan Frame
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+version = '0.3'
+
+import threading
+from io import BytesIO
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import aws
+import log
+import throttle
+
+
+log = log.get_logger('upload')
+
+# When the size of an upload isn't known (a streamed archive), its parts
+# double in size every PART_GROWTH parts, so that throttle.MAX_PARTS of
+# them can hold more than their first size would allow. Parts are held in
+# memory, so no part grows past the uploader's max_part_size (at most
+# MAX_PART_SIZE, S3's limit); a streamed upload that would need more than
+# MAX_PARTS parts of that size fails. See max_upload_size.
+PART_GROWTH = 1000
+MAX_PART_SIZE = 5 * 1024 ** 3
+
+
+class MultipartUpload(object):
+    '''Uploads a key as a multipart upload, sending the parts from a pool
+    of worker threads. Each worker has its own connection.
+
+    Use upload_file() to send a file, or use the object as a write-only
+    file and call close() to finish the upload. If anything fails, the
+    upload is cancelled and the error is raised.
+
+    The upload tuner may send fewer parts at once, and larger ones than
+    part_size; size, if known, is the size of the whole upload. If it isn't
+    known, parts grow as the upload does (see PART_GROWTH). Either way no
+    part is larger than max_part_size. Up to workers parts are being sent
+    and workers more are queued, while the next one is filled and copied
+    out of the buffer, so the memory used is at most about
+    (2 * workers + 2) * max_part_size. An upload whose size is known to
+    need more than throttle.MAX_PARTS parts of max_part_size fails at
+    once; a streamed one fails when it reaches the limit.
+
+    With a Checkpoint the sent parts are recorded, and a failed upload is
+    left for a later run to resume rather than cancelled. If the
+    checkpoint holds an earlier upload, that one is continued.'''
+
+    retries = 3
+
+    def __init__(self, bucket, keyname, part_size, workers=1,
+            metadata=None, size=None, checkpoint=None,
+            max_part_size=MAX_PART_SIZE):
+        self.bucket = bucket
+        self.keyname = keyname
+        self.tuner = throttle.get_tuner('upload', workers)
+        self.max_part_size = max(min(max_part_size, MAX_PART_SIZE),
+                part_size)
+        if size is not None and size > (self.max_part_size *
+                throttle.MAX_PARTS):
+            raise IOError('%s is %d MB, more than %d parts of %d MB can '
+                    'hold; raise upload_max_part_size.' % (keyname,
+                    size // 1024 ** 2, throttle.MAX_PARTS,
+                    self.max_part_size // 1024 ** 2))
+        self.part_size = min(self.tuner.part_size(part_size, size),
+                self.max_part_size)
+        self.size = size
+        self.checkpoint = checkpoint
+        self.buf = BytesIO()
+        self.part_num = 0
+        self.etags = {}
+        # Parts already in S3 when resuming: number: (etag, size)
+        self.uploaded = {}
+        self.errors = []
+        self.closed = False
+
+        self.mp = None
+        if checkpoint is not None and checkpoint.state is not None:
+            self._resume()
+        if self.mp is None:
+            self.mp = bucket.initiate_multipart_upload(keyname,
+                    metadata=metadata)
+            log.debug('Started upload %s for %s.' % (self.mp.id, keyname))
+            if checkpoint is not None:
+                checkpoint.start(self.mp.id, self.part_size, metadata)
+
+        self.queue = queue.Queue(workers)
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _resume(self):
+        '''Continues the checkpoint's upload, listing the parts it already
+        has. Starts a new one if S3 no longer knows it.'''
+        import boto.s3.multipart
+
+        state = self.checkpoint.state
+        mp = boto.s3.multipart.MultiPartUpload(self.bucket)
+        mp.key_name = self.keyname
+        mp.id = state['upload_id']
+        # boto returns None rather than raising if the upload is gone
+        if mp.get_all_parts(max_parts=1) is None:
+            log.warn('Upload %s of %s no longer exists; starting again.' %
+                    (mp.id, self.keyname))
+            self.checkpoint.remove()
+            return
+        for part in mp:
+            self.uploaded[part.part_number] = (part.etag, part.size)
+        self.mp = mp
+        self.part_size = state['part_size']
+        log.info('Resuming upload of %s; %d parts were already sent.' %
+                (self.keyname, len(self.uploaded)))
+
+    def _is_uploaded(self, part_num, data):
+        '''Returns whether S3 already has data as the given part.'''
+        if part_num not in self.uploaded:
+            return False
+        etag, size = self.uploaded[part_num]
+        if size != len(data):
+            return False
+        if self.checkpoint.state['parts'].get(str(part_num)) != etag:
+            # Sent, but not recorded before the last run stopped
+            from hashlib import md5
+            if '"%s"' % md5(data).hexdigest() != etag:
+                return False
+        self.etags[part_num] = etag
+        return True
+
+    def upload_file(self, path):
+        '''Uploads the file at path and completes the upload. When resuming,
+        parts that S3 already has are skipped.'''
+        try:
+            with open(path, 'rb') as inf:
+                for piece in iter(lambda: inf.read(self.part_size), b''):
+                    if self._is_uploaded(self.part_num + 1, piece):
+                        self.part_num += 1
+                        continue
+                    self._put(piece)
+            self.close()
+        except:
+            self.abort()
+            raise
+
+    def write(self, data):
+        self.buf.write(data)
+        part_size = self.next_part_size()
+        if self.buf.tell() < part_size:
+            return
+        data = self.buf.getvalue()
+        self.buf = BytesIO()
+        offset = 0
+        while len(data) - offset >= part_size:
+            self._put(data[offset:offset + part_size])
+            offset += part_size
+            part_size = self.next_part_size()
+        self.buf.write(data[offset:])
+
+    def next_part_size(self):
+        '''Returns the size of the next part written.'''
+        if self.size is not None:
+            return self.part_size
+        return min(self.part_size << (self.part_num // PART_GROWTH),
+                self.max_part_size)
+
+    def close(self):
+        '''Sends the last part, waits for the workers and completes the
+        upload.'''
+        if self.closed:
+            return
+        # An empty upload still needs one (empty) part
+        if self.buf.tell() > 0 or self.part_num == 0:
+            self._put(self.buf.getvalue())
+        self.buf = BytesIO()
+        self._stop_workers()
+        if self.errors:
+            self.abort()
+            raise self.errors[0]
+        self._complete()
+        self.closed = True
+
+    def abort(self):
+        '''Cancels the upload so S3 discards the parts already sent. With a
+        checkpoint the upload is kept to be resumed.'''
+        if self.closed:
+            return
+        self.closed = True
+        self._stop_workers()
+        if self.checkpoint is not None:
+            log.warn('Upload of %s stopped; the next run will resume it.' %
+                    self.keyname)
+            return
+        try:
+            self.mp.cancel_upload()
+        except Exception:
+            log.error('Failed to cancel upload %s.' % self.mp.id)
+
+    def _put(self, data):
+        '''Queues data as the next part. Blocks while the workers are
+        busy.'''
+        if self.errors:
+            raise self.errors[0]
+        if self.part_num >= throttle.MAX_PARTS:
+            # Fail now rather than when completing the upload
+            raise IOError('%s needs more than the %d parts S3 allows; '
+                    'parts of at most %d MB hold %d MB. Raise '
+                    'upload_max_part_size.' % (self.keyname,
+                    throttle.MAX_PARTS, self.max_part_size // 1024 ** 2,
+                    max_upload_size(self.part_size, self.max_part_size) //
+                    1024 ** 2))
+        self.part_num += 1
+        self.queue.put((self.part_num, data))
+
+    def _stop_workers(self):
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def _worker(self):
+        '''Sends queued parts until it receives None.'''
+        import boto.s3.multipart
+
+        mp = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.errors:
+                # Something failed; drain the queue without sending
+                continue
+            part_num, data = item
+            try:
+                if mp is None:
+                    mp = boto.s3.multipart.MultiPartUpload(aws.open_bucket())
+                    mp.key_name = self.keyname
+                    mp.id = self.mp.id
+                self.etags[part_num] = self._send_part(mp, part_num, data)
+                if self.checkpoint is not None:
+                    self.checkpoint.add_part(part_num, self.etags[part_num])
+            except Exception as e:
+                log.error('Failed to send part %d of %s: %s' % (part_num,
+                        self.keyname, e))
+                self.errors.append(e)
+
+    def _send_part(self, mp, part_num, data):
+        '''Sends a part, retrying on failure, and returns its ETag.'''
+        from boto.utils import compute_md5
+
+        fp = BytesIO(data)
+        md5 = compute_md5(fp)
+        for attempt in range(self.retries):
+            try:
+                fp.seek(0)
+                with self.tuner.slot():
+                    key = mp.upload_part_from_file(throttle.wrap(fp),
+                            part_num, md5=md5[:2], size=len(data))
+                self.tuner.record(len(data))
+                log.debug('Sent part %d (%d bytes).' % (part_num, len(data)))
+                return key.etag
+            except Exception as e:
+                self.tuner.record(0, True)
+                if attempt == self.retries - 1:
+                    raise
+                log.warn('Retrying part %d: %s' % (part_num, e))
+
+    def _complete(self):
+        parts = ''.join(['<Part><PartNumber>%d</PartNumber><ETag>%s</ETag>'
+                '</Part>' % (n, self.etags[n]) for n in sorted(self.etags)])
+        self.bucket.complete_multipart_upload(self.keyname, self.mp.id,
+                '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' %
+                parts)
+        log.debug('Completed upload of %s in %d parts.' % (self.keyname,
+                len(self.etags)))
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+
+
+class Checkpoint(object):
+    '''Records a multipart upload of a file in a JSON file in
+    upload_checkpoints, so that a later run can resume it: the upload id,
+    the part size, the file's path, size and mtime, the metadata, and the
+    ETag of each part sent. state is None if there is no usable
+    checkpoint.'''
+
+    def __init__(self, keyname, path):
+        import os
+        import config
+
+        self.keyname = keyname
+        self.path = path
+        self.file = os.path.join(config.upload_checkpoints,
+                checkpoint_name(keyname))
+        self.lock = threading.Lock()
+        self.state = read_checkpoint(self.file)
+        if self.state is not None and not self.matches():
+            log.debug('Discarding the checkpoint of %s; the file changed.' %
+                    keyname)
+            self.discard()
+
+    def matches(self):
+        '''Returns whether the checkpoint is of the same key and an
+        unchanged file at the same path.'''
+        import os
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (self.state['key'] == self.keyname and
+                self.state['path'] == os.path.abspath(self.path) and
+                self.state['size'] == st.st_size and
+                self.state['mtime'] == st.st_mtime)
+
+    def start(self, upload_id, part_size, metadata=None):
+        import os
+        import time
+
+        st = os.stat(self.path)
+        self.state = {'key': self.keyname, 'upload_id': upload_id,
+                'part_size': part_size, 'path': os.path.abspath(self.path),
+                'size': st.st_size, 'mtime': st.st_mtime,
+                'metadata': metadata or {}, 'started': time.time(),
+                'parts': {}}
+        self.save()
+
+    def add_part(self, part_num, etag):
+        with self.lock:
+            self.state['parts'][str(part_num)] = etag
+            self.save()
+
+    def save(self):
+        '''Writes the checkpoint, replacing the old one atomically.'''
+        import json
+        import os
+
+        if not os.path.isdir(os.path.dirname(self.file)):
+            os.makedirs(os.path.dirname(self.file))
+        tmp = self.file + '.tmp'
+        with open(tmp, 'w') as outf:
+            json.dump(self.state, outf)
+        os.rename(tmp, self.file)
+
+    def remove(self):
+        import os
+
+        self.state = None
+        if os.path.exists(self.file):
+            os.remove(self.file)
+
+    def discard(self):
+        '''Cancels the recorded upload and removes the checkpoint.'''
+        cancel_upload(aws.open_bucket(), self.state['key'],
+                self.state['upload_id'])
+        self.remove()
+
+
+def checkpoint_name(keyname):
+    '''Returns the name of the checkpoint file of a key. Keys are hashed
+    since no file name made by replacing their slashes is unique.'''
+    import hashlib
+
+    # Keys read back from a checkpoint are unicode
+    if not isinstance(keyname, bytes):
+        keyname = keyname.encode('utf-8')
+    return hashlib.sha1(keyname).hexdigest() + '.json'
+
+
+def read_checkpoint(path):
+    '''Returns the state saved in a checkpoint file, or None.'''
+    import json
+
+    try:
+        with open(path) as inf:
+            return json.load(inf)
+    except (IOError, ValueError):
+        return None
+
+
+def list_checkpoints(prefix):
+    '''Returns the Checkpoints of the keys under prefix whose files are
+    still unchanged.'''
+    import os
+    import config
+
+    checkpoints = []
+    if not os.path.isdir(config.upload_checkpoints):
+        return checkpoints
+    for name in sorted(os.listdir(config.upload_checkpoints)):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(config.upload_checkpoints, name)
+        state = read_checkpoint(path)
+        if state is None or not state['key'].startswith(prefix):
+            continue
+        # Older versions named the file after the key
+        new_path = os.path.join(config.upload_checkpoints,
+                checkpoint_name(state['key']))
+        if path != new_path:
+            if os.path.exists(new_path):
+                os.remove(path)
+                continue
+            os.rename(path, new_path)
+        checkpoint = Checkpoint(state['key'], state['path'])
+        if checkpoint.state is not None:
+            checkpoints.append(checkpoint)
+    return checkpoints
+
+
+def cancel_upload(bucket, keyname, upload_id):
+    '''Cancels a multipart upload, logging rather than raising if it
+    fails.'''
+    try:
+        bucket.cancel_multipart_upload(keyname, upload_id)
+        log.info('Cancelled upload %s of %s.' % (upload_id, keyname))
+    except Exception as e:
+        log.debug('Cannot cancel upload %s of %s: %s' % (upload_id,
+                keyname, e))
+
+
+def clean_uploads(bucket, prefix, max_age):
+    '''Removes checkpoints older than max_age seconds and cancels the
+    multipart uploads under prefix started before then, so that S3 stops
+    keeping (and charging for) their parts.'''
+    import os
+    import time
+    from boto.utils import parse_ts
+    from calendar import timegm
+    import config
+
+    cutoff = time.time() - max_age
+    # Uploads with a current checkpoint are kept whatever S3 says
+    keep = set()
+    if os.path.isdir(config.upload_checkpoints):
+        for name in os.listdir(config.upload_checkpoints):
+            path = os.path.join(config.upload_checkpoints, name)
+            state = read_checkpoint(path)
+            if state is None or state['started'] < cutoff:
+                log.debug('Removing stale checkpoint %s.' % path)
+                os.remove(path)
+            else:
+                keep.add(state['upload_id'])
+    for upload in bucket.list_multipart_uploads():
+        if not upload.key_name.startswith(prefix) or upload.id in keep:
+            continue
+        if timegm(parse_ts(upload.initiated).timetuple()) < cutoff:
+            cancel_upload(bucket, upload.key_name, upload.id)
+
+
+class UploadReport(object):
+    '''Counts the files sent, copied and skipped by upload_files and lists
+    (path, error) for those that failed.'''
+
+    def __init__(self):
+        self.sent = 0
+        self.bytes = 0
+        self.copied = 0
+        self.skipped = 0
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def add_copied(self):
+        with self.lock:
+            self.copied += 1
+
+    def add_skipped(self):
+        with self.lock:
+            self.skipped += 1
+
+    def add_sent(self, size):
+        with self.lock:
+            self.sent += 1
+            self.bytes += size
+
+    def add_failed(self, path, error):
+        with self.lock:
+            self.failed.append((path, error))
+
+
+def upload_files(bucket, files, workers=4, retries=3, should_send=None,
+        find_copy=None):
+    '''Uploads each (path, keyname) in files, workers files at a time, and
+    returns an UploadReport. The workers share bucket's connection, whose
+    pool gives each of them a keep-alive HTTP connection; each has its own
+    Key. A file that fails is tried up to retries times. If should_send is
+    given, files for which should_send(path, keyname) is False are
+    skipped. If find_copy is given, a file for which find_copy(path,
+    keyname) returns a key already holding it is copied from that key
+    within S3 instead. Small files are sent within the upload tuner's
+    limit.'''
+    from log import FileProgress
+
+    throttle.get_tuner('upload', workers)
+    jobs = queue.Queue(2 * workers)
+    report = UploadReport()
+    progress = FileProgress(log, 'Sent')
+
+    def work():
+        while True:
+            item = jobs.get()
+            if item is None:
+                return
+            path, keyname = item
+            try:
+                if should_send is not None and not should_send(path,
+                        keyname):
+                    report.add_skipped()
+                    continue
+                source = None
+                if find_copy is not None:
+                    source = find_copy(path, keyname)
+                if source is not None:
+                    copy_key(bucket, source, keyname)
+                    report.add_copied()
+                    continue
+                size = send_file(bucket, path, keyname, retries)
+                report.add_sent(size)
+                progress.add(path, size)
+            except Exception as e:
+                log.error('Failed to upload %s: %s' % (path, e))
+                report.add_failed(path, e)
+
+    threads = []
+    for i in range(workers):
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    try:
+        for item in files:
+            jobs.put(item)
+    finally:
+        for t in threads:
+            jobs.put(None)
+        for t in threads:
+            t.join()
+    progress.finish()
+    return report
+
+
+def max_upload_size(part_size, max_part_size):
+    '''Returns the most a streamed upload can hold, starting from parts of
+    part_size and growing to max_part_size.'''
+    size = 0
+    for i in range(0, throttle.MAX_PARTS, PART_GROWTH):
+        size += min(part_size << (i // PART_GROWTH),
+                max_part_size) * min(PART_GROWTH, throttle.MAX_PARTS - i)
+    return size
+
+
+def copy_key(bucket, source, keyname):
+    '''Copies the key source (a Key) to keyname within the bucket, with its
+    metadata. Keys larger than S3 copies in one request are copied in
+    parts, sized as uploads of the same size would be.'''
+    import config
+
+    if source.size <= MAX_PART_SIZE:
+        bucket.copy_key(keyname, bucket.name, source.name)
+        log.debug('Copied %s to %s.' % (source.name, keyname))
+        return
+
+    part_size = throttle.get_tuner('upload').part_size(
+            config.upload_part_size, source.size)
+    metadata = bucket.get_key(source.name).metadata
+    mp = bucket.initiate_multipart_upload(keyname, metadata=metadata)
+    try:
+        for part_num, start in enumerate(range(0, source.size, part_size),
+                1):
+            mp.copy_part_from_key(bucket.name, source.name, part_num, start,
+                    min(start + part_size, source.size) - 1)
+        mp.complete_upload()
+    except:
+        mp.cancel_upload()
+        raise
+    log.debug('Copied %s to %s in parts.' % (source.name, keyname))
+
+
+def send_data(bucket, keyname, data, retries=3, metadata=None):
+    '''Uploads a string to keyname, retrying on failure. Strings larger
+    than upload_part_size are sent as multipart uploads.'''
+    import config
+
+    if len(data) > config.upload_part_size:
+        upload = MultipartUpload(bucket, keyname, config.upload_part_size,
+                config.upload_workers, metadata, len(data),
+                max_part_size=config.upload_max_part_size)
+        try:
+            upload.write(data)
+            upload.close()
+        except:
+            upload.abort()
+            raise
+        return
+
+    for attempt in range(retries):
+        try:
+            put_file(bucket.new_key(keyname), BytesIO(data), metadata)
+            log.debug('Sent %s (%d bytes).' % (keyname, len(data)))
+            return
+        except Exception as e:
+            if attempt == retries - 1:
+                raise
+            log.warn('Retrying %s: %s' % (keyname, e))
+
+
+def send_file(bucket, path, keyname, retries=3, metadata=None):
+    '''Uploads a file to keyname, retrying on failure, and returns its
+    size. The metadata defaults to the file's hash. Files larger than
+    upload_part_size are sent as multipart uploads.'''
+    import os
+    import config
+    from encrypt import get_file_hash
+
+    size = os.path.getsize(path)
+    if metadata is None:
+        metadata = {'hash': get_file_hash(path)}
+    if size > config.upload_part_size:
+        MultipartUpload(bucket, keyname, config.upload_part_size,
+                config.upload_workers, metadata, size,
+                Checkpoint(keyname, path),
+                config.upload_max_part_size).upload_file(path)
+        return size
+
+    for attempt in range(retries):
+        try:
+            with open(path, 'rb') as inf:
+                put_file(bucket.new_key(keyname), inf, metadata)
+            return size
+        except Exception as e:
+            if attempt == retries - 1:
+                raise
+            log.warn('Retrying %s: %s' % (path, e))
+
+
+def put_file(key, fp, metadata=None):
+    '''Sends the rest of fp as the contents of key with a single PUT,
+    within the upload tuner's limit and the bandwidth limit.'''
+    tuner = throttle.get_tuner('upload')
+    if metadata:
+        key.update_metadata(metadata)
+    # Hashed before throttling so the bytes are only counted once
+    md5 = key.compute_md5(fp)
+    try:
+        with tuner.slot():
+            key.set_contents_from_file(throttle.wrap(fp), md5=md5)
+    except Exception:
+        tuner.record(0, True)
+        raise
+    tuner.record(key.size)